@@ -0,0 +1,114 @@
+# Seeding CPU cost per GB: the buffered upload path vs blocks from mmap buffers vs os.sendfile from plain files.
+# usage: PYTHONPATH=src python benchmarks/seed_bench.py [size_mb]
+
+import asyncio
+import hashlib
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import List
+
+from yap_torrent.protocol import TorrentInfo
+from yap_torrent.protocol import bt_main_messages as msg
+from yap_torrent.protocol.connection import Connection
+from yap_torrent.storage import FileStorage, MMapStorage
+
+PIECE_LENGTH = 2 ** 18
+BLOCK_SIZE = 2 ** 14
+# length prefix and PIECE header
+MESSAGE_OVERHEAD = 4 + 9
+
+
+def make_info(size: int) -> TorrentInfo:
+	pieces_num = (size + PIECE_LENGTH - 1) // PIECE_LENGTH
+	return TorrentInfo({"name": b"bench", "piece length": PIECE_LENGTH, "pieces": bytes(20 * pieces_num), "length": size})
+
+
+def receive(sock: socket.socket, total: int, cpu_times: List[float]) -> None:
+	start = time.thread_time()
+	buffer = bytearray(2 ** 20)
+	received = 0
+	while received < total:
+		n = sock.recv_into(buffer)
+		if not n:
+			break
+		received += n
+	cpu_times.append(time.thread_time() - start)
+
+
+async def send_buffered(connection: Connection, storage: FileStorage, info: TorrentInfo, root: Path) -> None:
+	# the upload system on a cache miss: load the piece, check it, slice blocks and pack messages
+	for index in range(info.pieces_num):
+		data = storage.load_piece(root, info, index)
+		for begin in range(0, len(data), BLOCK_SIZE):
+			hashlib.sha1(data).digest()
+			await connection.send(msg.piece(index, begin, data[begin:begin + BLOCK_SIZE]))
+
+
+async def send_mmap(connection: Connection, storage: MMapStorage, info: TorrentInfo, root: Path) -> None:
+	for index in range(info.pieces_num):
+		for begin in range(0, info.calculate_piece_size(index), BLOCK_SIZE):
+			block = storage.read_block(root, info, index, begin, BLOCK_SIZE)
+			await connection.send_chunks(msg.piece_header(index, begin), block)
+
+
+async def send_sendfile(connection: Connection, storage: FileStorage, info: TorrentInfo, root: Path) -> None:
+	for index in range(info.pieces_num):
+		for begin in range(0, info.calculate_piece_size(index), BLOCK_SIZE):
+			file, offset = storage.open_block(root, info, index, begin, BLOCK_SIZE)
+			with file:
+				await connection.send_file(msg.piece_header(index, begin), file, offset, BLOCK_SIZE)
+
+
+async def run(name: str, send, storage, info: TorrentInfo, root: Path) -> None:
+	total = info.size + (info.size // BLOCK_SIZE) * MESSAGE_OVERHEAD
+
+	listener = socket.create_server(("127.0.0.1", 0))
+	reader, writer = await asyncio.open_connection(*listener.getsockname())
+	sock, _ = listener.accept()
+	listener.close()
+
+	receiver_times: List[float] = []
+	receiver = threading.Thread(target=receive, args=(sock, total, receiver_times))
+	receiver.start()
+
+	connection = Connection(b"bench", reader, writer)
+	cpu_start = time.process_time()
+	start = time.perf_counter()
+	await send(connection, storage, info, root)
+	await asyncio.to_thread(receiver.join)
+	wall_time = time.perf_counter() - start
+	cpu_time = time.process_time() - cpu_start - receiver_times[0]
+
+	writer.close()
+	sock.close()
+	storage.close()
+
+	gb = info.size / 2 ** 30
+	print(f"{name:>9} | {cpu_time / gb:6.2f} CPU s/GB | {info.size / 2 ** 20 / wall_time:8.1f} MB/s")
+
+
+async def main():
+	size = int(sys.argv[1]) * 2 ** 20 if len(sys.argv) > 1 else 512 * 2 ** 20
+	info = make_info(size)
+
+	with tempfile.TemporaryDirectory() as root:
+		root = Path(root)
+		path = info.get_file_path(root, info.get_file(0))
+		path.parent.mkdir(parents=True, exist_ok=True)
+		with open(path, "wb") as f:
+			for _ in range(0, size, 2 ** 20):
+				f.write(os.urandom(2 ** 20))
+			f.truncate(size)
+
+		await run("buffered", send_buffered, FileStorage(), info, root)
+		await run("mmap", send_mmap, MMapStorage(30), info, root)
+		await run("sendfile", send_sendfile, FileStorage(), info, root)
+
+
+if __name__ == '__main__':
+	asyncio.run(main())
@@ -0,0 +1,112 @@
+# Torrent data storage benchmark: current file path vs pwrite vs mmap, with memory and null storages as a baseline.
+# usage: PYTHONPATH=src python benchmarks/storage_bench.py [size_mb] [files]
+
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from yap_torrent.protocol import TorrentInfo
+from yap_torrent.storage import FileStorage, MMapStorage, Storage, MemoryStorage, NullStorage
+from yap_torrent.utils import load_piece
+
+PIECE_LENGTH = 2 ** 18
+BLOCK_SIZE = 2 ** 14
+
+
+def make_info(size: int, files_num: int) -> TorrentInfo:
+	file_length = size // files_num
+	pieces_num = (file_length * files_num + PIECE_LENGTH - 1) // PIECE_LENGTH
+	return TorrentInfo({
+		"name": b"bench",
+		"piece length": PIECE_LENGTH,
+		"pieces": bytes(20 * pieces_num),
+		"files": [{"length": file_length, "path": [f"file_{i}".encode()]} for i in range(files_num)],
+	})
+
+
+class PWriteStorage(Storage):
+	def __init__(self):
+		self._fds = {}
+
+	def _fd(self, path: Path, length: int) -> int:
+		fd = self._fds.get(path)
+		if fd is None:
+			path.parent.mkdir(parents=True, exist_ok=True)
+			fd = os.open(path, os.O_RDWR | os.O_CREAT)
+			os.ftruncate(fd, length)
+			self._fds[path] = fd
+		return fd
+
+	def load_piece(self, root: Path, info: TorrentInfo, index: int) -> bytes:
+		data = bytearray(info.get_piece_info(index).size)
+		for file, start_pos, end_pos in info.piece_to_files(index):
+			read_from = start_pos % info.piece_length
+			fd = self._fd(info.get_file_path(root, file), file.length)
+			data[read_from:read_from + end_pos - start_pos] = os.pread(fd, end_pos - start_pos, start_pos - file.start)
+		return bytes(data)
+
+	def save_piece(self, root: Path, info: TorrentInfo, index: int, data: bytes) -> None:
+		buffer = memoryview(data)
+		for file, start_pos, end_pos in info.piece_to_files(index):
+			read_from = start_pos % info.piece_length
+			fd = self._fd(info.get_file_path(root, file), file.length)
+			os.pwrite(fd, buffer[read_from:read_from + end_pos - start_pos], start_pos - file.start)
+
+	def close(self) -> None:
+		for fd in self._fds.values():
+			os.close(fd)
+
+
+def run(name: str, storage: Storage, info: TorrentInfo, root: Path) -> None:
+	payload = os.urandom(PIECE_LENGTH)
+
+	start = time.perf_counter()
+	for index in range(info.pieces_num):
+		storage.save_piece(root, info, index, payload[:info.calculate_piece_size(index)])
+	storage.flush(force=True)
+	write_time = time.perf_counter() - start
+
+	start = time.perf_counter()
+	blocks = 0
+	for index in range(info.pieces_num):
+		for begin in range(0, info.calculate_piece_size(index), BLOCK_SIZE):
+			block = storage.read_block(root, info, index, begin, BLOCK_SIZE)
+			if block is None:
+				# the way the upload system does it: load the piece and slice a block
+				block = storage.load_piece(root, info, index)[begin:begin + BLOCK_SIZE]
+			blocks += len(block)
+	read_time = time.perf_counter() - start
+	storage.close()
+
+	size_mb = info.size / 2 ** 20
+	print(f"{name:>8} | write {size_mb / write_time:9.1f} MB/s | block read {blocks / 2 ** 20 / read_time:9.1f} MB/s")
+
+
+def main():
+	size = int(sys.argv[1]) * 2 ** 20 if len(sys.argv) > 1 else 256 * 2 ** 20
+	files_num = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+	info = make_info(size, files_num)
+
+	storages = (
+		("file", FileStorage()),
+		("pwrite", PWriteStorage()),
+		("mmap", MMapStorage(30)),
+		("memory", MemoryStorage()),
+		("null", NullStorage()),
+	)
+	for name, storage in storages:
+		with tempfile.TemporaryDirectory() as root:
+			run(name, storage, info, Path(root))
+
+	# sanity check: data written by mmap is visible to the plain file reader
+	with tempfile.TemporaryDirectory() as root:
+		storage = MMapStorage(30)
+		storage.save_piece(Path(root), info, 0, b"x" * PIECE_LENGTH)
+		storage.close()
+		assert load_piece(Path(root), info, 0) == b"x" * PIECE_LENGTH
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,64 @@
+# TorrentInfo memory benchmark on a torrent with a lot of files: decoded info dict vs compact TorrentInfo.
+# usage: PYTHONPATH=src python benchmarks/torrent_info_bench.py [files]
+
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+from yap_torrent.protocol import TorrentInfo, encode, decode
+
+PIECE_LENGTH = 2 ** 18
+
+
+def make_metadata(files_num: int) -> bytes:
+	# files of a few hundred KB in a hundred folders
+	files = [
+		{"length": 100_000 + i % 300_000, "path": [f"folder_{i % 100}".encode(), f"file_{i}.bin".encode()]}
+		for i in range(files_num)]
+	size = sum(f["length"] for f in files)
+	pieces_num = (size + PIECE_LENGTH - 1) // PIECE_LENGTH
+	return encode({"name": b"bench", "piece length": PIECE_LENGTH, "pieces": os.urandom(20 * pieces_num), "files": files})
+
+
+def measure(name: str, factory):
+	# build time is measured with tracemalloc on. compare it between the rows only
+	gc.collect()
+	tracemalloc.start()
+	start = time.perf_counter()
+	value = factory()
+	spent = time.perf_counter() - start
+	size, _ = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	print(f"{name:>12} | {size / 2 ** 20:8.1f} MB | build {spent:6.3f} s")
+	return value
+
+
+def main():
+	files_num = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+	metadata = make_metadata(files_num)
+	print(f"{files_num} files, metadata {len(metadata) / 2 ** 20:.1f} MB")
+
+	# the old TorrentInfo kept the decoded dict and the metadata was encoded again on every request
+	data = measure("dict", lambda: decode(metadata))
+	del data
+
+	# the compact form keeps the metadata bytes. piece hashes are a view of them
+	info = measure("compact", lambda: TorrentInfo.from_metadata(metadata))
+	assert info.get_metadata() == metadata
+
+	start = time.perf_counter()
+	files = info.files
+	print(f"{'files':>12} | {len(files)} in {time.perf_counter() - start:.3f} s")
+
+	start = time.perf_counter()
+	pieces = range(0, info.pieces_num, max(1, info.pieces_num // 1000))
+	for index in pieces:
+		for _ in info.piece_to_files(index):
+			pass
+	print(f"{'piece files':>12} | {len(pieces)} pieces in {time.perf_counter() - start:.3f} s")
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,79 @@
+# Validation benchmark on a mostly empty sparse download: hole detection vs reading every byte,
+# in one chunk and in chunks of a single piece the way a subset validation splits them.
+# usage: PYTHONPATH=src python benchmarks/validation_bench.py [size_mb] [percent_done]
+
+import hashlib
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from yap_torrent.protocol import TorrentInfo
+from yap_torrent.storage import FileStorage
+from yap_torrent.systems import bt_validation_system
+from yap_torrent.systems.bt_validation_system import _make_chunk, _check_chunk, _split_chunks
+
+PIECE_LENGTH = 2 ** 20
+
+
+def make_download(root: Path, size: int, percent_done: float):
+	pieces_num = (size + PIECE_LENGTH - 1) // PIECE_LENGTH
+	done = set(random.sample(range(pieces_num), int(pieces_num * percent_done / 100)))
+
+	payload = {index: os.urandom(PIECE_LENGTH) for index in done}
+	hashes = b"".join(
+		hashlib.sha1(payload[index]).digest() if index in done else os.urandom(20) for index in range(pieces_num))
+	info = TorrentInfo({"name": b"bench", "piece length": PIECE_LENGTH, "length": size, "pieces": hashes})
+
+	# the same way the client does it: a truncated sparse file with some pieces written
+	storage = FileStorage()
+	for index in sorted(done):
+		storage.save_piece(root, info, index, payload[index][:info.calculate_piece_size(index)])
+	return info, done
+
+
+def run(name: str, info: TorrentInfo, root: Path, done: set, chunk_size: int) -> None:
+	files = list(info.files)
+	bt_validation_system.CHUNK_SIZE = chunk_size
+	chunks = [_make_chunk(info, root, files, first, last) for first, last in
+	          _split_chunks(info, set(range(info.pieces_num)))]
+
+	start = time.perf_counter()
+	result = set()
+	for chunk in chunks:
+		result.update(_check_chunk(chunk))
+	spent = time.perf_counter() - start
+
+	assert result == done, f"{name}: wrong result"
+	print(f"{name:>8} | {spent:7.3f} s | {info.size / 2 ** 20 / spent:9.1f} MB/s")
+
+
+def main():
+	size = int(sys.argv[1]) * 2 ** 20 if len(sys.argv) > 1 else 2 ** 30
+	percent_done = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+	with tempfile.TemporaryDirectory() as root:
+		info, done = make_download(Path(root), size, percent_done)
+		print(f"{size / 2 ** 20:.0f} MB, {len(done)} of {info.pieces_num} pieces done")
+
+		chunk_size = bt_validation_system.CHUNK_SIZE
+		try:
+			run("sparse", info, Path(root), done, info.size)
+			run("chunks", info, Path(root), done, chunk_size)
+			run("pieces", info, Path(root), done, PIECE_LENGTH)
+
+			# pretend the file system can't report holes
+			data_ranges = bt_validation_system._data_ranges
+			bt_validation_system._data_ranges = lambda fd, start, end: None
+			try:
+				run("read all", info, Path(root), done, info.size)
+			finally:
+				bt_validation_system._data_ranges = data_ranges
+		finally:
+			bt_validation_system.CHUNK_SIZE = chunk_size
+
+
+if __name__ == '__main__':
+	main()
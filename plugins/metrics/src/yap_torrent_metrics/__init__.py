@@ -0,0 +1,68 @@
+import asyncio
+import logging
+from asyncio import StreamReader, StreamWriter, Server
+from typing import Set, Optional
+
+from yap_torrent.env import Env
+from yap_torrent.plugins import TorrentPlugin
+from .exporter import export
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 9177
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# yap_torrent.plugins.metrics
+class MetricsPlugin(TorrentPlugin):
+	def __init__(self):
+		self._env: Optional[Env] = None
+		self._server: Optional[Server] = None
+
+	async def start(self, env: Env):
+		self._env = env
+		host = env.config.data.get("metrics_host", DEFAULT_HOST)
+		port = int(env.config.data.get("metrics_port", DEFAULT_PORT))
+		self._server = await asyncio.start_server(self._on_connect, host, port)
+		logger.info(f"Metrics are served at http://{host}:{port}/metrics")
+
+	def close(self):
+		if self._server:
+			self._server.close()
+
+	@staticmethod
+	def get_purpose() -> Set[str]:
+		return {"metrics"}
+
+	async def _on_connect(self, reader: StreamReader, writer: StreamWriter):
+		try:
+			request = await asyncio.wait_for(reader.readline(), 5)
+			# skip headers
+			while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+				pass
+
+			parts = request.decode("latin-1").split()
+			if len(parts) < 2 or parts[0] != "GET":
+				await self._respond(writer, "405 Method Not Allowed", b"")
+			elif parts[1].split("?")[0] not in ("/", "/metrics"):
+				await self._respond(writer, "404 Not Found", b"")
+			else:
+				await self._respond(writer, "200 OK", export(self._env).encode())
+		except (TimeoutError, ConnectionError) as ex:
+			logger.debug(f"Metrics request failed: {ex}")
+		finally:
+			writer.close()
+
+	@staticmethod
+	async def _respond(writer: StreamWriter, status: str, body: bytes):
+		writer.write(
+			f"HTTP/1.1 {status}\r\nContent-Type: {CONTENT_TYPE}\r\nContent-Length: {len(body)}\r\n"
+			f"Connection: close\r\n\r\n".encode())
+		writer.write(body)
+		await writer.drain()
+
+
+plugin = MetricsPlugin()
+
+logger.info(f"Metrics plugin imported")
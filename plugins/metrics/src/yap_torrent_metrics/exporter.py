@@ -0,0 +1,62 @@
+from typing import Dict, List
+
+from yap_torrent.env import Env
+from yap_torrent.metrics import HISTOGRAM, COUNTER, GAUGE
+from yap_torrent.profiler import Histogram
+
+
+def _escape(value: str) -> str:
+	return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+	if not labels:
+		return ""
+	values = ",".join(f'{k}="{_escape(str(v))}"' for k, v in labels.items())
+	return f"{{{values}}}"
+
+
+def _format_histogram(lines: List[str], name: str, labels: Dict[str, str], histogram: Histogram):
+	# prometheus buckets are cumulative
+	seen = 0
+	for index, value in enumerate(histogram.buckets[:-1]):
+		seen += value
+		bucket_labels = dict(labels, le=f"{histogram.upper_bound(index):g}")
+		lines.append(f"{name}_bucket{_format_labels(bucket_labels)} {seen}")
+	lines.append(f"{name}_bucket{_format_labels(dict(labels, le='+Inf'))} {histogram.count}")
+	lines.append(f"{name}_sum{_format_labels(labels)} {histogram.total}")
+	lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+
+
+def _add_family(lines: List[str], name: str, kind: str, description: str, series: List) -> None:
+	lines.append(f"# HELP {name} {description}")
+	lines.append(f"# TYPE {name} {kind}")
+	for labels, value in series:
+		if kind == HISTOGRAM:
+			_format_histogram(lines, name, labels, value)
+		else:
+			lines.append(f"{name}{_format_labels(labels)} {getattr(value, 'value', value)}")
+
+
+def export(env: Env) -> str:
+	lines: List[str] = []
+	for name, kind, description, series in env.metrics.collect():
+		_add_family(lines, name, kind, description, series)
+
+	# scheduler and loop health. kept by the core anyway
+	stats = env.scheduler.stats
+	_add_family(lines, "yap_torrent_scheduler_updates_total", COUNTER, "Updates of systems and plugins",
+	            [({"job": k}, v.updates) for k, v in stats.items()])
+	_add_family(lines, "yap_torrent_scheduler_errors_total", COUNTER, "Failed updates of systems and plugins",
+	            [({"job": k}, v.errors) for k, v in stats.items()])
+	_add_family(lines, "yap_torrent_scheduler_lag_seconds", GAUGE, "Average delay of planned updates",
+	            [({"job": k}, v.lag_avg) for k, v in stats.items()])
+
+	watchdog = env.watchdog
+	if watchdog:
+		_add_family(lines, "yap_torrent_loop_lag_seconds", HISTOGRAM, "Event loop lag", [({}, watchdog.lag)])
+		_add_family(lines, "yap_torrent_loop_stalls_total", COUNTER, "Event loop stalls longer than the threshold",
+		            [({}, watchdog.stalls_count)])
+
+	lines.append("")
+	return "\n".join(lines)
@@ -5,7 +5,7 @@ from angelovich.core.DataStorage import Entity
 
 from yap_torrent.components.torrent_ec import TorrentEC, TorrentInfoEC, TorrentStatsEC
 from yap_torrent.env import Env
-from yap_torrent.systems import get_torrent_name
+from yap_torrent.systems import get_torrent_name, is_torrent_loaded, calculate_downloaded
 
 
 def _cls():
@@ -43,7 +43,11 @@ def _torrent_list(env: Env, loop: asyncio.AbstractEventLoop):
 def _torrent(env: Env, loop: asyncio.AbstractEventLoop, torrent_entity: Entity):
 	_cls()
 	info_hash = torrent_entity.get_component(TorrentEC).info_hash
-	if torrent_entity.has_component(TorrentInfoEC):
+	if not is_torrent_loaded(torrent_entity):
+		loop.create_task(send_event(env, "request.torrent.load", info_hash))
+		print(get_torrent_name(torrent_entity))
+		print(f"Complete: {calculate_downloaded(torrent_entity):.2%}")
+	elif torrent_entity.has_component(TorrentInfoEC):
 		info = torrent_entity.get_component(TorrentInfoEC).info
 		print(info.name)
 		print(f"Complete: {info.calculate_downloaded(torrent_entity.get_component(TorrentEC).bitfield.have_num):.2%}")
@@ -12,8 +12,8 @@ from textual.widgets import ListView, Footer, ListItem, Label, Button
 
 from yap_torrent.components.torrent_ec import TorrentEC, TorrentStatsEC
 from yap_torrent.env import Env
-from yap_torrent.systems import calculate_downloaded
-from ..utils import get_torrent_name
+from yap_torrent.systems import calculate_downloaded, calculate_rates, calculate_eta, get_info_hash
+from ..utils import get_torrent_name, format_eta
 
 
 class TorrentInfo(Widget):
@@ -37,6 +37,8 @@ class TorrentInfo(Widget):
 		yield Label(id="torrent-completed")
 		yield Label(id="torrent-downloaded")
 		yield Label(id="torrent-uploaded")
+		yield Label(id="torrent-rates")
+		yield Label(id="torrent-eta")
 		with Horizontal():
 			yield Button("+peers", id="add-peers-button")
 			yield Button("Check", id="check-torrent-button")
@@ -57,14 +59,22 @@ class TorrentInfo(Widget):
 
 	def update_time(self):
 		downloaded = uploaded = completed = ""
+		download_rate = upload_rate = 0.0
+		eta = None
 		if self._entity:
+			env: Env = self.app.env
 			completed = calculate_downloaded(self._entity)
 			downloaded = self._entity.get_component(TorrentStatsEC).downloaded
 			uploaded = self._entity.get_component(TorrentStatsEC).uploaded
+			download_rate, upload_rate = calculate_rates(env, get_info_hash(self._entity))
+			eta = calculate_eta(env, self._entity)
 
 		self.query_one("#torrent-completed", expect_type=Label).update(f"Complete: {completed:.2%}")
 		self.query_one("#torrent-downloaded", expect_type=Label).update(f"Downloaded: {downloaded:,} bytes")
 		self.query_one("#torrent-uploaded", expect_type=Label).update(f"Uploaded: {uploaded:,} bytes")
+		self.query_one("#torrent-rates", expect_type=Label).update(
+			f"Speed: {download_rate / 1024:,.1f} / {upload_rate / 1024:,.1f} KiB/s")
+		self.query_one("#torrent-eta", expect_type=Label).update(f"ETA: {format_eta(eta)}")
 
 	@on(Button.Pressed, "#add-peers-button")
 	def add_peers(self):
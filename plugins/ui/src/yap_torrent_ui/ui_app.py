@@ -1,3 +1,5 @@
+import logging
+
 from textual.app import App, ComposeResult
 from textual.screen import Screen
 from textual.widgets import Footer
@@ -7,6 +9,8 @@ from .screens.add_magnet import AddMagnetDialog
 from .screens.bsod import BSOD
 from .screens.torrents_list import TorrentsList
 
+logger = logging.getLogger(__name__)
+
 
 class Root(Screen):
 	BINDINGS = [
@@ -27,6 +31,7 @@ class TorrentUIApp(App):
 	}
 	BINDINGS = [
 		("m", "app.push_screen('magnet_dialog')", "Add magnet"),
+		("p", "toggle_profiler", "Profiler"),
 		("ctrl+c", "help_quit"),
 	]
 
@@ -43,6 +48,16 @@ class TorrentUIApp(App):
 	def action_quit(self) -> None:
 		self.env.close_event.set()
 
+	def action_toggle_profiler(self) -> None:
+		profiler = self.env.profiler
+		if profiler.enabled:
+			profiler.disable()
+			logger.info(profiler.dump_text())
+			self.notify("Profiler stopped. Results are in the log")
+		else:
+			profiler.enable()
+			self.notify("Profiler started")
+
 	def on_mount(self) -> None:
 		self.push_screen(Root())
 
@@ -2,14 +2,24 @@ from typing import Optional
 
 from angelovich.core.DataStorage import Entity
 
-from yap_torrent.components.torrent_ec import TorrentInfoEC, TorrentEC
+from yap_torrent.components.torrent_ec import TorrentInfoEC, TorrentEC, TorrentStubEC
 
 
 def get_torrent_name(entity: Optional[Entity], default_text="No Data") -> str:
 	if entity:
 		if entity.has_component(TorrentInfoEC):
 			return entity.get_component(TorrentInfoEC).info.name
+		elif entity.has_component(TorrentStubEC):
+			return entity.get_component(TorrentStubEC).name
 		else:
 			return f"[{entity.get_component(TorrentEC).info_hash}]"
 	else:
 		return default_text
+
+
+def format_eta(eta: Optional[float]) -> str:
+	if eta is None:
+		return "∞"
+	minutes, seconds = divmod(int(eta), 60)
+	hours, minutes = divmod(minutes, 60)
+	return f"{hours}:{minutes:02}:{seconds:02}"
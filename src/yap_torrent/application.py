@@ -1,6 +1,6 @@
 import asyncio
 import logging
-import time
+from pathlib import Path
 from typing import List
 
 import yap_torrent.plugins as plugins
@@ -18,16 +18,22 @@ from yap_torrent.systems.bt_extension_system import BTExtensionSystem
 from yap_torrent.systems.bt_intrest_system import BTInterestedSystem
 from yap_torrent.systems.bt_local_data_system import LocalDataSystem
 from yap_torrent.systems.bt_magnet_system import MagnetSystem
+from yap_torrent.systems.bt_scrub_system import ScrubSystem
+from yap_torrent.systems.bt_super_seed_system import SuperSeedSystem
 from yap_torrent.systems.bt_upload_system import BTUploadSystem
 from yap_torrent.systems.bt_validation_system import ValidationSystem
 from yap_torrent.systems.peer_system import PeerSystem
 from yap_torrent.systems.piece_system import PieceSystem
 from yap_torrent.systems.torrents_system import TorrentSystem
 from yap_torrent.systems.watch_system import WatcherSystem
+from yap_torrent.watchdog import LoopWatchdog
 
 logger = logging.getLogger(__name__)
 
+# plugins update time
 GLOBAL_TICK_TIME = 1
+# scheduler stats to the log
+STATS_REPORT_TIME = 60
 
 
 def network_setup() -> tuple[str, str]:
@@ -60,10 +66,12 @@ class Application:
 			PeerSystem(env),
 			BTChokeSystem(env),
 			BTInterestedSystem(env),
+			SuperSeedSystem(env),
 			BTDownloadSystem(env),
 			BTUploadSystem(env),
 			PieceSystem(env),
 			ValidationSystem(env),
+			ScrubSystem(env),
 			BTExtensionSystem(env),
 			BTExtMetadataSystem(env),
 			BTDHTSystem(env),
@@ -84,6 +92,13 @@ class Application:
 
 		logger.info("Torrent application start")
 
+		# watch the loop from the very start. systems startup can block it too
+		config = env.config
+		if config.loop_lag_threshold > 0:
+			env.watchdog = LoopWatchdog(
+				asyncio.get_running_loop(), config.loop_watchdog_interval, config.loop_lag_threshold)
+			env.watchdog.start()
+
 		for system in self.systems:
 			logger.debug(f"start system {system}")
 			await system.start()
@@ -92,27 +107,18 @@ class Application:
 			logger.debug(f"start plugin {plugin}")
 			await plugin.start(env)
 
-		logger.info("Torrent application initialized")
-
-		last_time = time.monotonic()
-		while not close_event.is_set():
-			current_time = time.monotonic()
-			dt = current_time - last_time
-			last_time = current_time
-
-			try:
-				for system in self.systems:
-					await system.update(dt)
-			except Exception as ex:
-				logger.error("unexpected exception on systems update: %s", ex, exc_info=True)
+		# every system and plugin is updated on its own. systems can be woken up by events
+		scheduler = env.scheduler
+		for system in self.systems:
+			scheduler.add(str(system), system.update, system.update_time, system.wake_event)
+		for plugin in self.plugins:
+			scheduler.add(f"Plugin: {plugin.__class__.__name__}", plugin.update, GLOBAL_TICK_TIME)
+		scheduler.add("Scheduler stats", self._report_stats, STATS_REPORT_TIME)
 
-			try:
-				for plugin in self.plugins:
-					await plugin.update(dt)
-			except Exception as ex:
-				logger.error("unexpected exception on plugins update: %s", ex, exc_info=True)
+		logger.info("Torrent application initialized")
 
-			await asyncio.sleep(GLOBAL_TICK_TIME)
+		await close_event.wait()
+		await scheduler.close()
 
 		logger.info("Torrent application stop")
 		self.stop()
@@ -124,9 +130,33 @@ class Application:
 	# leftovers = asyncio.all_tasks()
 	# print(leftovers)
 
+	async def _report_stats(self, _: float):
+		logger.debug(f"Scheduler stats:\n{self.env.scheduler.report()}")
+		watchdog = self.env.watchdog
+		if watchdog:
+			logger.debug(f"Loop lag: p50 {watchdog.lag.percentile(0.5) * 1000:.1f} ms, "
+			             f"p99 {watchdog.lag.percentile(0.99) * 1000:.1f} ms, max {watchdog.lag.max * 1000:.1f} ms, "
+			             f"stalls {watchdog.stalls_count}")
+		if self.env.profiler.enabled:
+			logger.debug(self.env.profiler.dump_text())
+
 	def stop(self):
 		for system in self.systems:
 			system.close()
 
 		for plugin in self.plugins:
 			plugin.close()
+
+		self.env.storage.close()
+		self.env.bandwidth.close()
+
+		if self.env.watchdog:
+			self.env.watchdog.stop()
+
+		# profiling results of the session
+		profiler = self.env.profiler
+		if profiler.enabled:
+			logger.info(profiler.dump_text())
+			profile_path = Path(self.env.config.data_folder).joinpath("profile.json")
+			profile_path.write_text(profiler.dump_json())
+			logger.info(f"Profile saved to {profile_path}")
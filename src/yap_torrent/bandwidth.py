@@ -0,0 +1,197 @@
+import asyncio
+import logging
+import time
+from asyncio import Future, Task
+from collections import deque
+from typing import Dict, Deque, Tuple, Optional
+
+logger = logging.getLogger(__name__)
+
+# bytes granted to a waiting request in one round. one block
+QUANTUM = 2 ** 14
+# seconds of the rate a bucket can save for a burst
+BURST_TIME = 1.0
+# seconds between rounds of waiting requests
+TICK_TIME = 0.05
+
+
+class TokenBucket:
+	__slots__ = ("_rate", "_tokens", "_time")
+
+	def __init__(self, rate: int = 0):
+		self._rate: int = 0
+		self._tokens: float = 0
+		self._time: float = time.monotonic()
+		self.rate = rate
+
+	@property
+	def rate(self) -> int:
+		# bytes per second. 0 means no limit
+		return self._rate
+
+	@rate.setter
+	def rate(self, rate: int) -> None:
+		self._refill(time.monotonic())
+		self._rate = max(int(rate), 0)
+		self._tokens = min(self._tokens, self.burst)
+
+	@property
+	def limited(self) -> bool:
+		return self._rate > 0
+
+	@property
+	def burst(self) -> float:
+		return max(self._rate * BURST_TIME, QUANTUM)
+
+	def _refill(self, now: float) -> None:
+		if self._rate > 0:
+			self._tokens = min(self._tokens + (now - self._time) * self._rate, self.burst)
+		self._time = now
+
+	def available(self, now: float) -> int:
+		# a limit can be removed while requests wait
+		if self._rate <= 0:
+			return QUANTUM
+		self._refill(now)
+		return int(self._tokens)
+
+	def consume(self, amount: int) -> None:
+		self._tokens -= amount
+
+
+class _Request:
+	__slots__ = ("left", "buckets", "future")
+
+	def __init__(self, amount: int, buckets: Tuple[TokenBucket, ...], future: Future):
+		self.left: int = amount
+		self.buckets: Tuple[TokenBucket, ...] = buckets
+		self.future: Future = future
+
+
+class BandwidthChannel:
+	# one direction of traffic. buckets make a tree: the channel, then torrents, then peers.
+	# a request passes when all its buckets have tokens. waiting torrents get the tokens in turns
+	def __init__(self, rate: int = 0):
+		self.bucket: TokenBucket = TokenBucket(rate)
+		self._torrents: Dict[bytes, TokenBucket] = {}
+
+		# info hash -> waiting requests of the torrent
+		self._queues: Dict[bytes, Deque[_Request]] = {}
+		self._task: Optional[Task] = None
+
+	@property
+	def rate(self) -> int:
+		return self.bucket.rate
+
+	@rate.setter
+	def rate(self, rate: int) -> None:
+		self.bucket.rate = rate
+
+	def torrent(self, info_hash: bytes) -> TokenBucket:
+		bucket = self._torrents.get(info_hash)
+		if bucket is None:
+			bucket = self._torrents[info_hash] = TokenBucket()
+		return bucket
+
+	def remove_torrent(self, info_hash: bytes) -> None:
+		self._torrents.pop(info_hash, None)
+
+	@property
+	def waiting(self) -> int:
+		return sum(len(queue) for queue in self._queues.values())
+
+	async def acquire(self, amount: int, info_hash: bytes, peer_bucket: TokenBucket) -> None:
+		buckets = tuple(b for b in (self.bucket, self.torrent(info_hash), peer_bucket) if b.limited)
+		if not buckets:
+			return
+
+		# pass at once if nobody waits and there are enough tokens
+		now = time.monotonic()
+		if not self._queues and all(b.available(now) >= amount for b in buckets):
+			for bucket in buckets:
+				bucket.consume(amount)
+			return
+
+		future = asyncio.get_running_loop().create_future()
+		self._queues.setdefault(info_hash, deque()).append(_Request(amount, buckets, future))
+		if not self._task or self._task.done():
+			self._task = asyncio.create_task(self._serve())
+		await future
+
+	def close(self) -> None:
+		if self._task:
+			self._task.cancel()
+		for queue in self._queues.values():
+			for request in queue:
+				request.future.cancel()
+		self._queues.clear()
+
+	async def _serve(self) -> None:
+		while self._queues:
+			self._grant(time.monotonic())
+			if self._queues:
+				await asyncio.sleep(TICK_TIME)
+
+	def _grant(self, now: float) -> None:
+		# round-robin over torrents, a quantum at a time, until nobody can get more
+		progress = True
+		while progress and self._queues:
+			progress = False
+			for info_hash in list(self._queues):
+				queue = self._queues[info_hash]
+				served = self._grant_queue(queue, now)
+				progress = progress or served
+				# served torrents go to the end of the line
+				if served or not queue:
+					del self._queues[info_hash]
+				if served and queue:
+					self._queues[info_hash] = queue
+
+	@staticmethod
+	def _grant_queue(queue: Deque[_Request], now: float) -> bool:
+		# the first request which can get tokens. peers of the torrent take turns too
+		for _ in range(len(queue)):
+			request = queue[0]
+			# the waiting task is gone. a closed connection for example
+			if request.future.done():
+				queue.popleft()
+				continue
+
+			amount = min(request.left, QUANTUM, *(b.available(now) for b in request.buckets))
+			if amount <= 0:
+				queue.rotate(-1)
+				continue
+
+			for bucket in request.buckets:
+				bucket.consume(amount)
+			request.left -= amount
+			if request.left <= 0:
+				queue.popleft()
+				request.future.set_result(None)
+			else:
+				queue.rotate(-1)
+			return True
+		return False
+
+
+class Bandwidth:
+	def __init__(self, download_rate: int = 0, upload_rate: int = 0):
+		self.download: BandwidthChannel = BandwidthChannel(download_rate)
+		self.upload: BandwidthChannel = BandwidthChannel(upload_rate)
+
+	def set_rates(self, download_rate: int, upload_rate: int) -> None:
+		logger.info(f"Bandwidth limits set to {download_rate} down, {upload_rate} up")
+		self.download.rate = download_rate
+		self.upload.rate = upload_rate
+
+	def set_torrent_rates(self, info_hash: bytes, download_rate: int, upload_rate: int) -> None:
+		self.download.torrent(info_hash).rate = download_rate
+		self.upload.torrent(info_hash).rate = upload_rate
+
+	def remove_torrent(self, info_hash: bytes) -> None:
+		self.download.remove_torrent(info_hash)
+		self.upload.remove_torrent(info_hash)
+
+	def close(self) -> None:
+		self.download.close()
+		self.upload.close()
@@ -38,6 +38,11 @@ class TorrentMetadataEC(EntityComponent):
 	def is_complete(self) -> bool:
 		return len(self.metadata) == self.metadata_size
 
+	def clear(self) -> None:
+		self.metadata_size = -1
+		self.metadata = bytes()
+		self.pieces.clear()
+
 	def set_metadata(self, metadata: bytes) -> "TorrentMetadataEC":
 		self.metadata = metadata
 		self.metadata_size = len(metadata)
@@ -1,13 +1,18 @@
 import logging
+import random
 import time
 from asyncio import Task
-from typing import Set, Iterable, Iterator, Dict
+from collections import deque
+from typing import Set, Iterable, Iterator, Dict, Tuple, Deque, Optional
 
 from angelovich.core.DataStorage import EntityComponent
 
+from yap_torrent.bandwidth import TokenBucket
+from yap_torrent.metrics import Gauge
 from yap_torrent.protocol import bt_main_messages as msg
 from yap_torrent.protocol.connection import Connection
 from yap_torrent.protocol.structures import PeerInfo, PieceBlockInfo, Bitfield
+from yap_torrent.rate import RateMeter, RttEstimator
 
 logger = logging.getLogger(__name__)
 
@@ -30,9 +35,15 @@ class PeerConnectionEC(EntityComponent):
 
 		self.remote_choked = True
 		self.remote_interested = False
+		# last time the remote side was choked or unchoked
+		self.remote_choked_time: float = time.monotonic()
 
 		self.remote_bitfield: Bitfield = Bitfield()
 
+		# bandwidth limits of the peer. no limit by default
+		self.download_bucket: TokenBucket = TokenBucket()
+		self.upload_bucket: TokenBucket = TokenBucket()
+
 	def __hash__(self):
 		return hash(self.peer_info.host)
 
@@ -51,12 +62,14 @@ class PeerConnectionEC(EntityComponent):
 			return
 		await self.connection.send(msg.choke())
 		self.remote_choked = True
+		self.remote_choked_time = time.monotonic()
 
 	async def unchoke(self) -> None:
 		if not self.remote_choked:
 			return
 		await self.connection.send(msg.unchoke())
 		self.remote_choked = False
+		self.remote_choked_time = time.monotonic()
 
 	async def request(self, block: PieceBlockInfo) -> None:
 		await self.connection.send(msg.request(block.index, block.begin, block.length))
@@ -65,15 +78,116 @@ class PeerConnectionEC(EntityComponent):
 		return f"Peer {self.peer_info.host} [{self.connection.remote_peer_id}]"
 
 
+class PeerStatsEC(EntityComponent):
+	# transfer rates of a connected peer and the round trip time of block requests
+	def __init__(self) -> None:
+		super().__init__()
+		self.download: RateMeter = RateMeter()
+		self.upload: RateMeter = RateMeter()
+		self.rtt: RttEstimator = RttEstimator()
+
+		# send time of requests waiting for an answer
+		self._requests: Dict[Tuple[int, int], float] = {}
+
+	def on_request(self, block: PieceBlockInfo) -> None:
+		self._requests[(block.index, block.begin)] = time.monotonic()
+
+	def on_block(self, index: int, begin: int, length: int) -> None:
+		now = time.monotonic()
+		self.download.add(length, now)
+		request_time = self._requests.pop((index, begin), None)
+		if request_time is not None:
+			self.rtt.add(now - request_time)
+
+	def on_upload(self, length: int) -> None:
+		self.upload.add(length)
+
+	def clear_requests(self) -> None:
+		# a choke drops all requests. late blocks are not rtt samples
+		self._requests.clear()
+
+	@property
+	def requests_num(self) -> int:
+		return len(self._requests)
+
+
+class UploadQueueEC(EntityComponent):
+	# blocks the peer requested and we haven't sent yet
+	def __init__(self, max_size: int, size_gauge: Optional[Gauge] = None) -> None:
+		super().__init__()
+		self.max_size: int = max_size
+		self._blocks: Deque[PieceBlockInfo] = deque()
+		self._last: Optional[PieceBlockInfo] = None
+
+		# the task which sends the blocks
+		self.task: Optional[Task] = None
+
+		self._size_gauge: Gauge = size_gauge or Gauge()
+
+	def __len__(self) -> int:
+		return len(self._blocks)
+
+	def _reset(self):
+		if self.task:
+			self.task.cancel()
+		self.clear()
+		super()._reset()
+
+	@property
+	def is_full(self) -> bool:
+		return len(self._blocks) >= self.max_size
+
+	def add(self, block: PieceBlockInfo) -> None:
+		self._blocks.append(block)
+		self._size_gauge.inc()
+
+	def cancel(self, block: PieceBlockInfo) -> bool:
+		try:
+			self._blocks.remove(block)
+		except ValueError:
+			return False
+		self._size_gauge.dec()
+		return True
+
+	def clear(self) -> None:
+		self._size_gauge.dec(len(self._blocks))
+		self._blocks.clear()
+
+	def pop(self) -> PieceBlockInfo:
+		# the block right after the last sent one reads ahead on disk. first come first served otherwise
+		last = self._last
+		block = self._blocks[0]
+		if last and (block.index != last.index or block.begin != last.begin + last.length):
+			for candidate in self._blocks:
+				if candidate.index == last.index and candidate.begin == last.begin + last.length:
+					block = candidate
+					break
+		self._blocks.remove(block)
+		self._size_gauge.dec()
+		self._last = block
+		return block
+
+
 class KnownPeersEC(EntityComponent):
 	_MAX_CONNECT_ATTEMPTS = 5
+	# a retry waits twice as long after each failed attempt
 	_COOLDOWN_DURATION = 30
+	_MAX_COOLDOWN_DURATION = 30 * 60
 
 	def __init__(self):
 		super().__init__()
 		self._peers: Set[PeerInfo] = set()
 		self._fails: Dict[str, int] = {}
-		self._last_attempts: Dict[str, float] = {}
+		self._retry_times: Dict[str, float] = {}
+		# bytes received from a host over the previous connections
+		self._scores: Dict[str, int] = {}
+
+		# known peers of all torrents
+		self.peers_gauge: Gauge = Gauge()
+
+	def _reset(self):
+		self.peers_gauge.dec(len(self._peers))
+		super()._reset()
 
 	@property
 	def peers(self) -> Set[PeerInfo]:
@@ -83,32 +197,45 @@ class KnownPeersEC(EntityComponent):
 		new_peers = set(peers) - self._peers
 		logger.debug("New peers amount: %s", len(new_peers))
 		self._peers.update(new_peers)
+		self.peers_gauge.inc(len(new_peers))
 
 		for peer in new_peers:
 			self._fails[peer.host] = 0
-			self._last_attempts[peer.host] = 0
+			self._retry_times[peer.host] = 0
 
 	def get_fails_count(self, peer: PeerInfo):
 		return self._fails.get(peer.host, 0)
 
+	def get_score(self, host: str) -> int:
+		return self._scores.get(host, 0)
+
+	def add_score(self, host: str, amount: int) -> None:
+		if amount > 0:
+			self._scores[host] = self._scores.get(host, 0) + amount
+
 	def mark_good(self, peer: PeerInfo):
 		self._fails[peer.host] = 0
+		self._retry_times[peer.host] = 0
 
 	def mark_failed(self, peer: PeerInfo):
-		self._fails[peer.host] += 1
-		self._last_attempts[peer.host] = time.monotonic()
+		# incoming peers may be unknown
+		fails = self._fails[peer.host] = self._fails.get(peer.host, 0) + 1
+		cooldown = min(self._COOLDOWN_DURATION * 2 ** (fails - 1), self._MAX_COOLDOWN_DURATION)
+		# a jitter. peers from one announce don't retry all at once
+		self._retry_times[peer.host] = time.monotonic() + cooldown * random.uniform(0.75, 1.25)
 
 	def get_peers_to_connect(self, active_peers: Set[str]) -> Iterator[PeerInfo]:
+		now = time.monotonic()
 		for peer in self._peers:
 			if peer.host in active_peers:
 				continue
 
 			# give up after 5 failed attempts
-			if self._fails[peer.host] > self._MAX_CONNECT_ATTEMPTS:
+			if self._fails[peer.host] >= self._MAX_CONNECT_ATTEMPTS:
 				continue
 
 			# on a cooldown, skip
-			if time.monotonic() - self._last_attempts[peer.host] < self._COOLDOWN_DURATION:
+			if now < self._retry_times[peer.host]:
 				continue
 
 			# finally, return a peer to connect
@@ -6,6 +6,7 @@ from typing import Dict, Set, Generator, Callable, Optional, Tuple
 from angelovich.core.DataStorage import EntityComponent, EntityHashComponent
 
 from yap_torrent.components.peer_ec import PeerConnectionEC
+from yap_torrent.metrics import Counter, Gauge
 from yap_torrent.protocol import TorrentInfo
 from yap_torrent.protocol.structures import PieceBlockInfo, Bitfield
 
@@ -28,6 +29,16 @@ class TorrentInfoEC(EntityComponent):
 		self.info: TorrentInfo = torrent_info
 
 
+class TorrentStubEC(EntityComponent):
+	# a torrent with metadata and bitfield still on disk. keeps only what is needed to show it
+	def __init__(self, name: str, progress: float, left: int) -> None:
+		super().__init__()
+		self.name: str = name
+		self.progress: float = progress
+		# bytes left to download. used for announces
+		self.left: int = left
+
+
 class TorrentPathEC(EntityComponent):
 	def __init__(self, path: Path) -> None:
 		super().__init__()
@@ -50,6 +61,10 @@ class TorrentStatsEC(EntityComponent):
 
 		self.state: TorrentState = TorrentState(kwargs.get("state", TorrentState.Active))
 
+		# session bytes for metrics
+		self.uploaded_counter: Counter = Counter()
+		self.downloaded_counter: Counter = Counter()
+
 	def export(self) -> Dict[str, int]:
 		return {
 			"uploaded": self.uploaded,
@@ -60,10 +75,12 @@ class TorrentStatsEC(EntityComponent):
 	def update_uploaded(self, length: int) -> None:
 		self._uploaded += length
 		self._session_uploaded += length
+		self.uploaded_counter.inc(length)
 
 	def update_downloaded(self, length: int) -> None:
 		self._downloaded += length
 		self._session_downloaded += length
+		self.downloaded_counter.inc(length)
 
 	@property
 	def uploaded(self) -> float:
@@ -86,32 +103,50 @@ class TorrentDownloadEC(EntityComponent):
 	class InProgress:
 		MAX_DOWNLOADS_PER_PEER = 10
 
-		def __init__(self):
+		def __init__(self, requests_gauge: Gauge):
 			self._blocks_to_peers: Dict[PieceBlockInfo, Set[PeerConnectionEC]] = {}
 			self._peers_to_block: Dict[PeerConnectionEC, Set[PieceBlockInfo]] = {}
 
+			# requests sent and not answered yet
+			self.requests_num: int = 0
+			self._requests_gauge: Gauge = requests_gauge
+
 		def add(self, block: PieceBlockInfo, peer: PeerConnectionEC):
-			self._blocks_to_peers.setdefault(block, set()).add(peer)
+			peers = self._blocks_to_peers.setdefault(block, set())
+			if peer not in peers:
+				self._update_requests(1)
+			peers.add(peer)
 			self._peers_to_block.setdefault(peer, set()).add(block)
 
 		def remove_block(self, block) -> Set[PeerConnectionEC]:
 			peers = self._blocks_to_peers.pop(block, set())
 			for peer in peers:
 				self._peers_to_block[peer].remove(block)
+			self._update_requests(-len(peers))
 			return peers
 
 		def remove_peer(self, peer_hash) -> Set[PieceBlockInfo]:
 			blocks = self._peers_to_block.pop(peer_hash, set())
 			for block in blocks:
 				self._blocks_to_peers[block].remove(peer_hash)
+			self._update_requests(-len(blocks))
 			return blocks
 
+		def _update_requests(self, delta: int):
+			self.requests_num += delta
+			self._requests_gauge.inc(delta)
+
 		def get_endgame_block(self, interested_in: Set[int], peer: PeerConnectionEC) -> Optional[PieceBlockInfo]:
 			for block in self._blocks_to_peers:
 				if block.index in interested_in and peer not in self._blocks_to_peers[block]:
 					return block
 			return None
 
+		def remove_all(self):
+			self._update_requests(-self.requests_num)
+			self._blocks_to_peers.clear()
+			self._peers_to_block.clear()
+
 		def has_free_slot(self, peer: PeerConnectionEC) -> bool:
 			return len(self._peers_to_block.get(peer, set())) < self.MAX_DOWNLOADS_PER_PEER
 
@@ -134,17 +169,32 @@ class TorrentDownloadEC(EntityComponent):
 		def is_full(self) -> bool:
 			return self._size == self._downloaded
 
-	def __init__(self, info: TorrentInfo, find_next_piece: Callable[[Set[int]], int]):
+	def __init__(self, info: TorrentInfo, find_next_piece: Callable[[Set[int]], int],
+	             requests_gauge: Optional[Gauge] = None, buffers_gauge: Optional[Gauge] = None):
 		self._info: TorrentInfo = info
 		self._find_next_piece: Callable[[Set[int]], int] = find_next_piece
 
 		self._blocks_queue: Set[PieceBlockInfo] = set()
 		self._pieces: Dict[int, TorrentDownloadEC.PieceData] = {}
 
-		self._in_progress: TorrentDownloadEC.InProgress = TorrentDownloadEC.InProgress()
+		self._in_progress: TorrentDownloadEC.InProgress = TorrentDownloadEC.InProgress(requests_gauge or Gauge())
+
+		# bytes of pieces in progress
+		self._buffers_size: int = 0
+		self._buffers_gauge: Gauge = buffers_gauge or Gauge()
 
 		super().__init__()
 
+	def _reset(self):
+		# all requests and buffers are gone with the component
+		self._in_progress.remove_all()
+		self._update_buffers(-self._buffers_size)
+		super()._reset()
+
+	def _update_buffers(self, delta: int):
+		self._buffers_size += delta
+		self._buffers_gauge.inc(delta)
+
 	def _find_next_block(self, interested_in: Set[int]) -> Optional[PieceBlockInfo]:
 		# looking in already requested blocks
 		for block in self._blocks_queue:
@@ -168,6 +218,7 @@ class TorrentDownloadEC(EntityComponent):
 
 		# register a new piece
 		self._pieces[index] = TorrentDownloadEC.PieceData(piece_info.size)
+		self._update_buffers(piece_info.size)
 
 		# add a new piece to the blocks_manager
 		new_blocks = piece_info.create_blocks()
@@ -225,7 +276,10 @@ class TorrentDownloadEC(EntityComponent):
 
 	def pop_piece_data(self, index: int) -> bytes:
 		piece = self._pieces.pop(index, None)
-		return piece.data if piece else bytes()
+		if not piece:
+			return bytes()
+		self._update_buffers(-len(piece.data))
+		return piece.data
 
 	def cancel(self, peer: PeerConnectionEC):
 		logger.debug("%s cleaned up.", peer)
@@ -238,4 +292,46 @@ class SaveTorrentEC(EntityComponent):
 
 
 class ValidateTorrentEC(EntityComponent):
-	pass
+	def __init__(self, pieces: Optional[Set[int]] = None) -> None:
+		super().__init__()
+		# pieces to check. None means the whole torrent
+		self.pieces: Optional[Set[int]] = pieces
+
+		self.checked: int = 0
+		self.total: int = 0
+
+		# failed attempts and the time to try again
+		self.fails: int = 0
+		self.retry_time: float = 0
+
+	def reset(self, total: int) -> None:
+		self.checked = 0
+		self.total = total
+
+
+class SuperSeedEC(EntityComponent):
+	# initial seeding. peers see only the pieces we offer them, one at a time
+	def __init__(self) -> None:
+		super().__init__()
+		# peer host -> the piece offered and waiting to spread
+		self.offered: Dict[str, int] = {}
+		# peer host -> all pieces announced to the peer. only these are served
+		self.announced: Dict[str, Set[int]] = {}
+		# times each piece was offered
+		self.offers: Dict[int, int] = {}
+		# pieces seen on a peer we didn't give them to
+		self.spread: Set[int] = set()
+		# every piece has spread. the torrent is seeded as usual
+		self.finished: bool = False
+
+	def offer(self, host: str, index: int) -> None:
+		self.offered[host] = index
+		self.announced.setdefault(host, set()).add(index)
+		self.offers[index] = self.offers.get(index, 0) + 1
+
+	def forget(self, host: str) -> None:
+		self.offered.pop(host, None)
+		self.announced.pop(host, None)
+
+	def is_announced(self, host: str, index: int) -> bool:
+		return index in self.announced.get(host, ())
@@ -1,5 +1,6 @@
 import json
 import logging
+import os
 from typing import Dict, Any
 
 logger = logging.getLogger(__name__)
@@ -30,8 +31,68 @@ class Config:
 		self.port: int = int(data.get("port", 6889))
 
 		self.max_connections = int(data.get("max_connections", 30))
+		# outgoing connections: in progress at once and new ones per second (0 - no limit)
+		self.max_half_open: int = int(data.get("max_half_open", 8))
+		self.connect_rate: float = float(data.get("connect_rate", 10))
+		# incoming connections: handshakes in progress at once and connections from one address
+		self.max_inbound_handshakes: int = int(data.get("max_inbound_handshakes", 16))
+		self.max_connections_per_ip: int = int(data.get("max_connections_per_ip", 3))
+		# connections of one torrent (0 - up to max_connections)
+		self.max_torrent_connections: int = int(data.get("max_torrent_connections", 0))
 
 		self.dht_port: int = int(data.get("dht_port", 6999))
+
+		# torrent data storage: "file", "mmap", "memory" or "null"
+		self.storage_mode: str = data.get("storage_mode", "file")
+		self.mmap_flush_interval: float = float(data.get("mmap_flush_interval", 30))
+		# send uncached blocks of "file" storage with os.sendfile.
+		# such blocks skip the hash check before upload and rely on the scrubber (scrub_bandwidth) instead
+		self.use_sendfile: bool = bool(data.get("use_sendfile", True))
+
+		# files validation: worker processes, torrents at once and disk read limit in bytes per second (0 - no limit)
+		self.validation_workers: int = int(data.get("validation_workers", os.cpu_count() or 1))
+		self.max_validations: int = int(data.get("max_validations", 2))
+		self.validation_bandwidth: int = int(data.get("validation_bandwidth", 0))
+
+		# resume data journal size in bytes to compact it into a snapshot at
+		self.resume_journal_size: int = int(data.get("resume_journal_size", 2 ** 22))
+
+		# seconds without peers to unload torrent metadata from memory (0 - never)
+		self.unload_idle_time: float = float(data.get("unload_idle_time", 1800))
+
+		# background check of stored pieces: disk read limit in bytes per second (0 - disabled)
+		# and upload plus download speed in bytes per second to pause the check at
+		self.scrub_bandwidth: int = int(data.get("scrub_bandwidth", 2 ** 20))
+		self.scrub_max_load: int = int(data.get("scrub_max_load", 2 ** 19))
+
+		# time spent in systems and event listeners. can be switched at runtime with env.profiler
+		self.profiler_enabled: bool = bool(data.get("profiler_enabled", False))
+
+		# download and upload limits of all torrents in bytes per second (0 - no limit). can be changed at runtime
+		# with env.bandwidth
+		self.download_rate_limit: int = int(data.get("download_rate_limit", 0))
+		self.upload_rate_limit: int = int(data.get("upload_rate_limit", 0))
+
+		# peers to upload to at once (0 - tune to the upload capacity)
+		self.upload_slots: int = int(data.get("upload_slots", 0))
+
+		# seeding: peers to upload to at once (0 - share upload_slots with downloading torrents by interested peers),
+		# seconds an unchoked peer keeps its slot
+		# and the order to unchoke peers in: "round_robin", "fastest_upload" or "anti_leech"
+		self.seed_upload_slots: int = int(data.get("seed_upload_slots", 0))
+		self.seed_rotation_interval: float = float(data.get("seed_rotation_interval", 30))
+		self.seed_choking: str = data.get("seed_choking", "round_robin")
+
+		# block requests of a peer waiting for upload. more are dropped
+		self.max_upload_queue: int = int(data.get("max_upload_queue", 64))
+
+		# super-seeding of complete torrents: peers get single rare pieces until every piece has spread
+		self.super_seeding: bool = bool(data.get("super_seeding", False))
+
+		# event loop lag in seconds to log the stack of the blocking call at (0 - disabled) and ping interval
+		self.loop_lag_threshold: float = float(data.get("loop_lag_threshold", 0.25))
+		self.loop_watchdog_interval: float = float(data.get("loop_watchdog_interval", 0.1))
+
 		self._data = data
 
 	@property
@@ -0,0 +1,98 @@
+import logging
+import time
+from asyncio import StreamReader, StreamWriter
+from typing import Set, Optional, Tuple
+
+import yap_torrent.protocol.connection as net
+from yap_torrent.metrics import Metrics
+from yap_torrent.protocol.structures import PeerInfo
+from yap_torrent.rate import RttEstimator
+
+logger = logging.getLogger(__name__)
+
+# timeouts in seconds until there are measured connections, and limits of measured ones
+CONNECT_TIMEOUT = 5.0
+MIN_CONNECT_TIMEOUT = 1.0
+MAX_CONNECT_TIMEOUT = 15.0
+HANDSHAKE_TIMEOUT = 10.0
+MIN_HANDSHAKE_TIMEOUT = 2.0
+MAX_HANDSHAKE_TIMEOUT = 30.0
+# a peer which failed gets longer timeouts: twice as long for each failure, this many times at most
+MAX_TIMEOUT_BACKOFF = 3
+
+
+def _adaptive_timeout(estimator: RttEstimator, default: float, min_value: float, max_value: float,
+                      fails: int) -> float:
+	timeout = estimator.timeout if estimator.samples else default
+	timeout *= 2 ** min(fails, MAX_TIMEOUT_BACKOFF)
+	return max(min_value, min(timeout, max_value))
+
+
+class Connector:
+	# outgoing connections. limits connections in progress and new ones per second,
+	# so a big peer list doesn't flood the NAT table. timeouts follow the times of successful connections
+	def __init__(self, metrics: Metrics, max_half_open: int, connect_rate: float):
+		self.max_half_open: int = max(max_half_open, 1)
+		# new connections per second. 0 means no limit
+		self.connect_rate: float = max(connect_rate, 0)
+		self._tokens: float = self.connect_rate
+		self._time: float = time.monotonic()
+
+		# hosts with a connection in progress
+		self.connecting: Set[str] = set()
+
+		self._connect_rtt: RttEstimator = RttEstimator()
+		self._handshake_rtt: RttEstimator = RttEstimator()
+
+		self._metrics: Metrics = metrics
+		self._half_open = metrics.gauge("yap_torrent_peers_half_open", "Outgoing connections in progress")
+		self._connect_time = metrics.histogram("yap_torrent_connect_seconds", "TCP connect time to peers")
+		self._handshake_time = metrics.histogram("yap_torrent_handshake_seconds", "Handshake time of outgoing connections")
+
+	def connect_timeout(self, fails: int = 0) -> float:
+		return _adaptive_timeout(self._connect_rtt, CONNECT_TIMEOUT, MIN_CONNECT_TIMEOUT, MAX_CONNECT_TIMEOUT, fails)
+
+	def handshake_timeout(self, fails: int = 0) -> float:
+		return _adaptive_timeout(
+			self._handshake_rtt, HANDSHAKE_TIMEOUT, MIN_HANDSHAKE_TIMEOUT, MAX_HANDSHAKE_TIMEOUT, fails)
+
+	def can_connect(self) -> bool:
+		if len(self.connecting) >= self.max_half_open:
+			return False
+		if not self.connect_rate:
+			return True
+
+		now = time.monotonic()
+		self._tokens = min(self._tokens + (now - self._time) * self.connect_rate, max(self.connect_rate, 1))
+		self._time = now
+		return self._tokens >= 1
+
+	def reserve(self, host: str) -> None:
+		# takes a half-open slot and a connect at once. connect() runs later, in a task
+		self._tokens -= 1
+		self.connecting.add(host)
+		self._half_open.set(len(self.connecting))
+
+	async def connect(self, peer_info: PeerInfo, info_hash: bytes, local_peer_id: bytes, reserved: bytes,
+	                  fails: int = 0) -> Optional[Tuple[bytes, StreamReader, StreamWriter, bytes]]:
+		# the host is reserved already
+		trace = net.ConnectTrace()
+		try:
+			result = await net.connect(
+				peer_info, info_hash, local_peer_id, self.connect_timeout(fails), reserved,
+				handshake_timeout=self.handshake_timeout(fails), trace=trace)
+		finally:
+			self.connecting.discard(peer_info.host)
+			self._half_open.set(len(self.connecting))
+
+		# failed connections don't tell how long a good one takes
+		if trace.connect_time:
+			self._connect_rtt.add(trace.connect_time)
+			self._connect_time.add(trace.connect_time)
+		if result:
+			self._handshake_rtt.add(trace.handshake_time)
+			self._handshake_time.add(trace.handshake_time)
+
+		self._metrics.counter(
+			"yap_torrent_connects_total", "Outgoing connection attempts", result=trace.failure or "success").inc()
+		return result
@@ -2,9 +2,18 @@ import asyncio
 from typing import Optional
 
 from angelovich.core.DataStorage import DataStorage
-from angelovich.core.Dispatcher import Dispatcher
 
+from yap_torrent.bandwidth import Bandwidth
+
+from yap_torrent.components.peer_ec import PeerConnectionEC
+from yap_torrent.components.piece_ec import PieceEC
 from yap_torrent.config import Config
+from yap_torrent.index import EntityIndex
+from yap_torrent.metrics import Metrics
+from yap_torrent.profiler import Profiler, ProfiledDispatcher
+from yap_torrent.scheduler import Scheduler
+from yap_torrent.storage import Storage, create_storage
+from yap_torrent.watchdog import LoopWatchdog
 
 
 class Env:
@@ -14,5 +23,17 @@ class Env:
 		self.external_ip: str = external_ip
 		self.config: Config = cfg
 		self.data_storage: DataStorage = DataStorage()
-		self.event_bus = Dispatcher()
+		self.metrics: Metrics = Metrics()
+
+		# info hash -> connected peers and cached pieces of the torrent
+		self.peers_index: EntityIndex[PeerConnectionEC] = EntityIndex(
+			self.data_storage, PeerConnectionEC, lambda c: c.info_hash)
+		self.pieces_index: EntityIndex[PieceEC] = EntityIndex(self.data_storage, PieceEC, lambda c: c.info_hash)
+
+		self.profiler: Profiler = Profiler(cfg.profiler_enabled)
+		self.event_bus = ProfiledDispatcher(self.profiler)
+		self.storage: Storage = create_storage(cfg)
+		self.scheduler: Scheduler = Scheduler()
+		self.bandwidth: Bandwidth = Bandwidth(cfg.download_rate_limit, cfg.upload_rate_limit)
 		self.close_event: Optional[asyncio.Event] = None
+		self.watchdog: Optional[LoopWatchdog] = None
@@ -0,0 +1,57 @@
+from typing import Dict, Hashable, Callable, Type, List, TypeVar, Generic
+
+from angelovich.core.DataStorage import DataStorage, Entity, EntityComponent
+
+T = TypeVar("T", bound=EntityComponent)
+
+
+class EntityIndex(Generic[T]):
+	# entities of a collection grouped by a key of their component. kept up to date by the collection events
+	def __init__(self, ds: DataStorage, component_type: Type[T], key: Callable[[T], Hashable]):
+		self._component_type = component_type
+		self._key = key
+
+		# key -> entities in the order they were added
+		self._groups: Dict[Hashable, Dict[int, Entity]] = {}
+		# entity -> key. the component could be reset before the remove event
+		self._keys: Dict[int, Hashable] = {}
+
+		collection = ds.get_collection(component_type)
+		collection.add_listener(collection.EVENT_ADDED, self.__on_added, self)
+		collection.add_listener(collection.EVENT_REMOVED, self.__on_removed, self)
+		for entity in collection.entities:
+			self._add(entity, entity.get_component(component_type))
+
+	def get(self, key: Hashable) -> List[Entity]:
+		# a copy. callers await while iterating and the group can change in the meantime
+		group = self._groups.get(key)
+		if not group:
+			return []
+		# events could be delivered later than the change. skip entities which are gone already
+		return [e for e in group.values() if e.is_valid() and e.has_component(self._component_type)]
+
+	def keys(self) -> List[Hashable]:
+		return list(self._groups.keys())
+
+	async def __on_added(self, entity: Entity, component: T):
+		self._add(entity, component)
+
+	async def __on_removed(self, entity: Entity, _: T):
+		self._remove(entity)
+
+	def _add(self, entity: Entity, component: T):
+		# the component was replaced. move the entity to the new key
+		self._remove(entity)
+
+		key = self._key(component)
+		self._keys[id(entity)] = key
+		self._groups.setdefault(key, {})[id(entity)] = entity
+
+	def _remove(self, entity: Entity):
+		key = self._keys.pop(id(entity), None)
+		if key is None:
+			return
+		group = self._groups[key]
+		group.pop(id(entity), None)
+		if not group:
+			del self._groups[key]
@@ -0,0 +1,93 @@
+from typing import Dict, Tuple, Callable, Optional, Iterator, List
+
+from yap_torrent.profiler import Histogram
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Counter:
+	__slots__ = ("value",)
+
+	def __init__(self):
+		self.value: float = 0
+
+	def inc(self, amount: float = 1) -> None:
+		self.value += amount
+
+
+class Gauge:
+	__slots__ = ("value",)
+
+	def __init__(self):
+		self.value: float = 0
+
+	def inc(self, amount: float = 1) -> None:
+		self.value += amount
+
+	def dec(self, amount: float = 1) -> None:
+		self.value -= amount
+
+	def set(self, value: float) -> None:
+		self.value = value
+
+
+class _Family:
+	def __init__(self, name: str, kind: str, description: str):
+		self.name = name
+		self.kind = kind
+		self.description = description
+		self.series: Dict[Labels, Counter | Gauge | Histogram] = {}
+		# a value which is cheap to get when asked. the length of a collection for example
+		self.callback: Optional[Callable[[], float]] = None
+
+
+class Metrics:
+	# counters are updated where things happen. exporters only read them
+	def __init__(self):
+		self._families: Dict[str, _Family] = {}
+
+	def counter(self, name: str, description: str, **labels: str) -> Counter:
+		return self._get(name, COUNTER, description, labels, Counter)
+
+	def gauge(self, name: str, description: str, **labels: str) -> Gauge:
+		return self._get(name, GAUGE, description, labels, Gauge)
+
+	def histogram(self, name: str, description: str, **labels: str) -> Histogram:
+		return self._get(name, HISTOGRAM, description, labels, Histogram)
+
+	def gauge_callback(self, name: str, description: str, callback: Callable[[], float]) -> None:
+		self._get_family(name, GAUGE, description).callback = callback
+
+	def remove(self, **labels: str) -> None:
+		# drop series with all these labels. a removed torrent for example
+		items = set(labels.items())
+		for family in self._families.values():
+			for key in [k for k in family.series if items.issubset(k)]:
+				del family.series[key]
+
+	def collect(self) -> Iterator[Tuple[str, str, str, List[Tuple[Dict[str, str], Counter | Gauge | Histogram | float]]]]:
+		for family in self._families.values():
+			series = [(dict(key), value) for key, value in family.series.items()]
+			if family.callback:
+				series.append(({}, family.callback()))
+			yield family.name, family.kind, family.description, series
+
+	def _get_family(self, name: str, kind: str, description: str) -> _Family:
+		family = self._families.get(name)
+		if family is None:
+			family = self._families[name] = _Family(name, kind, description)
+		elif family.kind != kind:
+			raise ValueError(f"Metric {name} is a {family.kind}, not a {kind}")
+		return family
+
+	def _get(self, name: str, kind: str, description: str, labels: Dict[str, str], factory):
+		family = self._get_family(name, kind, description)
+		key: Labels = tuple(sorted(labels.items()))
+		value = family.series.get(key)
+		if value is None:
+			value = family.series[key] = factory()
+		return value
@@ -0,0 +1,167 @@
+import inspect
+import json
+import time
+from typing import Dict, List, Any, Callable, Coroutine
+
+from angelovich.core.Dispatcher import Dispatcher
+
+
+class Histogram:
+	# log2 buckets. the first one is everything below min_value, the last one is everything above the rest
+	def __init__(self, min_value: float = 1e-5, buckets_num: int = 24):
+		self.min_value = min_value
+		self.buckets: List[int] = [0] * buckets_num
+		self.count: int = 0
+		self.total: float = 0
+		self.max: float = 0
+
+	def add(self, value: float) -> None:
+		self.count += 1
+		self.total += value
+		if value > self.max:
+			self.max = value
+
+		index = 0
+		bound = self.min_value
+		last = len(self.buckets) - 1
+		while value >= bound and index < last:
+			bound *= 2
+			index += 1
+		self.buckets[index] += 1
+
+	def upper_bound(self, index: int) -> float:
+		return self.min_value * 2 ** index
+
+	def percentile(self, p: float) -> float:
+		# upper bound of the bucket the value falls in
+		if not self.count:
+			return 0
+		rank = p * self.count
+		seen = 0
+		for index, value in enumerate(self.buckets):
+			seen += value
+			if seen >= rank:
+				return min(self.upper_bound(index), self.max)
+		return self.max
+
+	@property
+	def average(self) -> float:
+		return self.total / self.count if self.count else 0
+
+	def to_dict(self) -> Dict[str, Any]:
+		return {
+			"count": self.count,
+			"total": self.total,
+			"max": self.max,
+			"p50": self.percentile(0.5),
+			"p99": self.percentile(0.99),
+			# upper bound -> number of values. empty buckets are skipped
+			"buckets": {f"{self.upper_bound(i):g}": v for i, v in enumerate(self.buckets) if v},
+		}
+
+
+class Profiler:
+	# time spent in system updates and event listeners, events and tasks counts
+	def __init__(self, enabled: bool = False):
+		self.enabled: bool = enabled
+		self.started: float = time.monotonic()
+
+		self.updates: Dict[str, Histogram] = {}
+		self.events: Dict[str, Histogram] = {}
+		self.listeners: Dict[str, Histogram] = {}
+		self.tasks: Dict[str, int] = {}
+
+	def enable(self) -> None:
+		if not self.enabled:
+			self.reset()
+		self.enabled = True
+
+	def disable(self) -> None:
+		self.enabled = False
+
+	def reset(self) -> None:
+		self.started = time.monotonic()
+		self.updates.clear()
+		self.events.clear()
+		self.listeners.clear()
+		self.tasks.clear()
+
+	def add_update(self, system: str, duration: float) -> None:
+		_get_histogram(self.updates, system).add(duration)
+
+	def add_listener_call(self, event: str, listener: str, duration: float) -> None:
+		_get_histogram(self.events, event).add(duration)
+		_get_histogram(self.listeners, f"{event} {listener}").add(duration)
+
+	def add_task(self, system: str) -> None:
+		self.tasks[system] = self.tasks.get(system, 0) + 1
+
+	def dump(self) -> Dict[str, Any]:
+		return {
+			"enabled": self.enabled,
+			"duration": time.monotonic() - self.started,
+			"updates": {k: v.to_dict() for k, v in self.updates.items()},
+			"events": {k: v.to_dict() for k, v in self.events.items()},
+			"listeners": {k: v.to_dict() for k, v in self.listeners.items()},
+			"tasks": dict(self.tasks),
+		}
+
+	def dump_json(self) -> str:
+		return json.dumps(self.dump(), indent=2)
+
+	def dump_text(self) -> str:
+		lines = [f"Profile for {time.monotonic() - self.started:.1f} s"]
+		for title, histograms in (("update", self.updates), ("event", self.events), ("listener", self.listeners)):
+			if not histograms:
+				continue
+			lines.append("")
+			lines.append(f"{title:<60} {'count':>8} {'total ms':>10} {'avg ms':>8} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+			# the most expensive first
+			for name, h in sorted(histograms.items(), key=lambda x: x[1].total, reverse=True):
+				lines.append(
+					f"{name:<60} {h.count:>8} {h.total * 1000:>10.1f} {h.average * 1000:>8.2f} "
+					f"{h.percentile(0.5) * 1000:>8.2f} {h.percentile(0.99) * 1000:>8.2f} {h.max * 1000:>8.2f}")
+
+		if self.tasks:
+			lines.append("")
+			lines.append(f"{'tasks':<60} {'count':>8}")
+			for name, count in sorted(self.tasks.items(), key=lambda x: x[1], reverse=True):
+				lines.append(f"{name:<60} {count:>8}")
+		return "\n".join(lines)
+
+
+def _get_histogram(histograms: Dict[str, Histogram], name: str) -> Histogram:
+	histogram = histograms.get(name)
+	if histogram is None:
+		histogram = histograms[name] = Histogram()
+	return histogram
+
+
+async def _call(callback: Callable, args, kwargs) -> Any:
+	result = callback(*args, **kwargs)
+	if inspect.isawaitable(result):
+		result = await result
+	return result
+
+
+class ProfiledDispatcher(Dispatcher):
+	# listeners are wrapped when added. the wrapper checks the switch on every call
+	def __init__(self, profiler: Profiler):
+		super().__init__()
+		self._profiler = profiler
+
+	def add_listener(self, name: str, callback: Callable[..., Coroutine | None], scope=None):
+		profiler = self._profiler
+		listener = getattr(callback, "__qualname__", repr(callback))
+
+		async def profiled(*args, **kwargs):
+			if not profiler.enabled:
+				return await _call(callback, args, kwargs)
+
+			start = time.perf_counter()
+			try:
+				return await _call(callback, args, kwargs)
+			finally:
+				profiler.add_listener_call(name, listener, time.perf_counter() - start)
+
+		return super().add_listener(name, profiled, scope)
@@ -45,6 +45,12 @@ def payload_request(message: Message) -> tuple[int, int, int]:
 	raise RuntimeError("wrong message type for request property")
 
 
+def payload_cancel(message: Message) -> tuple[int, int, int]:
+	if message.message_id == MessageId.CANCEL.value:
+		return struct.unpack(f"!III", message.payload)
+	raise RuntimeError("wrong message type for cancel property")
+
+
 def choke() -> bytes:
 	return struct.pack('!B', MessageId.CHOKE.value)
 
@@ -77,5 +83,10 @@ def piece(piece_index: int, begin: int, block: bytes) -> bytes:
 	return struct.pack(f'!BII{len(block)}s', MessageId.PIECE.value, piece_index, begin, block)
 
 
+def piece_header(piece_index: int, begin: int) -> bytes:
+	# PIECE message without a block. The block is sent right after it
+	return struct.pack('!BII', MessageId.PIECE.value, piece_index, begin)
+
+
 def cancel(piece_index: int, begin: int, length: int) -> bytes:
 	return struct.pack('!BIII', MessageId.CANCEL.value, piece_index, begin, length)
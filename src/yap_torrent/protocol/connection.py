@@ -2,10 +2,11 @@
 
 import asyncio
 import logging
+import os
 import struct
 import time
 from asyncio import StreamReader, StreamWriter, IncompleteReadError
-from typing import Tuple, Optional
+from typing import Tuple, Optional, Callable, Awaitable, BinaryIO
 
 from .message import Message
 from .structures import PeerInfo
@@ -14,6 +15,8 @@ logger = logging.getLogger(__name__)
 
 PSTR_V1 = b'BitTorrent protocol'
 
+_HAS_SENDFILE = hasattr(os, "sendfile")
+
 
 def __create_handshake_message(info_hash: bytes, peer_id: bytes, reserved=bytes(8)):
 	# Handshake
@@ -41,49 +44,71 @@ async def __read_handshake_message(reader: StreamReader) -> Tuple[bytes, bytes,
 	return pstrlen, pstr, reserved, info_hash, peer_id
 
 
+class ConnectTrace:
+	# what happened to an outgoing connection. filled by connect()
+	__slots__ = ("connect_time", "handshake_time", "failure")
+
+	def __init__(self):
+		self.connect_time: float = 0
+		self.handshake_time: float = 0
+		# None on success
+		self.failure: Optional[str] = None
+
+
 async def connect(peer_info: PeerInfo, info_hash: bytes, local_peer_id: bytes, timeout: float = 1.0,
                   reserved: bytes = bytes(8), local_addr: Optional[Tuple[str, int]] = None,
                   # ('127.0.0.1', 9999)
+                  handshake_timeout: Optional[float] = None,
+                  trace: Optional[ConnectTrace] = None,
                   ) -> Optional[Tuple[bytes, StreamReader, StreamWriter, bytes]]:
 	logger.debug("try connect to %s", peer_info)
 	assert len(reserved) == 8
 	assert len(info_hash) == 20
+	trace = trace or ConnectTrace()
+	start_time = time.monotonic()
 	try:
 		async with asyncio.timeout(timeout):
 			reader, writer = await asyncio.open_connection(peer_info.host, peer_info.port, local_addr=local_addr)
 	except TimeoutError:
 		logger.debug("Connection to %s failed by timeout", peer_info)
+		trace.failure = "timeout"
 		return None
 	except ConnectionRefusedError as ex:
 		logger.debug("Connection to %s Refused. %s", peer_info, ex)
+		trace.failure = "refused"
 		return None
 	except Exception as ex:
 		logger.error("TODO: Connection to %s failed by %s", peer_info, ex)
+		trace.failure = "error"
 		return None
+	trace.connect_time = time.monotonic() - start_time
 
 	message = __create_handshake_message(info_hash, local_peer_id, reserved)
 	logger.debug("Send handshake to: %s, message: %s", peer_info, message)
 
-	writer.write(message)
-	await writer.drain()
+	start_time = time.monotonic()
 	try:
-		async with asyncio.timeout(timeout):
+		async with asyncio.timeout(timeout if handshake_timeout is None else handshake_timeout):
+			writer.write(message)
+			await writer.drain()
 			handshake_response = await __read_handshake_message(reader)
 	except TimeoutError:
 		logger.debug("Handshake to %s failed by timeout", peer_info)
-		return None
+		trace.failure = "handshake_timeout"
 	except IncompleteReadError:
 		logger.debug("Peer %s closed the connection.", peer_info)
-		return None
+		trace.failure = "closed"
 	except OSError as ex:
 		# looks like simple connectin lost.
 		logger.debug("OSError on %s. Exception %s", peer_info, ex)
-		return None
+		trace.failure = "closed"
 	except Exception as ex:
 		logger.error("Unexpected: Handshake to %s failed by %s", peer_info, ex)
+		trace.failure = "error"
+	if trace.failure:
+		writer.close()
 		return None
-	# finally:
-	# 	writer.close()
+	trace.handshake_time = time.monotonic() - start_time
 
 	pstrlen, pstr, reserved, remote_info_hash, remote_peer_id = handshake_response
 	logger.debug("Received handshake from: %s %s, message: %s", remote_peer_id, peer_info, handshake_response)
@@ -92,16 +117,11 @@ async def connect(peer_info: PeerInfo, info_hash: bytes, local_peer_id: bytes, t
 	return remote_peer_id, reader, writer, reserved
 
 
-async def on_connect(
-		local_peer_id: bytes,
-		reader: StreamReader,
-		writer: StreamWriter,
-		reserved: bytes = bytes(8),
-		timeout: float = 1.0,
-):
+async def read_handshake(reader: StreamReader, timeout: float = 1.0) -> Optional[Tuple[bytes, bytes, bytes, bytes, bytes]]:
+	# the first half of an incoming connection. nothing is sent, the caller decides whether to answer
 	try:
 		async with asyncio.timeout(timeout):
-			pstrlen, pstr, remote_reserved, info_hash, remote_peer_id = await __read_handshake_message(reader)
+			return await __read_handshake_message(reader)
 	except TimeoutError:
 		logger.debug("Incoming handshake timeout error")
 		return None
@@ -114,9 +134,10 @@ async def on_connect(
 	except Exception as ex:
 		logger.error("Incoming handshake unexpected error %s", ex)
 		return None
-	# finally:
-	# 	writer.close()
 
+
+async def send_handshake(writer: StreamWriter, info_hash: bytes, local_peer_id: bytes, remote_peer_id: bytes,
+                         reserved: bytes = bytes(8)) -> bool:
 	try:
 		message = __create_handshake_message(info_hash, local_peer_id, reserved)
 		logger.debug("Send handshake back to: %s, message: %s", remote_peer_id, message)
@@ -124,11 +145,25 @@ async def on_connect(
 		await writer.drain()
 	except Exception as ex:
 		logger.error("Handshake to %s failed by %s", remote_peer_id, ex)
+		return False
+	return True
+
+
+async def on_connect(
+		local_peer_id: bytes,
+		reader: StreamReader,
+		writer: StreamWriter,
+		reserved: bytes = bytes(8),
+		timeout: float = 1.0,
+):
+	result = await read_handshake(reader, timeout)
+	if result is None:
 		return None
-	# finally:
-	# 	writer.close()
 
-	return pstrlen, pstr, remote_reserved, info_hash, remote_peer_id
+	pstrlen, pstr, remote_reserved, info_hash, remote_peer_id = result
+	if not await send_handshake(writer, info_hash, local_peer_id, remote_peer_id, reserved):
+		return None
+	return result
 
 
 class Connection:
@@ -145,6 +180,14 @@ class Connection:
 		self.reader: StreamReader = reader
 		self.writer: StreamWriter = writer
 
+		# waits for the download bandwidth before a message is read
+		self.read_throttle: Optional[Callable[[int], Awaitable[None]]] = None
+
+		# the transport refuses other writes while a file is sent
+		self._file_lock = asyncio.Lock()
+		# False after the transport turned sendfile down. TLS or an event loop without it
+		self._sendfile = True
+
 	def is_dead(self) -> bool:
 		is_timeout = time.monotonic() - self.last_message_time > self.timeout
 		return self.reader.at_eof() or self.writer.is_closing() or is_timeout
@@ -160,6 +203,8 @@ class Connection:
 			length = struct.unpack("!I", buffer)[0]
 
 			if length:
+				if self.read_throttle:
+					await self.read_throttle(length)
 				buffer = await self.reader.readexactly(length)
 				self.last_message_time = time.monotonic()
 				message_callback(Message(buffer))
@@ -187,8 +232,13 @@ class Connection:
 			return
 		await self.send(bytes())
 
-	async def send(self, message: bytes) -> None:
+	async def _wait_file(self) -> None:
+		if self._file_lock.locked():
+			async with self._file_lock:
+				pass
 
+	async def send(self, message: bytes) -> None:
+		await self._wait_file()
 		if self.writer.is_closing():
 			return
 
@@ -204,3 +254,77 @@ class Connection:
 			logger.debug("Connection lost %s", ex)
 		except Exception as ex:
 			logger.error("got send error on %s: %s", self.remote_peer_id, ex)
+
+	async def send_chunks(self, *chunks: bytes | memoryview) -> None:
+		# one message split into several buffers. they go to the transport as is, with no joining copy
+		await self._wait_file()
+		if self.writer.is_closing():
+			return
+
+		logger.debug("send %s message to %s", Message(bytes(chunks[0])), self.remote_peer_id)
+		try:
+			self.last_out_time = time.monotonic()
+			self.writer.write(struct.pack("!I", sum(len(chunk) for chunk in chunks)))
+			for chunk in chunks:
+				self.writer.write(chunk)
+			await self.writer.drain()
+		except ConnectionResetError as ex:
+			logger.debug("Connection lost %s", ex)
+		except ConnectionAbortedError as ex:
+			logger.debug("Connection lost %s", ex)
+		except Exception as ex:
+			logger.error("got send error on %s: %s", self.remote_peer_id, ex)
+
+	def _sendfile_now(self, file: BinaryIO, offset: int, count: int) -> int:
+		# straight to the raw socket while the transport has nothing buffered. no loop iteration per block
+		transport = self.writer.transport
+		if not _HAS_SENDFILE or transport.get_write_buffer_size() or transport.get_extra_info("sslcontext"):
+			return 0
+		sock = transport.get_extra_info("socket")
+		if sock is None:
+			return 0
+		try:
+			return os.sendfile(sock.fileno(), file.fileno(), offset, count)
+		except (BlockingIOError, InterruptedError):
+			return 0
+
+	async def send_file(self, header: bytes, file: BinaryIO, offset: int, count: int) -> None:
+		# the message header goes through the transport, the data goes from the file to the socket with os.sendfile
+		async with self._file_lock:
+			if self.writer.is_closing():
+				return
+
+			logger.debug("send %s message from file to %s", Message(header), self.remote_peer_id)
+			try:
+				self.last_out_time = time.monotonic()
+				self.writer.write(struct.pack("!I", len(header) + count))
+				self.writer.write(header)
+
+				sent = 0
+				if self._sendfile:
+					sent = self._sendfile_now(file, offset, count)
+				if self._sendfile and sent < count:
+					# waits until the socket can take the rest
+					loop = asyncio.get_running_loop()
+					try:
+						sent += await loop.sendfile(
+							self.writer.transport, file, offset + sent, count - sent, fallback=False)
+					except asyncio.SendfileNotAvailableError as ex:
+						logger.debug("sendfile is not available for %s: %s", self.remote_peer_id, ex)
+						self._sendfile = False
+
+				if sent < count:
+					# the header is sent already. the rest of the block goes the usual way
+					data = os.pread(file.fileno(), count - sent, offset + sent)
+					if len(data) < count - sent:
+						raise EOFError(f"block at {offset} is out of file")
+					self.writer.write(data)
+					await self.writer.drain()
+			except ConnectionResetError as ex:
+				logger.debug("Connection lost %s", ex)
+			except ConnectionAbortedError as ex:
+				logger.debug("Connection lost %s", ex)
+			except Exception as ex:
+				# the message is broken. the peer can't read the stream anymore
+				logger.error("got send error on %s: %s", self.remote_peer_id, ex)
+				self.close()
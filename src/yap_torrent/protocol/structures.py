@@ -1,10 +1,12 @@
+import bisect
 import hashlib
 import math
+from array import array
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Generator, Tuple, Dict, Any, Iterable, Set
+from typing import List, Generator, Tuple, Dict, Any, Iterable, Set, Optional
 
-from yap_torrent.protocol import encode
+from yap_torrent.protocol.parser import encode, decode
 
 
 def _block_size():
@@ -65,12 +67,95 @@ class FileInfo:
 		return FileInfo(path, data.get("length", 0), data.get("md5sum", b''), start)
 
 
-@dataclass(frozen=True, slots=True)
+def _pieces_view(metadata: bytes, pieces: bytes) -> memoryview:
+	# piece hashes are a part of the metadata. look them up there instead of keeping a copy
+	view = memoryview(metadata)
+	key = b"6:pieces" + str(len(pieces)).encode() + b":"
+	offset = metadata.find(key)
+	while offset >= 0:
+		start = offset + len(key)
+		if view[start:start + len(pieces)] == pieces:
+			return view[start:start + len(pieces)]
+		offset = metadata.find(key, offset + 1)
+	return memoryview(bytes(pieces))
+
+
 class TorrentInfo:
-	_data: Dict[str, Any]
+	# the info dictionary in a compact form. file columns are arrays, path parts are interned,
+	# piece hashes are a view of the metadata bytes
+	__slots__ = ("_metadata", "_pieces", "_raw_name", "_piece_length", "_multi_file", "_size",
+	             "_lengths", "_starts", "_path_table", "_path_ids", "_path_offsets", "_md5sums")
+
+	def __init__(self, data: Dict[str, Any], metadata: Optional[bytes] = None):
+		self._build(data, encode(data) if metadata is None else metadata)
+
+	@classmethod
+	def from_metadata(cls, metadata: bytes) -> "TorrentInfo":
+		return cls(decode(metadata), metadata)
+
+	def _build(self, data: Dict[str, Any], metadata: bytes) -> None:
+		self._metadata: bytes = metadata
+		self._pieces: memoryview = _pieces_view(metadata, data.get('pieces', b""))
+
+		# name.utf-8 is not in BEP-03. But uses widely
+		self._raw_name: bytes = data.get('name.utf-8', data.get("name", b''))
+		self._piece_length: int = data.get('piece length', 0)
+
+		self._multi_file: bool = 'files' in data
+		if self._multi_file:
+			files_field = data["files"]
+		else:
+			files_field = [{"length": data.get("length", 0), "path": [self._raw_name], "md5sum": data.get("md5sum", b'')}]
+
+		self._lengths = array('q')
+		self._starts = array('q')
+		self._path_ids = array('i')
+		self._path_offsets = array('q', [0])
+		self._md5sums: Dict[int, bytes] = {}
+		path_table: Dict[bytes, int] = {}
+
+		start = 0
+		for i, file_dict in enumerate(files_field):
+			length = file_dict.get("length", 0)
+			self._lengths.append(length)
+			self._starts.append(start)
+			start += length
+
+			# path.utf-8 is not in BEP-03. But uses widely
+			for part in file_dict.get("path.utf-8", file_dict.get("path", [])):
+				self._path_ids.append(path_table.setdefault(part, len(path_table)))
+			self._path_offsets.append(len(self._path_ids))
+
+			md5sum = file_dict.get("md5sum")
+			if md5sum:
+				self._md5sums[i] = md5sum
+
+		self._size: int = start
+		self._path_table: Tuple[bytes, ...] = tuple(path_table)
+
+	def __getstate__(self) -> bytes:
+		return self._metadata
+
+	def __setstate__(self, state) -> None:
+		if isinstance(state, bytes):
+			self._build(decode(state), state)
+			return
+
+		# pickles of the dict based dataclass: [data] or (None, {"_data": data})
+		data = state[1]["_data"] if isinstance(state, tuple) else state[0]
+		self._build(data, encode(data))
+
+	def __eq__(self, other) -> bool:
+		return isinstance(other, TorrentInfo) and self._metadata == other._metadata
+
+	def __hash__(self) -> int:
+		return hash(self._metadata)
+
+	def __repr__(self) -> str:
+		return f"TorrentInfo({self.name}, {self.files_num} files, {self.pieces_num} pieces)"
 
 	def get_metadata(self) -> bytes:
-		return encode(self._data)
+		return self._metadata
 
 	@property
 	def name(self) -> str:
@@ -78,34 +163,31 @@ class TorrentInfo:
 
 	@property
 	def raw_name(self) -> bytes:
-		# name.utf-8 is not in BEP-03. But uses widely
-		return self._data.get('name.utf-8', self._data.get("name", b''))
+		return self._raw_name
 
-	@staticmethod
-	def __files_generator(files_field: List[dict]):
-		start = 0
-		for file_dict in files_field:
-			info = FileInfo.from_dict(file_dict, start)
-			yield info
-			start += info.length
+	@property
+	def files_num(self) -> int:
+		return len(self._lengths)
+
+	def get_file(self, i: int) -> FileInfo:
+		path_table = self._path_table
+		path = [path_table[part] for part in self._path_ids[self._path_offsets[i]:self._path_offsets[i + 1]]]
+		return FileInfo(path, self._lengths[i], self._md5sums.get(i, b''), self._starts[i])
 
 	@property
 	def files(self) -> Iterable[FileInfo]:
-		if 'files' in self._data:
-			return tuple(self.__files_generator(self._data["files"]))
-		else:
-			return (FileInfo([self.raw_name], self._data.get("length", 0), self._data.get("md5sum", b'')),)
+		return tuple(self.get_file(i) for i in range(self.files_num))
 
 	def get_file_path(self, root: Path, file: FileInfo) -> Path:
 		# add folder for multifile protocol
-		path = root.joinpath(self.name) if 'files' in self._data else root
+		path = root.joinpath(self.name) if self._multi_file else root
 		for file_path in file.path:
 			path = path.joinpath(file_path.decode("utf-8"))
 		return path
 
 	@property
 	def size(self) -> int:
-		return sum(f.length for f in self.files)
+		return self._size
 
 	def calculate_downloaded(self, pieces_num: int):
 		downloaded = pieces_num * self.piece_length
@@ -115,21 +197,20 @@ class TorrentInfo:
 		downloaded = pieces_num * self.piece_length
 		return downloaded >= self.size
 
-	@property
-	def _pieces(self) -> bytes:
-		return self._data.get('pieces', b"")
-
 	@property
 	def piece_length(self) -> int:
-		return self._data.get('piece length', 0)
+		return self._piece_length
 
 	@property
 	def pieces_num(self) -> int:
 		# pieces: string consisting of the concatenation of all 20-byte SHA1 hash values, one per piece (byte string, i.e., not urlencoded)
-		return int(len(self._pieces) / 20)
+		return len(self._pieces) // 20
 
 	def get_piece_hash(self, index: int) -> bytes:
-		return self._pieces[index * 20:(index + 1) * 20]
+		return bytes(self._pieces[index * 20:(index + 1) * 20])
+
+	def get_pieces_hashes(self, first: int, last: int) -> bytes:
+		return bytes(self._pieces[first * 20:last * 20])
 
 	def get_piece_info(self, index: int) -> PieceInfo:
 		return PieceInfo(self.calculate_piece_size(index), index, self.get_piece_hash(index))
@@ -143,22 +224,24 @@ class TorrentInfo:
 			size = piece_length
 		return size
 
-	def piece_to_files(self, index: int) -> Generator[Tuple[FileInfo, int, int]]:
+	def file_to_pieces(self, file: FileInfo) -> range:
+		if not file.length:
+			return range(0)
 		piece_length = self.piece_length
-		piece_start = index * piece_length
-		piece_end = piece_start + self.calculate_piece_size(index)
-		for file in self.files:
-			file_end = file.start + file.length
-			if piece_start >= file_end:
-				continue
-			if file.start >= piece_end:
-				continue
+		return range(file.start // piece_length, (file.start + file.length - 1) // piece_length + 1)
 
-			start_pos = max(piece_start, file.start)
-			file_end = file.start + file.length
-			end_pos = min(piece_end, file_end)
+	def piece_to_files(self, index: int) -> Generator[Tuple[FileInfo, int, int]]:
+		piece_start = index * self.piece_length
+		piece_end = piece_start + self.calculate_piece_size(index)
 
-			yield file, start_pos, end_pos
+		# the last file starting before the piece
+		i = max(0, bisect.bisect_right(self._starts, piece_start) - 1)
+		while i < self.files_num and self._starts[i] < piece_end:
+			file_start = self._starts[i]
+			file_end = file_start + self._lengths[i]
+			if file_end > piece_start:
+				yield self.get_file(i), max(piece_start, file_start), min(piece_end, file_end)
+			i += 1
 
 
 @dataclass(frozen=True, slots=True)
@@ -267,6 +350,9 @@ class Bitfield:
 	def set_index(self, index: int):
 		self._have.add(index)
 
+	def remove_index(self, index: int):
+		self._have.discard(index)
+
 	def have_index(self, index: int) -> bool:
 		return index in self._have
 
@@ -276,6 +362,9 @@ class Bitfield:
 	def intersection(self, other: Set[int]) -> Set[int]:
 		return self._have.intersection(other)
 
+	def difference(self, other: Set[int]) -> Set[int]:
+		return self._have.difference(other)
+
 	@property
 	def have_num(self) -> int:
 		return len(self._have)
@@ -0,0 +1,75 @@
+import time
+from array import array
+from typing import Optional
+
+# seconds in a rate window
+RATE_WINDOW = 20
+
+
+class RateMeter:
+	# bytes per second over a sliding window of one second buckets. updates don't allocate
+	__slots__ = ("_buckets", "_window_total", "_second", "_start", "total")
+
+	def __init__(self, window: int = RATE_WINDOW):
+		self._buckets = array("q", [0]) * window
+		self._window_total: int = 0
+		self._start: float = time.monotonic()
+		self._second: int = int(self._start)
+		self.total: int = 0
+
+	def _advance(self, now: float) -> None:
+		second = int(now)
+		passed = second - self._second
+		if passed <= 0:
+			return
+
+		buckets = self._buckets
+		size = len(buckets)
+		if passed >= size:
+			for i in range(size):
+				buckets[i] = 0
+			self._window_total = 0
+		else:
+			# drop buckets which left the window
+			for s in range(self._second + 1, second + 1):
+				i = s % size
+				self._window_total -= buckets[i]
+				buckets[i] = 0
+		self._second = second
+
+	def add(self, amount: int, now: Optional[float] = None) -> None:
+		now = time.monotonic() if now is None else now
+		self._advance(now)
+		self._buckets[self._second % len(self._buckets)] += amount
+		self._window_total += amount
+		self.total += amount
+
+	def rate(self, now: Optional[float] = None) -> float:
+		now = time.monotonic() if now is None else now
+		self._advance(now)
+		# the current bucket is not full yet. a new meter has less history than the window
+		span = min(len(self._buckets) - 1 + now - self._second, now - self._start)
+		return self._window_total / max(span, 1.0)
+
+
+class RttEstimator:
+	# smoothed round trip time and its deviation, the way TCP does it (RFC 6298)
+	__slots__ = ("srtt", "rttvar", "samples")
+
+	def __init__(self):
+		self.srtt: float = 0
+		self.rttvar: float = 0
+		self.samples: int = 0
+
+	def add(self, rtt: float) -> None:
+		if not self.samples:
+			self.srtt = rtt
+			self.rttvar = rtt / 2
+		else:
+			self.rttvar += (abs(self.srtt - rtt) - self.rttvar) / 4
+			self.srtt += (rtt - self.srtt) / 8
+		self.samples += 1
+
+	@property
+	def timeout(self) -> float:
+		return self.srtt + 4 * self.rttvar
@@ -0,0 +1,251 @@
+import logging
+import os
+import pickle
+import re
+import threading
+from pathlib import Path
+from typing import Dict, Any, Optional, BinaryIO, Tuple, Set
+
+from yap_torrent.protocol import TorrentInfo
+from yap_torrent.protocol.structures import Bitfield
+
+logger = logging.getLogger(__name__)
+
+# delta kinds
+_VALUE = 0  # value
+_SET = 1  # added, removed
+_DICT = 2  # updated items
+
+_LEGACY_NAME = re.compile(r"[0-9a-f]{40}")
+
+
+def _make_delta(old: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, Tuple]:
+	delta: Dict[str, Tuple] = {}
+	for key, value in new.items():
+		old_value = old.get(key)
+		if value == old_value:
+			continue
+
+		if isinstance(value, set) and isinstance(old_value, set):
+			delta[key] = (_SET, value.difference(old_value), old_value.difference(value))
+		elif isinstance(value, dict) and isinstance(old_value, dict):
+			delta[key] = (_DICT, {k: v for k, v in value.items() if k not in old_value or old_value[k] != v})
+		else:
+			delta[key] = (_VALUE, value)
+	return delta
+
+
+def _apply_delta(state: Dict[str, Any], delta: Dict[str, Tuple]) -> None:
+	for key, (kind, *args) in delta.items():
+		if kind == _SET:
+			added, removed = args
+			value = state[key] = set(state.get(key, set()))
+			value.difference_update(removed)
+			value.update(added)
+		elif kind == _DICT:
+			value = state[key] = dict(state.get(key, {}))
+			value.update(args[0])
+		else:
+			state[key] = args[0]
+
+
+def pack_pieces(pieces: Set[int], length: int) -> bytes:
+	# pieces are kept as a bitfield. a bit per piece in memory and on disk
+	bitfield = Bitfield()
+	bitfield.reset(pieces)
+	return bitfield.dump(length)
+
+
+def unpack_pieces(data: bytes) -> Set[int]:
+	return Bitfield().update(data).difference(set())
+
+
+def _write_atomic(path: Path, data: bytes) -> None:
+	tmp_path = path.with_name(path.name + ".tmp")
+	with open(tmp_path, "wb") as f:
+		f.write(data)
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(tmp_path, path)
+
+
+class ResumeStore:
+	# torrent metadata is written once per info hash. pieces of a torrent go to a file of their own, read when
+	# the torrent is loaded. the rest of the state is a small index in an append-only journal of changes
+	# which is compacted into a snapshot from time to time
+	def __init__(self, path: Path, compact_size: int):
+		self._path = path
+		self._metadata_path = path.joinpath("metadata")
+		self._pieces_path = path.joinpath("pieces")
+		self._snapshot_path = path.joinpath("state")
+		self._journal_path = path.joinpath("journal")
+		self._compact_size = compact_size
+
+		# last saved state of every torrent. pieces are not here
+		self._states: Dict[bytes, Dict[str, Any]] = {}
+		self._journal: Optional[BinaryIO] = None
+		self._lock = threading.Lock()
+
+	def load(self) -> Dict[bytes, Dict[str, Any]]:
+		self._metadata_path.mkdir(parents=True, exist_ok=True)
+		self._pieces_path.mkdir(parents=True, exist_ok=True)
+
+		states: Dict[bytes, Dict[str, Any]] = {}
+		if self._snapshot_path.exists():
+			with open(self._snapshot_path, "rb") as f:
+				states = pickle.load(f)
+
+		if self._journal_path.exists():
+			with open(self._journal_path, "rb") as f:
+				while True:
+					try:
+						info_hash, delta = pickle.load(f)
+					except EOFError:
+						break
+					except Exception as ex:
+						# the last record could be written partially
+						logger.warning(f"Resume journal is broken at {f.tell()}: {ex}")
+						break
+
+					if delta is None:
+						states.pop(info_hash, None)
+					else:
+						_apply_delta(states.setdefault(info_hash, {}), delta)
+
+		legacy = self._load_legacy(states)
+
+		# older saves keep pieces in the state, as a set before that
+		for info_hash, state in states.items():
+			if "pieces" not in state:
+				continue
+			pieces = state.pop("pieces")
+			if isinstance(pieces, set):
+				pieces = pack_pieces(pieces, max(pieces) + 1 if pieces else 0)
+			self._save_pieces(info_hash, pieces)
+			# torrents with pieces have metadata. the name marks them in the index
+			state.setdefault("name", info_hash.hex())
+
+		self._states = states
+		self._compact()
+		for path in legacy:
+			os.remove(path)
+
+		# metadata is loaded later with load_metadata
+		return {info_hash: dict(state, info_hash=info_hash) for info_hash, state in states.items()}
+
+	def _load_legacy(self, states: Dict[bytes, Dict[str, Any]]) -> list[Path]:
+		# one pickle file per torrent with the whole torrent info inside
+		result = []
+		for path in self._path.iterdir():
+			if not path.is_file() or not _LEGACY_NAME.fullmatch(path.name):
+				continue
+			try:
+				with open(path, "rb") as f:
+					save_data: Dict[str, Any] = pickle.load(f)
+			except Exception as ex:
+				logger.warning(f"Can't load legacy save {path}: {ex}")
+				continue
+
+			logger.info(f"Migrate legacy save {path}")
+			info_hash = save_data.pop("info_hash")
+			torrent_info: Optional[TorrentInfo] = save_data.pop("torrent_info", None)
+			if torrent_info:
+				self._save_metadata(info_hash, torrent_info)
+			if "bitfield" in save_data:
+				save_data["pieces"] = save_data.pop("bitfield")
+			if "files_state" in save_data:
+				save_data["files_state"] = dict(enumerate(save_data["files_state"]))
+			states[info_hash] = save_data
+			result.append(path)
+		return result
+
+	def _get_metadata_path(self, info_hash: bytes) -> Path:
+		return self._metadata_path.joinpath(info_hash.hex())
+
+	def load_metadata(self, info_hash: bytes) -> Optional[TorrentInfo]:
+		path = self._get_metadata_path(info_hash)
+		if not path.exists():
+			return None
+		with open(path, "rb") as f:
+			return TorrentInfo.from_metadata(f.read())
+
+	def _save_metadata(self, info_hash: bytes, torrent_info: TorrentInfo) -> None:
+		path = self._get_metadata_path(info_hash)
+		if not path.exists():
+			_write_atomic(path, torrent_info.get_metadata())
+
+	def _get_pieces_path(self, info_hash: bytes) -> Path:
+		return self._pieces_path.joinpath(info_hash.hex())
+
+	def load_pieces(self, info_hash: bytes) -> Optional[bytes]:
+		path = self._get_pieces_path(info_hash)
+		if not path.exists():
+			return None
+		with open(path, "rb") as f:
+			return f.read()
+
+	def _save_pieces(self, info_hash: bytes, pieces: bytes) -> None:
+		if self.load_pieces(info_hash) != pieces:
+			_write_atomic(self._get_pieces_path(info_hash), pieces)
+
+	def get_state(self, info_hash: bytes) -> Dict[str, Any]:
+		with self._lock:
+			return self._states.get(info_hash, {})
+
+	def save(self, info_hash: bytes, data: Dict[str, Any]) -> None:
+		data = dict(data)
+		data.pop("info_hash", None)
+		torrent_info: Optional[TorrentInfo] = data.pop("torrent_info", None)
+		pieces: Optional[bytes] = data.pop("pieces", None)
+
+		with self._lock:
+			if torrent_info:
+				self._save_metadata(info_hash, torrent_info)
+			# before the files state in the journal. newer pieces with older files state are validated on load
+			if pieces is not None:
+				self._save_pieces(info_hash, pieces)
+
+			state = self._states.get(info_hash, {})
+			delta = _make_delta(state, data)
+			if not delta:
+				return
+
+			new_state = dict(state)
+			_apply_delta(new_state, delta)
+			self._states[info_hash] = new_state
+			self._append(info_hash, delta)
+
+	def remove(self, info_hash: bytes) -> None:
+		with self._lock:
+			if self._states.pop(info_hash, None) is not None:
+				self._append(info_hash, None)
+
+			for path in (self._get_metadata_path(info_hash), self._get_pieces_path(info_hash)):
+				if path.exists():
+					os.remove(path)
+
+	def _append(self, info_hash: bytes, delta: Optional[Dict[str, Tuple]]) -> None:
+		if not self._journal:
+			self._journal = open(self._journal_path, "ab")
+		pickle.dump((info_hash, delta), self._journal, pickle.DEFAULT_PROTOCOL)
+		self._journal.flush()
+
+		if self._journal.tell() > self._compact_size:
+			self._compact()
+
+	def _compact(self) -> None:
+		# write the snapshot first. replay of the old journal over the new snapshot gives the same state
+		logger.debug(f"Compact resume data: {len(self._states)} torrents")
+		_write_atomic(self._snapshot_path, pickle.dumps(self._states, pickle.DEFAULT_PROTOCOL))
+
+		if self._journal:
+			self._journal.close()
+		self._journal = open(self._journal_path, "wb")
+
+	def close(self) -> None:
+		with self._lock:
+			if not self._journal:
+				return
+			self._compact()
+			self._journal.close()
+			self._journal = None
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import time
+from asyncio import Task
+from typing import Callable, Awaitable, Any, Optional, Dict, List
+
+logger = logging.getLogger(__name__)
+
+# an update longer than this is reported
+SLOW_UPDATE_TIME = 0.5
+
+
+class TickStats:
+	# lag is the time between the planned and the actual start of a timer update
+	_SMOOTHING = 0.1
+
+	def __init__(self):
+		self.updates: int = 0
+		self.wakeups: int = 0
+		self.errors: int = 0
+
+		self.lag_avg: float = 0
+		self.lag_max: float = 0
+		self.duration_avg: float = 0
+		self.duration_max: float = 0
+
+	def add(self, lag: float, duration: float, woken: bool):
+		self.updates += 1
+		if woken:
+			self.wakeups += 1
+		else:
+			self.lag_avg += (lag - self.lag_avg) * self._SMOOTHING
+			self.lag_max = max(self.lag_max, lag)
+		self.duration_avg += (duration - self.duration_avg) * self._SMOOTHING
+		self.duration_max = max(self.duration_max, duration)
+
+	def __repr__(self):
+		return (f"updates {self.updates}, wakeups {self.wakeups}, errors {self.errors}, "
+		        f"lag {self.lag_avg * 1000:.1f}/{self.lag_max * 1000:.1f} ms, "
+		        f"duration {self.duration_avg * 1000:.1f}/{self.duration_max * 1000:.1f} ms")
+
+
+async def _run(name: str, update: Callable[[float], Awaitable[Any]], interval: float,
+               wake_event: Optional[asyncio.Event], stats: TickStats):
+	last_time = time.monotonic()
+	next_time = last_time + interval
+	while True:
+		# sleep until the next update or until someone wakes the job up
+		timeout = next_time - time.monotonic()
+		if timeout > 0:
+			if wake_event:
+				try:
+					await asyncio.wait_for(wake_event.wait(), timeout)
+				except TimeoutError:
+					pass
+			else:
+				await asyncio.sleep(timeout)
+
+		if wake_event:
+			wake_event.clear()
+
+		start_time = time.monotonic()
+		# woken up before the planned time
+		woken = start_time < next_time
+		lag = 0.0 if woken else start_time - next_time
+		delta_time = start_time - last_time
+		last_time = start_time
+
+		try:
+			await update(delta_time)
+		except asyncio.CancelledError:
+			raise
+		except Exception as ex:
+			stats.errors += 1
+			logger.error(f"unexpected exception on {name} update: {ex}", exc_info=True)
+
+		end_time = time.monotonic()
+		duration = end_time - start_time
+		stats.add(lag, duration, woken)
+		if duration > SLOW_UPDATE_TIME:
+			logger.debug(f"Slow update of {name}: {duration:.3f} s")
+
+		# wakeups don't move the timer. missed updates of a slow job are skipped, not piled up
+		if not woken:
+			next_time += interval
+			if next_time < end_time:
+				next_time = end_time + interval
+
+
+class Scheduler:
+	# every job runs in its own task with its own interval. a slow or failing job doesn't hold back the others
+	def __init__(self):
+		self.stats: Dict[str, TickStats] = {}
+		self._tasks: List[Task] = []
+
+	def add(self, name: str, update: Callable[[float], Awaitable[Any]], interval: float,
+	        wake_event: Optional[asyncio.Event] = None) -> None:
+		stats = self.stats[name] = TickStats()
+		self._tasks.append(asyncio.create_task(_run(name, update, interval, wake_event, stats)))
+
+	def report(self) -> str:
+		return "\n".join(f"{name}: {stats}" for name, stats in self.stats.items())
+
+	async def close(self) -> None:
+		for task in self._tasks:
+			task.cancel()
+		await asyncio.gather(*self._tasks, return_exceptions=True)
+		self._tasks.clear()
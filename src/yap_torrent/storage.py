@@ -0,0 +1,310 @@
+import hashlib
+import logging
+import mmap
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Set, Tuple, List, Any, Callable, BinaryIO
+
+from yap_torrent.config import Config
+from yap_torrent.protocol import TorrentInfo
+from yap_torrent.protocol.structures import FileInfo
+from yap_torrent.utils import load_piece, save_piece
+
+logger = logging.getLogger(__name__)
+
+# files kept open to send blocks from
+MAX_OPEN_FILES = 64
+
+
+def find_block_file(info: TorrentInfo, index: int, begin: int, length: int) -> Optional[Tuple[FileInfo, int]]:
+	# returns the file and the offset inside it in case the block doesn't span files
+	block_start = index * info.piece_length + begin
+	for file, start_pos, end_pos in info.piece_to_files(index):
+		if start_pos <= block_start and block_start + length <= end_pos:
+			return file, block_start - file.start
+	return None
+
+
+class Storage:
+	# False means there is nothing on disk to validate. check pieces with load_piece instead
+	on_disk: bool = True
+
+	def load_piece(self, root: Path, info: TorrentInfo, index: int) -> bytes:
+		raise NotImplementedError
+
+	def save_piece(self, root: Path, info: TorrentInfo, index: int, data: bytes) -> None:
+		raise NotImplementedError
+
+	def read_block(self, root: Path, info: TorrentInfo, index: int, begin: int, length: int) -> Optional[memoryview]:
+		# zero copy block access. None means the storage can't do it and the whole piece should be loaded
+		return None
+
+	def open_block(self, root: Path, info: TorrentInfo, index: int, begin: int,
+	               length: int) -> Optional[Tuple[BinaryIO, int]]:
+		# a file and the block offset in it to send the block with sendfile. None if the storage can't do it.
+		# the caller owns the file and closes it
+		return None
+
+	def flush(self, force: bool = False) -> None:
+		pass
+
+	def release(self, root: Path, info: TorrentInfo) -> None:
+		pass
+
+	def close(self) -> None:
+		pass
+
+
+class FileStorage(Storage):
+	def __init__(self):
+		# least recently used files at the start
+		self._files: OrderedDict[Path, BinaryIO] = OrderedDict()
+
+	def load_piece(self, root: Path, info: TorrentInfo, index: int) -> bytes:
+		return load_piece(root, info, index)
+
+	def save_piece(self, root: Path, info: TorrentInfo, index: int, data: bytes) -> None:
+		save_piece(root, info, index, data)
+
+	def open_block(self, root: Path, info: TorrentInfo, index: int, begin: int,
+	               length: int) -> Optional[Tuple[BinaryIO, int]]:
+		result = find_block_file(info, index, begin, length)
+		if not result:
+			return None
+
+		file, offset = result
+		path = info.get_file_path(root, file)
+		f = self._files.get(path)
+		if f is None:
+			try:
+				f = open(path, "rb")
+			except OSError as ex:
+				logger.debug(f"Can't open {path} to send blocks: {ex}")
+				return None
+			self._files[path] = f
+			if len(self._files) > MAX_OPEN_FILES:
+				self._files.popitem(last=False)[1].close()
+		else:
+			self._files.move_to_end(path)
+		# a transfer can wait for the socket a long time. a copy of the descriptor is not closed under it
+		# when the file leaves the cache
+		return open(os.dup(f.fileno()), "rb", buffering=0), offset
+
+	def release(self, root: Path, info: TorrentInfo) -> None:
+		for file in info.files:
+			f = self._files.pop(info.get_file_path(root, file), None)
+			if f is not None:
+				f.close()
+
+	def close(self) -> None:
+		for f in self._files.values():
+			f.close()
+		self._files.clear()
+
+
+class _BufferStorage(Storage):
+	# keeps a writable buffer per torrent file and works with slices of it
+	def __init__(self):
+		self._buffers: Dict[Path, mmap.mmap | bytearray] = {}
+
+		# pieces are saved from the executor while blocks are read on the event loop
+		self._lock = threading.Lock()
+
+	def _create_buffer(self, path: Path, length: int) -> mmap.mmap | bytearray:
+		raise NotImplementedError
+
+	def _get_buffer(self, path: Path, length: int, create: bool = True) -> Optional[mmap.mmap | bytearray]:
+		with self._lock:
+			buffer = self._buffers.get(path)
+			if buffer is None and create:
+				buffer = self._buffers[path] = self._create_buffer(path, length)
+			return buffer
+
+	def _on_saved(self, path: Path) -> None:
+		pass
+
+	def load_piece(self, root: Path, info: TorrentInfo, index: int) -> bytes:
+		piece_length = info.piece_length
+		data = bytearray(info.get_piece_info(index).size)
+		for file, start_pos, end_pos in info.piece_to_files(index):
+			length = end_pos - start_pos
+			if not length:
+				continue
+
+			offset = start_pos - file.start
+			read_from = start_pos % piece_length
+
+			buffer = self._get_buffer(info.get_file_path(root, file), file.length, create=False)
+			if buffer is not None:
+				data[read_from:read_from + length] = memoryview(buffer)[offset:offset + length]
+		return bytes(data)
+
+	def save_piece(self, root: Path, info: TorrentInfo, index: int, data: bytes) -> None:
+		piece_length = info.piece_length
+		view = memoryview(data)
+		for file, start_pos, end_pos in info.piece_to_files(index):
+			length = end_pos - start_pos
+			if not length:
+				continue
+
+			offset = start_pos - file.start
+			read_from = start_pos % piece_length
+
+			path = info.get_file_path(root, file)
+			buffer = self._get_buffer(path, file.length)
+			buffer[offset:offset + length] = view[read_from:read_from + length]
+			self._on_saved(path)
+
+	def read_block(self, root: Path, info: TorrentInfo, index: int, begin: int, length: int) -> Optional[memoryview]:
+		result = find_block_file(info, index, begin, length)
+		if not result:
+			return None
+
+		# a missing file is not zeros. the caller loads and checks the piece instead
+		file, offset = result
+		buffer = self._get_buffer(info.get_file_path(root, file), file.length, create=False)
+		if buffer is None:
+			return None
+		return memoryview(buffer)[offset:offset + length]
+
+	def _pop_buffers(self, root: Path, info: TorrentInfo) -> List[mmap.mmap | bytearray]:
+		result = []
+		with self._lock:
+			for file in info.files:
+				buffer = self._buffers.pop(info.get_file_path(root, file), None)
+				if buffer is not None:
+					result.append(buffer)
+		return result
+
+
+class MMapStorage(_BufferStorage):
+	def __init__(self, flush_interval: float):
+		super().__init__()
+		self._flush_interval = flush_interval
+		self._last_flush = time.monotonic()
+		self._dirty: Set[Path] = set()
+
+	def _create_buffer(self, path: Path, length: int) -> mmap.mmap:
+		# reserve file size the same way as the file storage does
+		path.parent.mkdir(parents=True, exist_ok=True)
+		if not path.exists():
+			with open(path, "wb") as out:
+				out.truncate(length)
+
+		with open(path, "r+b") as f:
+			if f.seek(0, 2) < length:
+				f.truncate(length)
+			return mmap.mmap(f.fileno(), length)
+
+	def _get_buffer(self, path: Path, length: int, create: bool = True) -> Optional[mmap.mmap]:
+		# the file on disk is the source of truth. map it if it's there, create it only to write
+		with self._lock:
+			buffer = self._buffers.get(path)
+			if buffer is None and (create or _file_size(path) >= length):
+				buffer = self._buffers[path] = self._create_buffer(path, length)
+			return buffer
+
+	def _on_saved(self, path: Path) -> None:
+		with self._lock:
+			self._dirty.add(path)
+
+	def flush(self, force: bool = False) -> None:
+		if not force and time.monotonic() - self._last_flush < self._flush_interval:
+			return
+		self._last_flush = time.monotonic()
+
+		with self._lock:
+			dirty = [self._buffers[path] for path in self._dirty if path in self._buffers]
+			self._dirty.clear()
+
+		for mm in dirty:
+			mm.flush()
+
+	def release(self, root: Path, info: TorrentInfo) -> None:
+		for mm in self._pop_buffers(root, info):
+			_close_map(mm)
+
+	def close(self) -> None:
+		self.flush(force=True)
+		with self._lock:
+			maps = list(self._buffers.values())
+			self._buffers.clear()
+		for mm in maps:
+			_close_map(mm)
+
+
+class MemoryStorage(_BufferStorage):
+	on_disk = False
+
+	def _create_buffer(self, path: Path, length: int) -> bytearray:
+		return bytearray(length)
+
+	def release(self, root: Path, info: TorrentInfo) -> None:
+		self._pop_buffers(root, info)
+
+
+def null_piece_data(index: int, size: int, begin: int = 0) -> bytes:
+	# piece content for the null storage: the piece index repeated over and over
+	pattern = index.to_bytes(4, "big")
+	shift = begin % len(pattern)
+	return (pattern[shift:] + pattern * (size // len(pattern) + 1))[:size]
+
+
+def make_null_info(name: str, size: int, piece_length: int) -> Dict[str, Any]:
+	# an info dict with the null storage content. use it to build torrents for benchmarks and soak tests
+	pieces_num = (size + piece_length - 1) // piece_length
+	pieces = bytearray()
+	for index in range(pieces_num):
+		piece_size = min(piece_length, size - index * piece_length)
+		pieces.extend(hashlib.sha1(null_piece_data(index, piece_size)).digest())
+	return {"name": name.encode("utf-8"), "piece length": piece_length, "length": size, "pieces": bytes(pieces)}
+
+
+class NullStorage(Storage):
+	on_disk = False
+
+	def load_piece(self, root: Path, info: TorrentInfo, index: int) -> bytes:
+		return null_piece_data(index, info.calculate_piece_size(index))
+
+	def save_piece(self, root: Path, info: TorrentInfo, index: int, data: bytes) -> None:
+		pass
+
+	def read_block(self, root: Path, info: TorrentInfo, index: int, begin: int, length: int) -> Optional[memoryview]:
+		return memoryview(null_piece_data(index, length, begin))
+
+
+def _file_size(path: Path) -> int:
+	try:
+		return path.stat().st_size
+	except OSError:
+		return -1
+
+
+def _close_map(mm: mmap.mmap) -> None:
+	mm.flush()
+	try:
+		mm.close()
+	except BufferError:
+		# some blocks are still in the transport buffers. the map will be closed by gc
+		logger.debug("mmap is still in use. skip close")
+
+
+_STORAGES: Dict[str, Callable[[Config], Storage]] = {
+	"file": lambda config: FileStorage(),
+	"mmap": lambda config: MMapStorage(config.mmap_flush_interval),
+	"memory": lambda config: MemoryStorage(),
+	"null": lambda config: NullStorage(),
+}
+
+
+def create_storage(config: Config) -> Storage:
+	factory = _STORAGES.get(config.storage_mode)
+	if not factory:
+		logger.warning(f"Unknown storage mode '{config.storage_mode}'. Using 'file' storage.")
+		factory = _STORAGES["file"]
+
+	logger.info(f"Using '{config.storage_mode}' storage")
+	return factory(config)
@@ -1,4 +1,5 @@
 import asyncio
+import time
 from typing import Coroutine, Any
 
 from _asyncio import Task
@@ -7,25 +8,43 @@ from yap_torrent.env import Env
 
 
 class System:
-	def __init__(self, env: Env):
+	def __init__(self, env: Env, update_time: float = 1):
 		self.__env: Env = env
 		self.__tasks: set[asyncio.Task] = set()
 
+		# the scheduler calls update every update_time seconds or right after wake
+		self.__update_time: float = update_time
+		self.__wake_event: asyncio.Event = asyncio.Event()
+
 	async def start(self):
 		pass
 
 	async def update(self, delta_time: float):
-		await self._update(delta_time)
+		profiler = self.__env.profiler
+		if not profiler.enabled:
+			await self._update(delta_time)
+			return
+
+		start = time.perf_counter()
+		try:
+			await self._update(delta_time)
+		finally:
+			profiler.add_update(self.__class__.__name__, time.perf_counter() - start)
 
 	async def _update(self, delta_time: float):
 		pass
 
 	def add_task(self, coro: Coroutine[Any, Any, Any]) -> Task:
+		if self.__env.profiler.enabled:
+			self.__env.profiler.add_task(self.__class__.__name__)
 		task = asyncio.create_task(coro)
 		task.add_done_callback(lambda _: self.__tasks.remove(task))
 		self.__tasks.add(task)
 		return task
 
+	def wake(self) -> None:
+		self.__wake_event.set()
+
 	def close(self) -> None:
 		for task in self.__tasks:
 			task.cancel()
@@ -34,18 +53,18 @@ class System:
 	def env(self):
 		return self.__env
 
+	@property
+	def update_time(self) -> float:
+		return self.__update_time
+
+	@property
+	def wake_event(self) -> asyncio.Event:
+		return self.__wake_event
+
 	def __repr__(self):
 		return f"System: {self.__class__.__name__}"
 
 
 class TimeSystem(System):
 	def __init__(self, env: Env, min_update_time: float = 1):
-		super().__init__(env)
-		self.__min_update_time = min_update_time
-		self.__cumulative_update_time = 0
-
-	async def update(self, delta_time: float):
-		self.__cumulative_update_time += delta_time
-		if self.__cumulative_update_time >= self.__min_update_time:
-			await self._update(self.__cumulative_update_time)
-			self.__cumulative_update_time = 0
+		super().__init__(env, min_update_time)
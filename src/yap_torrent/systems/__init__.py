@@ -1,11 +1,12 @@
+import time
 from pathlib import Path
-from typing import Optional, Dict, Generator
+from typing import Optional, Dict, List, Tuple
 
 from angelovich.core.DataStorage import Entity
 
-from yap_torrent.components.peer_ec import KnownPeersEC, PeerConnectionEC
+from yap_torrent.components.peer_ec import KnownPeersEC, PeerStatsEC
 from yap_torrent.components.torrent_ec import TorrentInfoEC, TorrentEC, TorrentPathEC, TorrentStatsEC, \
-	ValidateTorrentEC, TorrentState
+	ValidateTorrentEC, TorrentState, TorrentStubEC, SuperSeedEC
 from yap_torrent.env import Env
 from yap_torrent.protocol import TorrentInfo
 
@@ -17,26 +18,69 @@ def is_torrent_complete(torrent_entity: Entity) -> bool:
 
 
 def is_torrent_active(torrent_entity: Entity) -> bool:
+	# validating torrents are active. they serve already verified pieces
 	return (torrent_entity.is_valid()
-	        and not (torrent_entity.has_component(ValidateTorrentEC)
-	                 or torrent_entity.get_component(TorrentStatsEC).state == TorrentState.Inactive))
+	        and is_torrent_loaded(torrent_entity)
+	        and torrent_entity.get_component(TorrentStatsEC).state != TorrentState.Inactive)
+
+
+def is_torrent_loaded(torrent_entity: Entity) -> bool:
+	return not torrent_entity.has_component(TorrentStubEC)
+
+
+def is_torrent_validating(torrent_entity: Entity) -> bool:
+	return torrent_entity.has_component(ValidateTorrentEC)
 
 
 def calculate_downloaded(torrent_entity: Entity) -> float:
+	if torrent_entity.has_component(TorrentStubEC):
+		return torrent_entity.get_component(TorrentStubEC).progress
 	info = torrent_entity.get_component(TorrentInfoEC).info
 	bitfield = torrent_entity.get_component(TorrentEC).bitfield
 	return info.calculate_downloaded(bitfield.have_num)
 
 
+def calculate_left(torrent_entity: Entity) -> int:
+	# bytes left to download
+	if torrent_entity.has_component(TorrentStubEC):
+		return torrent_entity.get_component(TorrentStubEC).left
+	if not torrent_entity.has_component(TorrentInfoEC):
+		return 0
+	info = torrent_entity.get_component(TorrentInfoEC).info
+	bitfield = torrent_entity.get_component(TorrentEC).bitfield
+	return max(info.size - bitfield.have_num * info.piece_length, 0)
+
+
+def get_super_seed(torrent_entity: Entity) -> Optional[SuperSeedEC]:
+	# super-seeding state of a complete torrent. None if the torrent is seeded as usual
+	if not torrent_entity.has_component(SuperSeedEC):
+		return None
+	super_seed_ec = torrent_entity.get_component(SuperSeedEC)
+	return None if super_seed_ec.finished else super_seed_ec
+
+
 def create_torrent_entity(env: Env, info_hash: bytes, path: Optional[Path], stats: Dict[str, int],
-                          torrent_info: Optional[TorrentInfo] = None, ) -> Entity:
+                          torrent_info: Optional[TorrentInfo] = None, stub: Optional[TorrentStubEC] = None) -> Entity:
 	torrent_entity = env.data_storage.create_entity()
 	torrent_entity.add_component(TorrentPathEC(path))
-	torrent_entity.add_component(TorrentStatsEC(**stats))
-	torrent_entity.add_component(KnownPeersEC())
+	metrics = env.metrics
+	torrent_label = info_hash.hex()
+
+	stats_ec = TorrentStatsEC(**stats)
+	stats_ec.downloaded_counter = metrics.counter(
+		"yap_torrent_downloaded_bytes_total", "Bytes downloaded in this session", torrent=torrent_label)
+	stats_ec.uploaded_counter = metrics.counter(
+		"yap_torrent_uploaded_bytes_total", "Bytes uploaded in this session", torrent=torrent_label)
+	torrent_entity.add_component(stats_ec)
+
+	known_peers_ec = KnownPeersEC()
+	known_peers_ec.peers_gauge = metrics.gauge("yap_torrent_peers_known", "Known peers of all torrents")
+	torrent_entity.add_component(known_peers_ec)
 
 	if torrent_info:
 		torrent_entity.add_component(TorrentInfoEC(torrent_info))
+	if stub:
+		torrent_entity.add_component(stub)
 	torrent_entity.add_component(TorrentEC(info_hash))
 	return torrent_entity
 
@@ -52,11 +96,38 @@ def get_info_hash(torrent_entity: Entity) -> bytes:
 def get_torrent_name(entity: Entity):
 	if entity.has_component(TorrentInfoEC):
 		return entity.get_component(TorrentInfoEC).info.name
+	elif entity.has_component(TorrentStubEC):
+		return entity.get_component(TorrentStubEC).name
 	else:
 		return f"[{entity.get_component(TorrentEC).info_hash}]"
 
 
-def iterate_peers(env: Env, info_hash: bytes) -> Generator[Entity]:
-	for e in env.data_storage.get_collection(PeerConnectionEC):
-		if e.get_component(PeerConnectionEC).info_hash == info_hash:
-			yield e
+def iterate_peers(env: Env, info_hash: bytes) -> List[Entity]:
+	return env.peers_index.get(info_hash)
+
+
+def iterate_pieces(env: Env, info_hash: bytes) -> List[Entity]:
+	# cached pieces of the torrent
+	return env.pieces_index.get(info_hash)
+
+
+def calculate_rates(env: Env, info_hash: bytes) -> Tuple[float, float]:
+	# download and upload bytes per second of all connected peers
+	download = upload = 0.0
+	now = time.monotonic()
+	for peer_entity in iterate_peers(env, info_hash):
+		stats_ec = peer_entity.get_component(PeerStatsEC)
+		download += stats_ec.download.rate(now)
+		upload += stats_ec.upload.rate(now)
+	return download, upload
+
+
+def calculate_eta(env: Env, torrent_entity: Entity) -> Optional[float]:
+	# seconds to complete at the current download rate. None if it doesn't download at all
+	left = calculate_left(torrent_entity)
+	if left == 0:
+		return 0
+	download, _ = calculate_rates(env, get_info_hash(torrent_entity))
+	if download <= 0:
+		return None
+	return left / download
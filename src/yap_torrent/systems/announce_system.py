@@ -1,23 +1,35 @@
+import asyncio
 import logging
 import time
+from functools import partial
+from typing import Set, Tuple, List, Dict, Any, Optional, Coroutine
 
 from angelovich.core.DataStorage import Entity
 
-from yap_torrent.components.torrent_ec import TorrentInfoEC, TorrentEC, TorrentStatsEC
+from yap_torrent.components.torrent_ec import TorrentEC, TorrentStatsEC, TorrentState
 from yap_torrent.components.tracker_ec import TorrentTrackerDataEC, TorrentTrackerEC
 from yap_torrent.env import Env
+from yap_torrent.protocol.structures import TrackerAnnounceResponse
 from yap_torrent.protocol.tracker import make_announce
 from yap_torrent.system import System
-from yap_torrent.systems import get_torrent_name, get_torrent_entity, is_torrent_active
+from yap_torrent.systems import get_torrent_name, get_torrent_entity, is_torrent_active, is_torrent_validating, \
+	is_torrent_loaded, calculate_left
 
 logger = logging.getLogger(__name__)
 
 
+def _is_torrent_unloaded(torrent_entity: Entity) -> bool:
+	return (torrent_entity.is_valid() and not is_torrent_loaded(torrent_entity)
+	        and torrent_entity.get_component(TorrentStatsEC).state == TorrentState.Active)
+
+
 def _iterate_active_torrents(env: Env):
 	trackers_collection = env.data_storage.get_collection(TorrentTrackerDataEC).entities
 	for torrent_entity in trackers_collection:
-		# skip inactive torrents
-		if not is_torrent_active(torrent_entity):
+		# skip inactive torrents. validating ones announce "started" when the validation is complete
+		# not loaded torrents keep announcing. new peers load them
+		if not (is_torrent_active(torrent_entity) or _is_torrent_unloaded(torrent_entity)) \
+				or is_torrent_validating(torrent_entity):
 			continue
 
 		tracker_data_ec = torrent_entity.get_component(TorrentTrackerDataEC)
@@ -30,6 +42,11 @@ def _iterate_active_torrents(env: Env):
 
 
 class AnnounceSystem(System):
+	def __init__(self, env: Env):
+		super().__init__(env)
+		# torrents with a regular announce in progress
+		self._announcing: Set[bytes] = set()
+		self._latency = env.metrics.histogram("yap_torrent_announce_seconds", "Tracker announce time")
 
 	async def start(self):
 		await super().start()
@@ -39,100 +56,139 @@ class AnnounceSystem(System):
 
 		# make "started" announcements
 		for torrent_entity in _iterate_active_torrents(self.env):
-			self.__tracker_announce(torrent_entity, "started")
+			self.add_task(self.__tracker_announce_async(torrent_entity, "started"))
 
 	def close(self) -> None:
 		self.env.event_bus.remove_all_listeners(scope=self)
+		super().close()
 
 		# make "stopped" announcements
 		for torrent_entity in _iterate_active_torrents(self.env):
 			self.__tracker_announce(torrent_entity, "stopped")
 
+	# don't hold the event until trackers answer
 	async def _on_torrent_complete(self, torrent_entity: Entity):
-		await self.__tracker_announce_async(torrent_entity, "completed")
+		self.add_task(self.__tracker_announce_async(torrent_entity, "completed"))
 
 	async def _on_torrent_start(self, info_hash: bytes):
 		torrent_entity = get_torrent_entity(self.env, info_hash)
-		await self.__tracker_announce_async(torrent_entity, "started")
+		self.add_task(self.__tracker_announce_async(torrent_entity, "started"))
 
 	async def _on_torrent_stop(self, info_hash: bytes):
 		torrent_entity = get_torrent_entity(self.env, info_hash)
-		await self.__tracker_announce_async(torrent_entity, "stopped")
+		self.add_task(self.__tracker_announce_async(torrent_entity, "stopped"))
 
 	async def _update(self, delta_time: float):
 		current_time = time.monotonic()
 		for torrent_entity in _iterate_active_torrents(self.env):
+			info_hash = torrent_entity.get_component(TorrentEC).info_hash
+			if info_hash in self._announcing:
+				continue
+
 			tracker_data_ec = torrent_entity.get_component(TorrentTrackerDataEC)
 			interval = min(tracker_data_ec.interval, tracker_data_ec.min_interval)
 			if tracker_data_ec.last_update_time + interval <= current_time:
-				await self.__tracker_announce_async(torrent_entity)
+				self._announcing.add(info_hash)
+				task = self.add_task(self.__tracker_announce_async(torrent_entity))
+				task.add_done_callback(lambda _, key=info_hash: self._announcing.discard(key))
+
+	def __tracker_announce_async(self, torrent_entity: Entity, event: str = "") -> Coroutine[Any, Any, None]:
+		return self.__announce_async(torrent_entity, event, self.__make_announces(torrent_entity, event))
+
+	async def __announce_async(self, torrent_entity: Entity, event: str,
+	                           announces: List[Tuple[List[str], str, Dict[str, Any]]]):
+		# trackers can answer for seconds. don't block the loop with the request
+		loop = asyncio.get_running_loop()
+		for announce_tier, announce, params in announces:
+			logger.info(f"make announce '{event}' to: {announce}")
+			result = await loop.run_in_executor(None, partial(self.__make_announce, announce, params))
+			if self.__on_announce_result(torrent_entity, announce_tier, announce, result):
+				return
+		self.__on_announce_failed(torrent_entity)
 
-	async def __tracker_announce_async(self, torrent_entity: Entity, event: str = ""):
-		self.__tracker_announce(torrent_entity, event)
+	def __tracker_announce(self, torrent_entity: Entity, event: str = ""):
+		for announce_tier, announce, params in self.__make_announces(torrent_entity, event):
+			logger.info(f"make announce '{event}' to: {announce}")
+			if self.__on_announce_result(torrent_entity, announce_tier, announce, self.__make_announce(announce, params)):
+				return
+		self.__on_announce_failed(torrent_entity)
+
+	def __make_announce(self, announce: str, params: Dict[str, Any]) -> Optional[TrackerAnnounceResponse]:
+		start_time = time.monotonic()
+		result = make_announce(announce, **params)
+		self._latency.add(time.monotonic() - start_time)
+
+		status = "error" if not result else "failure" if result.failure_reason else "success"
+		self.env.metrics.counter("yap_torrent_announces_total", "Tracker announces", result=status).inc()
+		return result
 
 	# event = "", "started", "completed", "stopped"
-	def __tracker_announce(self, torrent_entity: Entity, event: str = ""):
-		peer_id = self.env.peer_id
-		external_ip = self.env.external_ip
-		port = self.env.config.port
-		info_hash = torrent_entity.get_component(TorrentEC).info_hash
-		bitfield = torrent_entity.get_component(TorrentEC).bitfield
+	def __make_announces(self, torrent_entity: Entity, event: str) -> List[Tuple[List[str], str, Dict[str, Any]]]:
+		# everything is collected right away. the torrent could be removed before the task starts
+		if not torrent_entity.has_component(TorrentTrackerEC):
+			return []
 		tracker_ec = torrent_entity.get_component(TorrentTrackerEC)
 		tracker_data_ec = torrent_entity.get_component(TorrentTrackerDataEC)
+		params = dict(
+			info_hash=torrent_entity.get_component(TorrentEC).info_hash,
+			peer_id=self.env.peer_id,
+			downloaded=torrent_entity.get_component(TorrentStatsEC).downloaded,
+			uploaded=torrent_entity.get_component(TorrentStatsEC).uploaded,
+			left=calculate_left(torrent_entity),
+			port=self.env.config.port,
+			ip=self.env.external_ip,
+			event=event,
+			compact=1,
+			tracker_id=tracker_data_ec.tracker_id
+		)
+
+		# https://bittorrent.org/beps/bep_0012.html
+		# a copy of every tier. other announces of the torrent can reorder it
+		return [(announce_tier, announce, params)
+		        for announce_tier in tracker_ec.announce_list for announce in list(announce_tier)]
+
+	def __on_announce_result(self, torrent_entity: Entity, announce_tier: List[str], announce: str,
+	                         result: Optional[TrackerAnnounceResponse]) -> bool:
+		if not result:
+			logger.info(f"announce to {announce} failed")
+			return False
+
+		# the torrent was removed while waiting for the tracker
+		if not torrent_entity.is_valid():
+			return True
+
+		info_hash = torrent_entity.get_component(TorrentEC).info_hash
+		tracker_data_ec = torrent_entity.get_component(TorrentTrackerDataEC)
 		torrent_name = get_torrent_name(torrent_entity)
 
-		left = 0
-		if torrent_entity.has_component(TorrentInfoEC):
-			torrent_info = torrent_entity.get_component(TorrentInfoEC).info
-			left = max(torrent_info.size - bitfield.have_num * torrent_info.piece_length, 0)
+		# update tracker data
+		tracker_data_ec.save_announce(result)
 
-		uploaded = torrent_entity.get_component(TorrentStatsEC).uploaded
-		downloaded = torrent_entity.get_component(TorrentStatsEC).downloaded
+		# move good announce to the front of the tier for next time
+		if announce in announce_tier:
+			announce_tier.remove(announce)
+			announce_tier.insert(0, announce)
 
-		# https://bittorrent.org/beps/bep_0012.html
-		for announce_tier in tracker_ec.announce_list:
-			for announce in announce_tier:
-				logger.info(f"make announce '{event}' to: {announce}")
-				result = make_announce(
-					announce,
-					info_hash,
-					peer_id=peer_id,
-					downloaded=downloaded,
-					uploaded=uploaded,
-					left=left,
-					port=port,
-					ip=external_ip,
-					event=event,
-					compact=1,
-					tracker_id=tracker_data_ec.tracker_id
-				)
-
-				if not result:
-					logger.info(f"announce to {announce} failed")
-					continue
-
-				# update tracker data
-				tracker_data_ec.save_announce(result)
-
-				# move good announce to the front of the tier for next time
-				announce_tier.remove(announce)
-				announce_tier.insert(0, announce)
-
-				# stop future updates in case of error
-				if result.failure_reason:
-					logger.warning(
-						f"Torrent tracker '{announce}' says '{result.failure_reason}'. Torrent {torrent_name} looks broken.")
-					return
-
-				# log warning
-				if result.warning_message:
-					logger.warning(f"Announce warning '{result.warning_message}' for {torrent_name}")
-
-				# update peers got from tracker
-				logger.info(f"Announce to '{announce}' for {torrent_name} succeeded. Got {len(result.peers)} peers")
-				self.env.event_bus.dispatch("peers.update", info_hash, result.peers)
-				return
+		# stop future updates in case of error
+		if result.failure_reason:
+			logger.warning(
+				f"Torrent tracker '{announce}' says '{result.failure_reason}'. Torrent {torrent_name} looks broken.")
+			return True
+
+		# log warning
+		if result.warning_message:
+			logger.warning(f"Announce warning '{result.warning_message}' for {torrent_name}")
+
+		# update peers got from tracker
+		logger.info(f"Announce to '{announce}' for {torrent_name} succeeded. Got {len(result.peers)} peers")
+		self.env.event_bus.dispatch("peers.update", info_hash, result.peers)
+		return True
+
+	@staticmethod
+	def __on_announce_failed(torrent_entity: Entity):
+		if not torrent_entity.is_valid() or not torrent_entity.has_component(TorrentTrackerDataEC):
+			return
 
 		# we couldn't get any data from trackers.
-		logger.warning(f"No announce results for {torrent_name}")
-		tracker_data_ec.fail_announce()
+		logger.warning(f"No announce results for {get_torrent_name(torrent_entity)}")
+		torrent_entity.get_component(TorrentTrackerDataEC).fail_announce()
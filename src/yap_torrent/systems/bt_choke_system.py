@@ -1,36 +1,228 @@
 import asyncio
 import logging
+import math
+import random
+import time
+from typing import List, Optional, Set, Tuple
 
 from angelovich.core.DataStorage import Entity
 
-from yap_torrent.components.peer_ec import PeerConnectionEC
+from yap_torrent.components.peer_ec import PeerConnectionEC, PeerStatsEC
+from yap_torrent.components.torrent_ec import TorrentEC, TorrentInfoEC
 from yap_torrent.env import Env
 from yap_torrent.protocol import bt_main_messages as msg
 from yap_torrent.protocol.message import Message
 from yap_torrent.system import System
-from yap_torrent.systems import get_torrent_entity, iterate_peers
+from yap_torrent.systems import get_torrent_entity, iterate_peers, is_torrent_active, is_torrent_complete
 
 logger = logging.getLogger(__name__)
 
+# seconds between rechoke rounds
+RECHOKE_INTERVAL = 10
+# rechoke rounds between optimistic unchoke rotations
+OPTIMISTIC_ROUNDS = 3
+# seconds a peer counts as new. new peers get more chances of an optimistic unchoke
+NEW_PEER_TIME = 60
+NEW_PEER_WEIGHT = 3
+# upload slots before the upload capacity is known
+DEFAULT_UPLOAD_SLOTS = 4
+# measured upload capacity goes down by this factor every round without a new peak
+CAPACITY_DECAY = 0.95
+
+# orders to unchoke peers of complete torrents in
+SEED_ROUND_ROBIN = "round_robin"
+SEED_FASTEST_UPLOAD = "fastest_upload"
+SEED_ANTI_LEECH = "anti_leech"
+
+
+def _auto_upload_slots(upload_rate: float) -> int:
+	# the original client's rule: a few slots for slow links, more for fast ones
+	if upload_rate <= 0:
+		return DEFAULT_UPLOAD_SLOTS
+	kib = upload_rate / 1024
+	if kib < 9:
+		return 2
+	if kib < 15:
+		return 3
+	if kib < 42:
+		return 4
+	return int(math.sqrt(kib * 0.6))
+
+
+def _split_slots(slots: int, download_num: int, seed_num: int) -> Tuple[int, int]:
+	# one budget for downloading and seeding torrents, shared by the number of interested peers.
+	# a group with fewer peers than its share leaves the rest to the other one
+	total = download_num + seed_num
+	if not total:
+		return slots, 0
+	download_slots = round(slots * download_num / total)
+	if download_num and seed_num and slots > 1:
+		download_slots = max(1, min(download_slots, slots - 1))
+	download_slots = min(download_slots, download_num)
+	seed_slots = min(slots - download_slots, seed_num)
+	return min(slots - seed_slots, download_num), seed_slots
+
 
 class BTChokeSystem(System):
 	_CHOKE_MESSAGES = (msg.MessageId.CHOKE.value, msg.MessageId.UNCHOKE.value)
 
+	def __init__(self, env: Env):
+		super().__init__(env, RECHOKE_INTERVAL)
+		# 0 - tune to the upload capacity
+		self._upload_slots: int = env.config.upload_slots
+		self._upload_capacity: float = 0
+
+		self._seed_slots: int = env.config.seed_upload_slots
+		self._seed_rotation_interval: float = env.config.seed_rotation_interval
+		self._seed_choking: str = env.config.seed_choking
+		if self._seed_choking not in (SEED_ROUND_ROBIN, SEED_FASTEST_UPLOAD, SEED_ANTI_LEECH):
+			logger.warning(f"Unknown seed choking {self._seed_choking}. Using {SEED_ROUND_ROBIN}")
+			self._seed_choking = SEED_ROUND_ROBIN
+
+		self._round: int = 0
+		self._optimistic: Optional[Entity] = None
+
+		self._slots_gauge = env.metrics.gauge(
+			"yap_torrent_upload_slots", "Peers of downloading torrents we upload to at once")
+		self._seed_slots_gauge = env.metrics.gauge(
+			"yap_torrent_seed_upload_slots", "Peers of seeding torrents we upload to at once")
+
 	async def start(self):
 		self.env.event_bus.add_listener("peer.message", self.__on_message, scope=self)
-		self.env.event_bus.add_listener("peer.connected", self.__on_peer_connected, scope=self)
+		self.env.event_bus.add_listener("peer.remote.interested_changed", self.__on_remote_interested, scope=self)
 		self.env.event_bus.add_listener("action.torrent.stop", self._on_torrent_stop, scope=self)
 
+	def close(self) -> None:
+		self.env.event_bus.remove_all_listeners(scope=self)
+		super().close()
+
+	async def _update(self, delta_time: float):
+		await self._rechoke()
+
+	@property
+	def upload_slots(self) -> int:
+		if self._upload_slots > 0:
+			return self._upload_slots
+		# a limit is the capacity we are allowed to use
+		return _auto_upload_slots(self.env.bandwidth.upload.rate or self._upload_capacity)
+
+	def _get_peers(self) -> Tuple[List[Entity], List[Entity]]:
+		# peers of torrents we download and peers of torrents we seed
+		download_peers: List[Entity] = []
+		seed_peers: List[Entity] = []
+		for torrent_entity in self.env.data_storage.get_collection(TorrentEC):
+			if not is_torrent_active(torrent_entity) or not torrent_entity.has_component(TorrentInfoEC):
+				continue
+			peers = seed_peers if is_torrent_complete(torrent_entity) else download_peers
+			peers.extend(iterate_peers(self.env, torrent_entity.get_component(TorrentEC).info_hash))
+		return download_peers, seed_peers
+
+	def _measure_upload(self, peers: List[Entity], now: float) -> None:
+		upload_rate = sum(p.get_component(PeerStatsEC).upload.rate(now) for p in peers)
+		self._upload_capacity = max(upload_rate, self._upload_capacity * CAPACITY_DECAY)
+
+	@staticmethod
+	def _rank(peer_entity: Entity, now: float) -> float:
+		# tit-for-tat: upload to peers which give us the most
+		return peer_entity.get_component(PeerStatsEC).download.rate(now)
+
+	def _seed_rank(self, peer_entity: Entity, now: float) -> Tuple[float, float]:
+		# nothing to reciprocate for a seed
+		peer_connection_ec = peer_entity.get_component(PeerConnectionEC)
+		# unchoked peers go to the end of the line, choked ones wait their turn
+		choke_time = now - peer_connection_ec.remote_choked_time
+		waited = choke_time if peer_connection_ec.remote_choked else -choke_time
+
+		if self._seed_choking == SEED_FASTEST_UPLOAD:
+			return peer_entity.get_component(PeerStatsEC).upload.rate(now), waited
+
+		if self._seed_choking == SEED_ANTI_LEECH:
+			# peers which just started or are almost done share what they get soon. the middle waits
+			torrent_entity = get_torrent_entity(self.env, peer_connection_ec.info_hash)
+			pieces_num = torrent_entity.get_component(TorrentInfoEC).info.pieces_num
+			have = peer_connection_ec.remote_bitfield.have_num / max(pieces_num, 1)
+			return abs(have - 0.5), waited
+
+		# round robin: an unchoked peer keeps its slot for the rotation interval
+		keeps = not peer_connection_ec.remote_choked and choke_time < self._seed_rotation_interval
+		return float(keeps), waited
+
+	def _pick_optimistic(self, candidates: List[Entity], now: float) -> Optional[Entity]:
+		if not candidates:
+			return None
+		weights = [
+			NEW_PEER_WEIGHT if now - p.get_component(PeerConnectionEC).connection.connection_time < NEW_PEER_TIME else 1
+			for p in candidates]
+		return random.choices(candidates, weights)[0]
+
+	async def _rechoke(self) -> None:
+		now = time.monotonic()
+		download_peers, seed_peers = self._get_peers()
+		self._measure_upload(download_peers + seed_peers, now)
+
+		# peers with the same rank take turns
+		interested = [p for p in download_peers if p.get_component(PeerConnectionEC).remote_interested]
+		random.shuffle(interested)
+		interested.sort(key=lambda p: self._rank(p, now), reverse=True)
+
+		seed_interested = [p for p in seed_peers if p.get_component(PeerConnectionEC).remote_interested]
+		random.shuffle(seed_interested)
+		seed_interested.sort(key=lambda p: self._seed_rank(p, now), reverse=True)
+
+		# one slot is left for the optimistic unchoke
+		slots = max(self.upload_slots - 1, 1)
+		if self._seed_slots > 0:
+			seed_slots = self._seed_slots
+		else:
+			slots, seed_slots = _split_slots(slots, len(interested), len(seed_interested))
+		self._slots_gauge.set(slots)
+		self._seed_slots_gauge.set(seed_slots)
+
+		unchoke: Set[int] = set(id(p) for p in interested[:slots])
+		unchoke.update(id(p) for p in seed_interested[:seed_slots])
+
+		self._round += 1
+		candidates = [p for p in interested + seed_interested if id(p) not in unchoke]
+		optimistic = self._optimistic
+		if self._round % OPTIMISTIC_ROUNDS == 0 or not any(p is optimistic for p in candidates):
+			optimistic = self._pick_optimistic(candidates, now)
+		self._optimistic = optimistic
+		if optimistic:
+			unchoke.add(id(optimistic))
+
+		tasks = []
+		for peer_entity in download_peers + seed_peers:
+			torrent_entity = get_torrent_entity(self.env, peer_entity.get_component(PeerConnectionEC).info_hash)
+			tasks.append(_update_remote_choked(self.env, torrent_entity, peer_entity, id(peer_entity) not in unchoke))
+		await asyncio.gather(*tasks)
+		logger.debug(f"Rechoke: {len(unchoke)} of {len(interested) + len(seed_interested)} interested peers "
+		             f"unchoked, {slots} download and {seed_slots} seed slots")
+
+	async def __on_remote_interested(self, torrent_entity: Entity, peer_entity: Entity) -> None:
+		peer_connection_ec = peer_entity.get_component(PeerConnectionEC)
+		if not peer_connection_ec.remote_interested or not peer_connection_ec.remote_choked:
+			return
+		if not is_torrent_active(torrent_entity) or not torrent_entity.has_component(TorrentInfoEC):
+			return
+
+		# don't wait for the next round if there is a free slot
+		download_peers, seed_peers = self._get_peers()
+		if self._seed_slots <= 0:
+			peers, slots = download_peers + seed_peers, self.upload_slots
+		elif is_torrent_complete(torrent_entity):
+			peers, slots = seed_peers, self._seed_slots
+		else:
+			peers, slots = download_peers, self.upload_slots
+		unchoked = sum(1 for p in peers if not p.get_component(PeerConnectionEC).remote_choked)
+		if unchoked < slots:
+			await _update_remote_choked(self.env, torrent_entity, peer_entity, False)
+
 	async def _on_torrent_stop(self, info_hash: bytes):
 		torrent_entity = get_torrent_entity(self.env, info_hash)
 		tasks = [_update_remote_choked(self.env, torrent_entity, peer_entity, True)
 		         for peer_entity in iterate_peers(self.env, info_hash)]
 		await asyncio.gather(*tasks)
 
-	async def __on_peer_connected(self, torrent_entity: Entity, peer_entity: Entity) -> None:
-		# TODO: implement choke algorythm
-		await _update_remote_choked(self.env, torrent_entity, peer_entity, False)
-
 	async def __on_message(self, torrent_entity: Entity, peer_entity: Entity, message: Message):
 		if message.message_id not in self._CHOKE_MESSAGES:
 			return
@@ -59,6 +251,7 @@ async def _update_remote_choked(env: Env, torrent_entity: Entity, peer_entity: E
 		return
 
 	peer_connection_ec.remote_choked = new_choked
+	peer_connection_ec.remote_choked_time = time.monotonic()
 	if new_choked:
 		await peer_connection_ec.connection.send(msg.choke())
 	else:
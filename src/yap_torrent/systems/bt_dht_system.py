@@ -24,6 +24,7 @@ from yap_torrent.protocol.connection import Message
 from yap_torrent.protocol.extensions import check_extension
 from yap_torrent.protocol.structures import PeerInfo
 from yap_torrent.system import System
+from yap_torrent.systems import is_torrent_loaded
 
 logger = logging.getLogger(__name__)
 
@@ -80,6 +81,9 @@ class BTDHTSystem(System, DHTServerProtocolHandler):
 		self.bad_nodes: Set[Tuple[str, int]] = set()
 		self.pending_torrents: List[bytes] = []
 
+		env.metrics.gauge_callback(
+			"yap_torrent_dht_nodes", "Nodes in the DHT routing table", lambda: len(self._routing_table.nodes))
+
 	async def start(self):
 		self.env.event_bus.add_listener("peer.connected", self.__on_peer_connected, scope=self)
 		self.env.event_bus.add_listener("peer.message", self.__on_message, scope=self)
@@ -91,7 +95,7 @@ class BTDHTSystem(System, DHTServerProtocolHandler):
 
 		# add torrents without info hash to pending torrents
 		for entity in collection.entities:
-			if entity.has_component(TorrentInfoEC):
+			if entity.has_component(TorrentInfoEC) or not is_torrent_loaded(entity):
 				continue
 			self.pending_torrents.append(entity.get_component(TorrentEC).info_hash)
 
@@ -117,6 +121,7 @@ class BTDHTSystem(System, DHTServerProtocolHandler):
 
 	async def __on_request_more_peers(self, info_hash: bytes):
 		self.pending_torrents.append(info_hash)
+		self.wake()
 
 	async def _update(self, delta_time: float):
 		if self.pending_nodes:
@@ -145,7 +150,8 @@ class BTDHTSystem(System, DHTServerProtocolHandler):
 		self._add_node(bytes(), peer_info.host, port)
 
 	async def __on_torrent_added(self, entity: Entity, component: TorrentEC):
-		if entity.has_component(TorrentInfoEC):
+		# metadata of not loaded torrents is on disk
+		if entity.has_component(TorrentInfoEC) or not is_torrent_loaded(entity):
 			return
 		self.pending_torrents.append(component.info_hash)
 
@@ -189,6 +195,7 @@ class BTDHTSystem(System, DHTServerProtocolHandler):
 			request_node = all_nodes[node_id]
 
 			# make a request to peer
+			self._count_query("out", KRPCQueryType.GET_PEERS.value)
 			result: Optional[KRPCMessage] = await dht_connection.get_peers(
 				self._my_node_id, info_hash, request_node.host, request_node.port)
 
@@ -227,6 +234,7 @@ class BTDHTSystem(System, DHTServerProtocolHandler):
 			                    key=lambda n: distance(info_hash, n.node_id))[:self.BUCKET_CAPACITY]
 			my_port = self.env.config.dht_port
 			for node in join_nodes:
+				self._count_query("out", KRPCQueryType.ANNOUNCE_PEER.value)
 				res = await dht_connection.announce_peer(
 					self._my_node_id,
 					info_hash,
@@ -247,6 +255,7 @@ class BTDHTSystem(System, DHTServerProtocolHandler):
 
 	async def _ping_new_host(self, host: str, port: int) -> None:
 		logger.debug('ping sent to %s:%s', host, port)
+		self._count_query("out", KRPCQueryType.PING.value)
 		ping_response = await dht_connection.ping(self._my_node_id, host, port)
 
 		# no connection to the host or message is broken
@@ -273,8 +282,13 @@ class BTDHTSystem(System, DHTServerProtocolHandler):
 			self.extra_good_nodes.add((remote_node_id, host, port))
 			logger.debug('no place for new node: %s|%s:%s', remote_node_id, host, port)
 
+	def _count_query(self, direction: str, query_type: str):
+		self.env.metrics.counter("yap_torrent_dht_queries_total", "DHT queries", direction=direction,
+		                         type=query_type).inc()
+
 	def process_query(self, message: KRPCMessage, addr: tuple[str | Any, int]) -> Dict[str, Any]:
 		query_type = message.query_type
+		self._count_query("in", query_type.value if query_type else "unknown")
 		arguments = message.arguments
 		if query_type == KRPCQueryType.PING:
 			return message.make_response(self._my_node_id, self.query_ping_response(arguments, addr))
@@ -6,7 +6,7 @@ from typing import Set, Dict
 
 from angelovich.core.DataStorage import Entity, DataStorage
 
-from yap_torrent.components.peer_ec import PeerConnectionEC
+from yap_torrent.components.peer_ec import PeerConnectionEC, PeerStatsEC
 from yap_torrent.components.piece_ec import PieceEC, PiecePendingRemoveEC
 from yap_torrent.components.torrent_ec import TorrentEC, TorrentInfoEC, TorrentStatsEC, TorrentDownloadEC
 from yap_torrent.env import Env
@@ -14,7 +14,7 @@ from yap_torrent.protocol import bt_main_messages as msg
 from yap_torrent.protocol.message import Message
 from yap_torrent.protocol.structures import PieceBlockInfo
 from yap_torrent.system import System
-from yap_torrent.systems import is_torrent_complete
+from yap_torrent.systems import is_torrent_complete, iterate_peers
 
 logger = logging.getLogger(__name__)
 
@@ -53,6 +53,7 @@ class BTDownloadSystem(System):
 		logger.debug("%s stop download", peer_entity.get_component(PeerConnectionEC))
 		if torrent_entity.has_component(TorrentDownloadEC):
 			torrent_entity.get_component(TorrentDownloadEC).cancel(peer_entity.get_component(PeerConnectionEC))
+		peer_entity.get_component(PeerStatsEC).clear_requests()
 
 
 def _get_piece_entity(ds: DataStorage, torrent_entity: Entity, index: int) -> Entity:
@@ -89,6 +90,7 @@ async def _process_piece_message(env: Env, peer_entity: Entity, torrent_entity:
 	index, begin, block = msg.payload_piece(message)
 	# update stats
 	torrent_entity.get_component(TorrentStatsEC).update_downloaded(len(block))
+	peer_entity.get_component(PeerStatsEC).on_block(index, begin, len(block))
 
 	blocks_manager = _get_blocks_manager(env, torrent_entity)
 
@@ -132,10 +134,8 @@ def _find_rarest(env: Env, torrent_entity: Entity, pieces: Set[int]) -> int:
 
 	# collect pieces on connected peers
 	counters: Dict[int, int] = {index: 0 for index in pieces}
-	for peer_entity in env.data_storage.get_collection(PeerConnectionEC):
+	for peer_entity in iterate_peers(env, info_hash):
 		peer_ec = peer_entity.get_component(PeerConnectionEC)
-		if peer_ec.info_hash != info_hash:
-			continue
 		for index in peer_ec.remote_bitfield.intersection(pieces):
 			counters[index] = counters.get(index, 0) + 1
 
@@ -152,12 +152,16 @@ async def _request_next(env: Env, torrent_entity: Entity, peer_entity: Entity) -
 	blocks_manager = _get_blocks_manager(env, torrent_entity)
 	for block in blocks_manager.request_blocks(interested_in, peer_entity.get_component(PeerConnectionEC)):
 		await peer_entity.get_component(PeerConnectionEC).request(block)
+		peer_entity.get_component(PeerStatsEC).on_request(block)
 
 
 def _get_blocks_manager(env: Env, torrent_entity):
 	if torrent_entity.has_component(TorrentDownloadEC):
 		return torrent_entity.get_component(TorrentDownloadEC)
 	info = torrent_entity.get_component(TorrentInfoEC).info
-	blocks_manager = TorrentDownloadEC(info, partial(_find_rarest, env, torrent_entity))
+	blocks_manager = TorrentDownloadEC(
+		info, partial(_find_rarest, env, torrent_entity),
+		env.metrics.gauge("yap_torrent_requests_in_flight", "Block requests waiting for an answer"),
+		env.metrics.gauge("yap_torrent_piece_buffers_bytes", "Memory of pieces in progress"))
 	torrent_entity.add_component(blocks_manager)
 	return blocks_manager
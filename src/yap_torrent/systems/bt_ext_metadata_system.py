@@ -7,7 +7,7 @@ from yap_torrent.components.extensions import TorrentMetadataEC, PeerExtensionsE
 from yap_torrent.components.peer_ec import PeerConnectionEC
 from yap_torrent.components.torrent_ec import TorrentEC, TorrentInfoEC
 from yap_torrent.protocol import bt_ext_messages as msg
-from yap_torrent.protocol import encode, decode, TorrentInfo
+from yap_torrent.protocol import encode, TorrentInfo
 from yap_torrent.protocol.connection import Message
 from yap_torrent.system import System
 from yap_torrent.utils import check_hash
@@ -22,6 +22,7 @@ class BTExtMetadataSystem(System):
 		self.env.event_bus.add_listener(f"protocol.extensions.message.{UT_METADATA}", self.__on_ext_message, scope=self)
 		self.env.event_bus.add_listener("protocol.extensions.create_handshake", self.__on_create_handshake, scope=self)
 		self.env.event_bus.add_listener("protocol.extensions.got_handshake", self.__on_got_handshake, scope=self)
+		self.env.event_bus.add_listener("action.torrent.unload", self.__on_torrent_unload, scope=self)
 
 		collection = self.env.data_storage.get_collection(TorrentEC)
 		collection.add_listener(collection.EVENT_ADDED, self.__on_torrent_added, self)
@@ -40,6 +41,10 @@ class BTExtMetadataSystem(System):
 	async def __on_torrent_added(self, entity: Entity, component: TorrentEC):
 		entity.add_component(TorrentMetadataEC())
 
+	async def __on_torrent_unload(self, info_hash: bytes):
+		torrent_entity = self.env.data_storage.get_collection(TorrentEC).find(info_hash)
+		torrent_entity.get_component(TorrentMetadataEC).clear()
+
 	async def __on_create_handshake(self, torrent_entity: Entity, additional_fields: dict[str, Any]) -> None:
 		additional_fields["metadata_size"] = 0
 		if torrent_entity.has_component(TorrentInfoEC):
@@ -142,7 +147,7 @@ class BTExtMetadataSystem(System):
 				info_hash = torrent_entity.get_component(TorrentEC).info_hash
 				if check_hash(metadata, info_hash):
 					metadata_ec.set_metadata(metadata)
-					torrent_info = TorrentInfo(decode(metadata))
+					torrent_info = TorrentInfo.from_metadata(metadata)
 					torrent_entity.add_component(TorrentInfoEC(torrent_info))
 
 					# disconnect all peers and start validation
@@ -1,5 +1,6 @@
 import asyncio
 import logging
+from typing import Set
 
 from angelovich.core.DataStorage import Entity
 
@@ -10,7 +11,7 @@ from yap_torrent.env import Env
 from yap_torrent.protocol import bt_main_messages as msg
 from yap_torrent.protocol.message import Message
 from yap_torrent.system import System
-from yap_torrent.systems import iterate_peers, get_torrent_entity
+from yap_torrent.systems import iterate_peers, get_torrent_entity, is_torrent_validating, get_super_seed
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +29,10 @@ class BTInterestedSystem(System):
 		self.env.event_bus.add_listener("piece.complete", self.__on_piece_complete, scope=self)
 		self.env.event_bus.add_listener("peer.connected", self.__on_peer_connected, scope=self)
 		self.env.event_bus.add_listener("action.torrent.stop", self._on_torrent_stop, scope=self)
+		self.env.event_bus.add_listener("action.torrent.start", self._on_torrent_start, scope=self)
+		self.env.event_bus.add_listener("torrent.validation.start", self.__on_validation_start, scope=self)
+		self.env.event_bus.add_listener("torrent.validation.pieces", self.__on_pieces_validated, scope=self)
+		self.env.event_bus.add_listener("piece.corrupted", self.__on_piece_corrupted, scope=self)
 
 	async def _on_torrent_stop(self, info_hash: bytes):
 		torrent_entity = get_torrent_entity(self.env, info_hash)
@@ -35,6 +40,36 @@ class BTInterestedSystem(System):
 		         for peer_entity in iterate_peers(self.env, info_hash)]
 		await asyncio.gather(*tasks)
 
+	async def _on_torrent_start(self, info_hash: bytes):
+		# validation could change the bitfield. check what we need from connected peers
+		torrent_entity = get_torrent_entity(self.env, info_hash)
+		for peer_entity in iterate_peers(self.env, info_hash):
+			await self.update_local_interested(torrent_entity, peer_entity)
+
+	async def __on_validation_start(self, torrent_entity: Entity):
+		# don't download pieces which could be already on disk
+		info_hash = torrent_entity.get_component(TorrentEC).info_hash
+		await self._on_torrent_stop(info_hash)
+
+	async def __on_pieces_validated(self, torrent_entity: Entity, indexes: Set[int]):
+		# a super-seed offers pieces one by one
+		if get_super_seed(torrent_entity):
+			return
+		info_hash = torrent_entity.get_component(TorrentEC).info_hash
+		for peer_entity in iterate_peers(self.env, info_hash):
+			peer_connection_ec = peer_entity.get_component(PeerConnectionEC)
+			for index in sorted(indexes):
+				# the peer doesn't need it
+				if peer_connection_ec.remote_bitfield.have_index(index):
+					continue
+				await peer_connection_ec.connection.send(msg.have(index))
+
+	async def __on_piece_corrupted(self, torrent_entity: Entity, _: int):
+		# the piece has to be downloaded again
+		info_hash = torrent_entity.get_component(TorrentEC).info_hash
+		for peer_entity in iterate_peers(self.env, info_hash):
+			await self.update_local_interested(torrent_entity, peer_entity)
+
 	async def __on_peer_connected(self, torrent_entity: Entity, peer_entity: Entity) -> None:
 		await self.update_local_interested(torrent_entity, peer_entity)
 
@@ -43,11 +78,9 @@ class BTInterestedSystem(System):
 		index = piece_entity.get_component(PieceEC).info.index
 
 		# notify all
-		peers_collection = self.env.data_storage.get_collection(PeerConnectionEC).entities
-		for peer_entity in peers_collection:
-			if peer_entity.get_component(PeerConnectionEC).info_hash == info_hash:
-				await peer_entity.get_component(PeerConnectionEC).connection.send(msg.have(index))
-				await self.update_local_interested(torrent_entity, peer_entity)
+		for peer_entity in iterate_peers(self.env, info_hash):
+			await peer_entity.get_component(PeerConnectionEC).connection.send(msg.have(index))
+			await self.update_local_interested(torrent_entity, peer_entity)
 
 	async def __on_message(self, torrent_entity: Entity, peer_entity: Entity, message: Message):
 		if message.message_id not in self._INTERESTED_MESSAGES:
@@ -69,7 +102,7 @@ class BTInterestedSystem(System):
 
 	async def update_remote_interested(self, torrent_entity: Entity, peer_entity: Entity, new_value: bool):
 		peer_connection_ec = peer_entity.get_component(PeerConnectionEC)
-		if peer_connection_ec.local_interested == new_value:
+		if peer_connection_ec.remote_interested == new_value:
 			return
 
 		peer_connection_ec.remote_interested = new_value
@@ -79,6 +112,11 @@ class BTInterestedSystem(System):
 		remote_bitfield = peer_entity.get_component(PeerConnectionEC).remote_bitfield
 		local_bitfield = torrent_entity.get_component(TorrentEC).bitfield
 		new_interested = local_bitfield.interested_in(remote_bitfield)
+
+		# don't download pieces which could be already on disk
+		if is_torrent_validating(torrent_entity):
+			new_interested = set()
+
 		await _update_local_peer_interested(self.env, torrent_entity, peer_entity, len(new_interested) > 0)
 
 
@@ -1,41 +1,62 @@
 import asyncio
+import bisect
 import logging
 import os
-import pickle
+import time
+from asyncio import Task
 from pathlib import Path
-from typing import Any, Dict, Set
+from typing import Any, Dict, Set, List, Optional, Tuple
 
 from angelovich.core.DataStorage import Entity
 
 from yap_torrent.components.peer_ec import KnownPeersEC
+from yap_torrent.components.piece_ec import PieceEC, PieceToSaveEC
 from yap_torrent.components.torrent_ec import TorrentInfoEC, TorrentEC, SaveTorrentEC, ValidateTorrentEC, \
-	TorrentPathEC, TorrentStatsEC
+	TorrentPathEC, TorrentStatsEC, TorrentStubEC, TorrentState, TorrentDownloadEC
 from yap_torrent.components.tracker_ec import TorrentTrackerDataEC, TorrentTrackerEC
 from yap_torrent.env import Env
-from yap_torrent.protocol.structures import PeerInfo
+from yap_torrent.protocol import TorrentInfo
+from yap_torrent.protocol.structures import PeerInfo, Bitfield, FileInfo
+from yap_torrent.resume import ResumeStore, pack_pieces, unpack_pieces
 from yap_torrent.system import System
-from yap_torrent.systems import create_torrent_entity
+from yap_torrent.systems import create_torrent_entity, get_torrent_entity, is_torrent_loaded, get_torrent_name, \
+	is_torrent_validating, calculate_downloaded, calculate_left, iterate_peers, iterate_pieces
 
 logger = logging.getLogger(__name__)
 
+UNLOAD_CHECK_TIME = 60
+
 
 class LocalDataSystem(System):
 	def __init__(self, env: Env):
 		super().__init__(env)
 		self.collection = self.env.data_storage.get_collection(SaveTorrentEC)
+		self._store = ResumeStore(Path(env.config.active_folder), env.config.resume_journal_size)
+		self._loading: Dict[bytes, Task] = {}
+
+		# last time loaded torrents had peers
+		self._unload_idle_time: float = env.config.unload_idle_time
+		self._last_active: Dict[bytes, float] = {}
+		self._unload_check_time: float = 0
 
 	async def start(self):
 		self.env.event_bus.add_listener("action.torrent.remove", self._on_torrent_remove, scope=self)
+		self.env.event_bus.add_listener("request.torrent.load", self._on_torrent_load, scope=self)
+
+		# only the index at startup. metadata and bitfields are loaded later
+		loop = asyncio.get_running_loop()
+		save_data = await loop.run_in_executor(None, self._store.load)
+		for data in save_data.values():
+			_import_torrent_data(self.env, data)
 
-		active_path = Path(self.env.config.active_folder)
-		await _load_local(self.env, active_path)
+		# load active torrents in background. the rest is loaded on demand
+		self.add_task(self._load_active())
 
 	def close(self):
 		to_save = self.env.data_storage.get_collection(TorrentEC).entities
 		for torrent_entity in to_save:
-			path = _path_from_entity(self.env, torrent_entity)
-			save_data = _export_torrent_data(torrent_entity)
-			_save(path, save_data)
+			_save(self._store, _export_torrent_data(self.env, torrent_entity), _get_files(torrent_entity))
+		self._store.close()
 		super().close()
 
 	async def _update(self, delta_time: float):
@@ -43,51 +64,179 @@ class LocalDataSystem(System):
 		to_save = self.collection.entities
 		for entity in to_save:
 			entity.remove_component(SaveTorrentEC)
-			self.add_task(_save_local(self.env, entity))
+			self.add_task(self._save_local(entity))
+
+		# unload idle torrents
+		self._unload_check_time += delta_time
+		if self._unload_idle_time > 0 and self._unload_check_time >= UNLOAD_CHECK_TIME:
+			self._unload_check_time = 0
+			self._unload_idle()
+
+	async def _save_local(self, torrent_entity: Entity):
+		loop = asyncio.get_running_loop()
+		save_data = _export_torrent_data(self.env, torrent_entity)
+		await loop.run_in_executor(None, _save, self._store, save_data, _get_files(torrent_entity))
 
 	async def _on_torrent_remove(self, info_hash: bytes):
-		path = _path_from_info_hash(self.env, info_hash)
-		if path.exists():
-			os.remove(path)
+		self._last_active.pop(info_hash, None)
+		self._store.remove(info_hash)
+
+	def _unload_idle(self):
+		current_time = time.monotonic()
+		with_peers = set(self.env.peers_index.keys())
+		for torrent_entity in self.env.data_storage.get_collection(TorrentInfoEC).entities:
+			info_hash = torrent_entity.get_component(TorrentEC).info_hash
+			if info_hash in with_peers or is_torrent_validating(torrent_entity):
+				self._last_active[info_hash] = current_time
+				continue
+
+			if current_time - self._last_active.setdefault(info_hash, current_time) >= self._unload_idle_time:
+				self._last_active.pop(info_hash)
+				self.add_task(self._unload(torrent_entity))
+
+	async def _unload(self, torrent_entity: Entity):
+		info_hash = torrent_entity.get_component(TorrentEC).info_hash
+
+		# pieces are still in memory. try next time
+		if any(e.has_component(PieceToSaveEC) for e in iterate_pieces(self.env, info_hash)):
+			return
+
+		# the state on disk is the one to load later
+		await self._save_local(torrent_entity)
+
+		# a peer came in the meantime
+		if (not torrent_entity.is_valid() or not torrent_entity.has_component(TorrentInfoEC)
+				or is_torrent_validating(torrent_entity) or any(iterate_peers(self.env, info_hash))):
+			return
+
+		await asyncio.gather(*self.env.event_bus.dispatch("action.torrent.unload", info_hash))
+
+		torrent_info = torrent_entity.get_component(TorrentInfoEC).info
+		bitfield = torrent_entity.get_component(TorrentEC).bitfield
+		stub = TorrentStubEC(torrent_info.name, calculate_downloaded(torrent_entity), calculate_left(torrent_entity))
+
+		torrent_entity.remove_component(TorrentInfoEC)
+		if torrent_entity.has_component(TorrentDownloadEC):
+			torrent_entity.remove_component(TorrentDownloadEC)
+		bitfield.reset(set())
+		torrent_entity.add_component(stub)
+
+		logger.info(f"Torrent {torrent_info.name} unloaded. No peers for {self._unload_idle_time:.0f} seconds")
+
+	async def _on_torrent_load(self, info_hash: bytes):
+		await self._load(info_hash)
+
+	async def _load_active(self):
+		stubs = list(self.env.data_storage.get_collection(TorrentStubEC).entities)
+		for torrent_entity in stubs:
+			if torrent_entity.is_valid() and torrent_entity.get_component(TorrentStatsEC).state == TorrentState.Active:
+				await self._load(torrent_entity.get_component(TorrentEC).info_hash)
+		logger.info(f"Active torrents loaded. {len(self.env.data_storage.get_collection(TorrentStubEC))} left on disk")
+
+	async def _load(self, info_hash: bytes):
+		# one load per torrent. the rest wait for it
+		task = self._loading.get(info_hash)
+		if not task:
+			task = self._loading[info_hash] = self.add_task(self._load_torrent(info_hash))
+			task.add_done_callback(lambda _: self._loading.pop(info_hash, None))
+		await task
+
+	async def _load_torrent(self, info_hash: bytes):
+		torrent_entity = get_torrent_entity(self.env, info_hash)
+		if not torrent_entity or is_torrent_loaded(torrent_entity):
+			return
+
+		path = torrent_entity.get_component(TorrentPathEC).root_path
+		loop = asyncio.get_running_loop()
+		torrent_info, pieces, to_validate = await loop.run_in_executor(None, self._load_data, info_hash, path)
 
+		# removed in the meantime
+		if not torrent_entity.is_valid():
+			return
 
-async def _load_local(env: Env, active_path: Path):
-	for root, dirs, files in os.walk(active_path):
-		for file_name in files:
-			file_path = Path(root).joinpath(file_name)
-			with open(file_path, 'rb') as f:
-				logger.debug(f"Loading save from {file_path}")
-				save_data = pickle.load(f)
-				_import_torrent_data(env, save_data)
+		if torrent_info:
+			torrent_entity.add_component(TorrentInfoEC(torrent_info))
+		torrent_entity.get_component(TorrentEC).bitfield.reset(pieces)
 
+		# validation could be requested already. it checks everything
+		if to_validate is not None and not is_torrent_validating(torrent_entity):
+			logger.info(f"{len(to_validate)} pieces of {get_torrent_name(torrent_entity)} need validation")
+			torrent_entity.add_component(ValidateTorrentEC(to_validate))
 
-async def _save_local(env: Env, torrent_entity: Entity):
-	loop = asyncio.get_running_loop()
-	path = _path_from_entity(env, torrent_entity)
-	save_data = _export_torrent_data(torrent_entity)
-	await loop.run_in_executor(None, _save, path, save_data)
+		torrent_entity.remove_component(TorrentStubEC)
+		logger.debug(f"Torrent {get_torrent_name(torrent_entity)} loaded")
 
+	def _load_data(self, info_hash: bytes, path: Path) -> Tuple[Optional[TorrentInfo], Set[int], Optional[Set[int]]]:
+		torrent_info = self._store.load_metadata(info_hash)
+		state = self._store.get_state(info_hash)
+		pieces = unpack_pieces(self._store.load_pieces(info_hash) or b'')
 
-def _path_from_info_hash(env, info_hash: bytes) -> Path:
-	active_path = Path(env.config.active_folder)
-	return active_path.joinpath(info_hash.hex())
+		# trust the bitfield for unchanged files. validate the rest
+		to_validate = None
+		if torrent_info:
+			bitfield = Bitfield()
+			bitfield.reset(pieces)
+			to_validate = _pieces_to_validate(
+				torrent_info, path, bitfield, state.get('files_state'), state.get('validate', False))
+		return torrent_info, pieces, to_validate
 
 
-def _path_from_entity(env, torrent_entity: Entity) -> Path:
-	info_hash: bytes = torrent_entity.get_component(TorrentEC).info_hash
-	return _path_from_info_hash(env, info_hash)
+def _get_files(torrent_entity: Entity) -> Optional[Tuple[TorrentInfo, Path]]:
+	if not torrent_entity.has_component(TorrentInfoEC):
+		return None
+	return torrent_entity.get_component(TorrentInfoEC).info, torrent_entity.get_component(TorrentPathEC).root_path
 
 
-def _save(path: Path, save_data: dict[str, Any]):
-	logger.debug(f"Save torrent data: {path}")
-	path.parent.mkdir(parents=True, exist_ok=True)
-	with open(path, 'wb') as f:
-		pickle.dump(save_data, f, pickle.DEFAULT_PROTOCOL)
+def _file_state(path: Path) -> Optional[Tuple[int, int, int]]:
+	try:
+		stat = os.stat(path)
+	except OSError:
+		return None
+	return stat.st_size, stat.st_mtime_ns, stat.st_ino
 
 
-def _export_torrent_data(torrent_entity: Entity) -> dict[str, Any]:
+def _save(store: ResumeStore, save_data: dict[str, Any], files: Optional[Tuple[TorrentInfo, Path]]):
+	# files state at the moment of the bitfield save. used to skip validation on the next start
+	# only files of new pieces could change since the last save
+	if files and 'pieces' in save_data:
+		torrent_info, root = files
+		saved_pieces: Optional[bytes] = store.load_pieces(save_data['info_hash'])
+		all_files = list(torrent_info.files)
+		if saved_pieces is None:
+			changed = range(len(all_files))
+		else:
+			changed = _pieces_to_files(
+				torrent_info, all_files, save_data['pieces'].difference(unpack_pieces(saved_pieces)))
+		save_data['files_state'] = {
+			i: _file_state(torrent_info.get_file_path(root, all_files[i])) for i in changed}
+		save_data['pieces'] = pack_pieces(save_data['pieces'], torrent_info.pieces_num)
+
+	logger.debug(f"Save torrent data: {save_data['info_hash'].hex()}")
+	store.save(save_data['info_hash'], save_data)
+
+
+def _pieces_to_files(torrent_info: TorrentInfo, files: List[FileInfo], pieces: Set[int]) -> Set[int]:
+	# indexes of files the pieces are in
+	piece_length = torrent_info.piece_length
+	size = torrent_info.size
+	starts = [file.start for file in files]
+
+	result: Set[int] = set()
+	for index in pieces:
+		piece_start = index * piece_length
+		piece_end = min(piece_start + piece_length, size)
+		i = max(0, bisect.bisect_right(starts, piece_start) - 1)
+		while i < len(files) and files[i].start < piece_end:
+			if files[i].start + files[i].length > piece_start:
+				result.add(i)
+			i += 1
+	return result
+
+
+def _export_torrent_data(env: Env, torrent_entity: Entity) -> dict[str, Any]:
+	info_hash = torrent_entity.get_component(TorrentEC).info_hash
 	result: dict[str, Any] = {
-		"info_hash": torrent_entity.get_component(TorrentEC).info_hash,
+		"info_hash": info_hash,
 		"peers": torrent_entity.get_component(KnownPeersEC).peers,
 		"path": torrent_entity.get_component(TorrentPathEC).root_path,
 		"stats": torrent_entity.get_component(TorrentStatsEC).export(),
@@ -96,26 +245,63 @@ def _export_torrent_data(torrent_entity: Entity) -> dict[str, Any]:
 	if torrent_entity.has_component(TorrentInfoEC):
 		torrent_info = torrent_entity.get_component(TorrentInfoEC).info
 		result['torrent_info'] = torrent_info
-		result['bitfield'] = torrent_entity.get_component(TorrentEC).bitfield.dump(torrent_info.pieces_num)
+		result['pieces'] = _saved_pieces(env, torrent_entity)
+
+		# the index to show and announce the torrent before it's loaded
+		result['name'] = torrent_info.name
+		result['progress'] = calculate_downloaded(torrent_entity)
+		result['left'] = calculate_left(torrent_entity)
 
 	if torrent_entity.has_component(TorrentTrackerEC):
 		result['announce_list'] = torrent_entity.get_component(TorrentTrackerEC).announce_list
 		result['tracker_data'] = torrent_entity.get_component(TorrentTrackerDataEC).export()
-	result['validate'] = torrent_entity.has_component(ValidateTorrentEC)
+
+	# not loaded torrents keep the saved state
+	if is_torrent_loaded(torrent_entity):
+		result['validate'] = torrent_entity.has_component(ValidateTorrentEC)
 	return result
 
 
+def _saved_pieces(env: Env, torrent_entity: Entity) -> Set[int]:
+	# pieces are in the bitfield before they are written. don't save them until they are on disk
+	info_hash = torrent_entity.get_component(TorrentEC).info_hash
+	not_saved = set(
+		e.get_component(PieceEC).info.index for e in iterate_pieces(env, info_hash) if e.has_component(PieceToSaveEC))
+	return torrent_entity.get_component(TorrentEC).bitfield.difference(not_saved)
+
+
+def _pieces_to_validate(torrent_info: TorrentInfo, root: Path, bitfield: Bitfield,
+                        files_state: Optional[Dict[int, Any]], validate: bool) -> Optional[Set[int]]:
+	all_pieces = set(range(torrent_info.pieces_num))
+
+	# old saves have no files state. check everything if asked
+	if files_state is None:
+		return all_pieces if validate else None
+
+	# check pieces of files changed since the last save
+	result: Set[int] = set()
+	for i, file in enumerate(torrent_info.files):
+		if _file_state(torrent_info.get_file_path(root, file)) != files_state.get(i):
+			result.update(torrent_info.file_to_pieces(file))
+
+	# validation was interrupted. pieces out of the bitfield are not checked yet
+	if validate:
+		result.update(all_pieces.difference(bitfield.intersection(all_pieces)))
+
+	return result or None
+
+
 def _import_torrent_data(env, save_data: dict[str, Any]):
 	# create the basic torrent entity
 	info_hash = save_data.get('info_hash')
 	path = save_data.get('path', Path(env.config.download_folder))
-	torrent_info = save_data.get('torrent_info', None)
 	stats = save_data.get('stats', {})
-	torrent_entity = create_torrent_entity(env, info_hash, path, stats, torrent_info)
 
-	# update bitfield
-	bitfield = save_data.get('bitfield', bytes())
-	torrent_entity.get_component(TorrentEC).bitfield.update(bitfield)
+	# torrents with metadata stay on disk until loaded
+	stub = None
+	if 'name' in save_data:
+		stub = TorrentStubEC(save_data['name'], save_data.get('progress', 0), save_data.get('left', 0))
+	torrent_entity = create_torrent_entity(env, info_hash, path, stats, stub=stub)
 
 	# update peers
 	peers: Set[PeerInfo] = save_data.get('peers', {})
@@ -127,8 +313,3 @@ def _import_torrent_data(env, save_data: dict[str, Any]):
 		torrent_entity.add_component(TorrentTrackerEC(announce_list))
 		tracker_data: Dict[str, Any] = save_data.get('tracker_data', {})
 		torrent_entity.add_component(TorrentTrackerDataEC(**tracker_data))
-
-	# update validate option
-	validate = save_data.get('validate', False)
-	if validate:
-		env.event_bus.dispatch("request.torrent.invalidate", info_hash)
@@ -0,0 +1,196 @@
+import asyncio
+import logging
+import pickle
+from asyncio import Task
+from pathlib import Path
+from typing import Optional, Tuple, Set, List
+
+from angelovich.core.DataStorage import Entity
+
+from yap_torrent.components.piece_ec import PieceEC, PieceToSaveEC
+from yap_torrent.components.torrent_ec import TorrentEC, TorrentInfoEC, TorrentPathEC, TorrentStatsEC, SaveTorrentEC
+from yap_torrent.config import Config
+from yap_torrent.env import Env
+from yap_torrent.protocol import TorrentInfo
+from yap_torrent.storage import Storage
+from yap_torrent.system import TimeSystem
+from yap_torrent.systems import get_torrent_entity, get_torrent_name, is_torrent_validating, iterate_pieces
+from yap_torrent.systems.bt_validation_system import check_pieces
+
+logger = logging.getLogger(__name__)
+
+
+def get_cursor_path(config: Config) -> Path:
+	file_path = Path(config.data_folder)
+	file_path.mkdir(parents=True, exist_ok=True)
+	return file_path.joinpath("scrub")
+
+
+def load_cursor(config: Config) -> Tuple[bytes, int]:
+	file_path = get_cursor_path(config)
+	if not file_path.exists():
+		return bytes(), 0
+
+	try:
+		with open(file_path, "rb") as f:
+			return pickle.load(f)
+	except Exception as ex:
+		logger.warning(f"Can't load scrub position: {ex}")
+		return bytes(), 0
+
+
+def save_cursor(config: Config, cursor: Tuple[bytes, int]):
+	with open(get_cursor_path(config), "wb") as f:
+		pickle.dump(cursor, f)
+
+
+def _split_runs(indexes: Set[int]) -> List[Tuple[int, int]]:
+	# [first, last) ranges of consecutive indexes
+	runs: List[Tuple[int, int]] = []
+	for index in sorted(indexes):
+		if runs and runs[-1][1] == index:
+			runs[-1] = runs[-1][0], index + 1
+		else:
+			runs.append((index, index + 1))
+	return runs
+
+
+def _check_runs(storage: Storage, torrent_info: TorrentInfo, download_path: Path,
+                runs: List[Tuple[int, int]]) -> Set[int]:
+	# missing pieces between the runs are not read
+	verified: Set[int] = set()
+	for first, last in runs:
+		verified.update(check_pieces(storage, torrent_info, download_path, first, last))
+	return verified
+
+
+class ScrubSystem(TimeSystem):
+	# re-hashes stored pieces in rotation. one torrent at a time, a few pieces per update
+	def __init__(self, env: Env):
+		super().__init__(env, 5)
+		config = env.config
+		self._bandwidth: int = config.scrub_bandwidth
+		self._max_load: int = config.scrub_max_load
+
+		# info hash of the torrent and the next piece to check
+		self._cursor: Tuple[bytes, int] = load_cursor(config)
+		self._task: Optional[Task] = None
+		self._last_transferred: float = -1
+		# bytes of the budget left from previous updates. a big piece waits until there's enough for it
+		self._carry: float = 0
+
+	def close(self):
+		save_cursor(self.env.config, self._cursor)
+		super().close()
+
+	async def _update(self, delta_time: float):
+		# upload and download speed of all torrents
+		transferred = sum(
+			stats.session_uploaded + stats.session_downloaded
+			for stats in (e.get_component(TorrentStatsEC) for e in self.env.data_storage.get_collection(TorrentStatsEC)))
+		load = (transferred - self._last_transferred) / delta_time if self._last_transferred >= 0 else 0
+		self._last_transferred = transferred
+
+		if self._bandwidth <= 0:
+			return
+
+		# previous check is still in progress
+		if self._task and not self._task.done():
+			return
+
+		# don't compete with peers for the disk
+		if load > self._max_load:
+			logger.debug(f"Scrub paused. Load {load:.0f} B/s")
+			return
+
+		self._task = self.add_task(self._scrub(self._carry + self._bandwidth * delta_time))
+
+	async def _scrub(self, amount: float):
+		self._carry = 0
+		torrent_entity = self._next_torrent()
+		if not torrent_entity:
+			return
+
+		info_hash, index = self._cursor
+		torrent_info = torrent_entity.get_component(TorrentInfoEC).info
+		download_path = torrent_entity.get_component(TorrentPathEC).root_path
+		bitfield = torrent_entity.get_component(TorrentEC).bitfield
+
+		if index == 0:
+			logger.info(f"Scrub start: {torrent_info.name}")
+
+		pieces = int(amount // torrent_info.piece_length)
+		self._carry = amount - pieces * torrent_info.piece_length
+		if not pieces:
+			return
+
+		end = min(index + pieces, torrent_info.pieces_num)
+		self._cursor = info_hash, end
+
+		# pieces which are not saved yet are not on disk
+		pending = self._pending_pieces(info_hash)
+		to_check: Set[int] = set(i for i in range(index, end) if bitfield.have_index(i) and i not in pending)
+		if not to_check:
+			return
+
+		loop = asyncio.get_running_loop()
+		verified = await loop.run_in_executor(
+			None, _check_runs, self.env.storage, torrent_info, download_path, _split_runs(to_check))
+
+		# validation or removal started in the meantime
+		if not torrent_entity.is_valid() or is_torrent_validating(torrent_entity):
+			return
+
+		pending = self._pending_pieces(info_hash)
+		for corrupted in sorted(to_check.difference(verified).difference(pending)):
+			self._on_corrupted(torrent_entity, corrupted)
+
+		if end >= torrent_info.pieces_num:
+			logger.info(f"Scrub complete: {torrent_info.name}")
+
+	def _next_torrent(self) -> Optional[Entity]:
+		info_hash, index = self._cursor
+		torrent_entity = get_torrent_entity(self.env, info_hash) if info_hash else None
+		if torrent_entity and self._can_scrub(torrent_entity) \
+				and index < torrent_entity.get_component(TorrentInfoEC).info.pieces_num:
+			return torrent_entity
+
+		# move to the next torrent in rotation
+		torrents = sorted(
+			(e for e in self.env.data_storage.get_collection(TorrentEC).entities if self._can_scrub(e)),
+			key=lambda e: e.get_component(TorrentEC).info_hash)
+		if not torrents:
+			return None
+
+		torrent_entity = next((e for e in torrents if e.get_component(TorrentEC).info_hash > info_hash), torrents[0])
+		self._cursor = torrent_entity.get_component(TorrentEC).info_hash, 0
+		save_cursor(self.env.config, self._cursor)
+		return torrent_entity
+
+	@staticmethod
+	def _can_scrub(torrent_entity: Entity) -> bool:
+		return (torrent_entity.has_component(TorrentInfoEC)
+		        and not is_torrent_validating(torrent_entity)
+		        and torrent_entity.get_component(TorrentEC).bitfield.have_num > 0)
+
+	def _pending_pieces(self, info_hash: bytes) -> Set[int]:
+		return set(
+			e.get_component(PieceEC).info.index for e in iterate_pieces(self.env, info_hash)
+			if e.has_component(PieceToSaveEC))
+
+	def _on_corrupted(self, torrent_entity: Entity, index: int):
+		logger.warning(f"Corrupted piece {index} found in {get_torrent_name(torrent_entity)}")
+
+		# the piece is still in memory. write it again
+		info_hash = torrent_entity.get_component(TorrentEC).info_hash
+		piece_entity = self.env.data_storage.get_collection(PieceEC).find(PieceEC.make_hash(info_hash, index))
+		if piece_entity and piece_entity.get_component(PieceEC).completed:
+			if not piece_entity.has_component(PieceToSaveEC):
+				piece_entity.add_component(PieceToSaveEC())
+			return
+
+		# download it again
+		torrent_entity.get_component(TorrentEC).bitfield.remove_index(index)
+		if not torrent_entity.has_component(SaveTorrentEC):
+			torrent_entity.add_component(SaveTorrentEC())
+		self.env.event_bus.dispatch("piece.corrupted", torrent_entity, index)
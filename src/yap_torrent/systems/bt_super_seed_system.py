@@ -0,0 +1,153 @@
+import logging
+import random
+from typing import Dict, Optional, Set, List
+
+from angelovich.core.DataStorage import Entity
+
+from yap_torrent.components.peer_ec import PeerConnectionEC
+from yap_torrent.components.torrent_ec import TorrentEC, TorrentInfoEC, SuperSeedEC
+from yap_torrent.protocol import bt_main_messages as msg
+from yap_torrent.protocol.message import Message
+from yap_torrent.protocol.structures import Bitfield
+from yap_torrent.system import System
+from yap_torrent.systems import iterate_peers, get_super_seed, get_torrent_name, get_torrent_entity, \
+	is_torrent_complete
+
+logger = logging.getLogger(__name__)
+
+
+class SuperSeedSystem(System):
+	# a super-seed offers a peer a single piece with a HAVE message. the next one is offered only after
+	# the piece shows up on another peer. this way each piece is uploaded about once until the swarm has a copy
+	_SPREAD_MESSAGES = (msg.MessageId.HAVE.value, msg.MessageId.BITFIELD.value)
+
+	async def start(self):
+		self.env.event_bus.add_listener("peer.connected", self.__on_peer_connected, scope=self)
+		self.env.event_bus.add_listener("peer.message", self.__on_message, scope=self)
+		self.env.event_bus.add_listener("action.torrent.complete", self.__on_torrent_changed, scope=self)
+		self.env.event_bus.add_listener("action.torrent.start", self.__on_torrent_start, scope=self)
+		self.env.event_bus.add_listener("piece.corrupted", self.__on_torrent_changed, scope=self)
+		self.env.event_bus.add_listener("torrent.validation.start", self.__on_torrent_changed, scope=self)
+		await self._update(0)
+
+	def close(self) -> None:
+		self.env.event_bus.remove_all_listeners(scope=self)
+		super().close()
+
+	async def _update(self, delta_time: float):
+		# torrents loaded complete don't send events
+		for torrent_entity in self.env.data_storage.get_collection(TorrentEC):
+			self._update_state(torrent_entity)
+
+	async def __on_torrent_start(self, info_hash: bytes):
+		torrent_entity = get_torrent_entity(self.env, info_hash)
+		if torrent_entity:
+			self._update_state(torrent_entity)
+
+	async def __on_torrent_changed(self, torrent_entity: Entity, *_):
+		self._update_state(torrent_entity)
+
+	def _update_state(self, torrent_entity: Entity) -> None:
+		# only a complete torrent is super-seeded. a corrupted piece or a validation ends it
+		complete = torrent_entity.has_component(TorrentInfoEC) and is_torrent_complete(torrent_entity)
+		if torrent_entity.has_component(SuperSeedEC):
+			if not complete:
+				torrent_entity.remove_component(SuperSeedEC)
+		elif complete and self.env.config.super_seeding:
+			torrent_entity.add_component(SuperSeedEC())
+
+	async def __on_peer_connected(self, torrent_entity: Entity, peer_entity: Entity) -> None:
+		super_seed_ec = get_super_seed(torrent_entity)
+		if not super_seed_ec:
+			return
+		# a reconnected peer starts over
+		super_seed_ec.forget(peer_entity.get_component(PeerConnectionEC).peer_info.host)
+		await self._offer(torrent_entity, super_seed_ec, peer_entity)
+
+	async def __on_message(self, torrent_entity: Entity, peer_entity: Entity, message: Message):
+		if message.message_id not in self._SPREAD_MESSAGES:
+			return
+		super_seed_ec = get_super_seed(torrent_entity)
+		if not super_seed_ec:
+			return
+
+		if message.message_id == msg.MessageId.HAVE.value:
+			await self._on_peer_has(torrent_entity, super_seed_ec, peer_entity, {msg.payload_index(message)}, False)
+		else:
+			pieces_num = torrent_entity.get_component(TorrentInfoEC).info.pieces_num
+			indexes = Bitfield().update(msg.payload_bitfield(message)).intersection(set(range(pieces_num)))
+			await self._on_peer_has(torrent_entity, super_seed_ec, peer_entity, indexes, True)
+
+	async def _on_peer_has(self, torrent_entity: Entity, super_seed_ec: SuperSeedEC, source_entity: Entity,
+	                       indexes: Set[int], from_bitfield: bool) -> None:
+		source_host = source_entity.get_component(PeerConnectionEC).peer_info.host
+		info_hash = torrent_entity.get_component(TorrentEC).info_hash
+
+		# peers which got the piece from us and shared it deserve the next one
+		waiting: Dict[int, List[Entity]] = {}
+		for peer_entity in iterate_peers(self.env, info_hash):
+			host = peer_entity.get_component(PeerConnectionEC).peer_info.host
+			index = super_seed_ec.offered.get(host)
+			if index is not None and host != source_host:
+				waiting.setdefault(index, []).append(peer_entity)
+
+		for index in sorted(indexes):
+			if super_seed_ec.offered.get(source_host) == index:
+				# it's the peer we gave the piece to. wait until someone else has it
+				continue
+			super_seed_ec.spread.add(index)
+			for peer_entity in waiting.pop(index, ()):
+				await self._offer(torrent_entity, super_seed_ec, peer_entity)
+
+		# the source peer may already have what we offered it. a bitfield comes after the first offer
+		offered = super_seed_ec.offered.get(source_host)
+		if offered in super_seed_ec.spread or (from_bitfield and offered in indexes):
+			await self._offer(torrent_entity, super_seed_ec, source_entity)
+
+		info = torrent_entity.get_component(TorrentInfoEC).info
+		if len(super_seed_ec.spread) >= info.pieces_num:
+			await self._finish(torrent_entity, super_seed_ec)
+
+	async def _offer(self, torrent_entity: Entity, super_seed_ec: SuperSeedEC, peer_entity: Entity) -> None:
+		peer_connection_ec = peer_entity.get_component(PeerConnectionEC)
+		index = self._select_piece(torrent_entity, super_seed_ec, peer_connection_ec)
+		if index is None:
+			super_seed_ec.offered.pop(peer_connection_ec.peer_info.host, None)
+			return
+		super_seed_ec.offer(peer_connection_ec.peer_info.host, index)
+		await peer_connection_ec.connection.send(msg.have(index))
+		logger.debug("Super-seed offers piece %s to %s", index, peer_connection_ec)
+
+	def _select_piece(self, torrent_entity: Entity, super_seed_ec: SuperSeedEC,
+	                  peer_connection_ec: PeerConnectionEC) -> Optional[int]:
+		info = torrent_entity.get_component(TorrentInfoEC).info
+		remote_bitfield = peer_connection_ec.remote_bitfield
+		announced = super_seed_ec.announced.get(peer_connection_ec.peer_info.host, set())
+		pieces = [i for i in range(info.pieces_num) if not remote_bitfield.have_index(i) and i not in announced]
+		if not pieces:
+			return None
+
+		# pieces offered the least times first, then the rarest among connected peers
+		least = min(super_seed_ec.offers.get(i, 0) for i in pieces)
+		pieces = [i for i in pieces if super_seed_ec.offers.get(i, 0) == least]
+
+		info_hash = torrent_entity.get_component(TorrentEC).info_hash
+		bitfields = [p.get_component(PeerConnectionEC).remote_bitfield for p in iterate_peers(self.env, info_hash)]
+		counters = {i: sum(1 for b in bitfields if b.have_index(i)) for i in pieces}
+		rarest = min(counters.values())
+		return random.choice([i for i, count in counters.items() if count == rarest])
+
+	async def _finish(self, torrent_entity: Entity, super_seed_ec: SuperSeedEC) -> None:
+		super_seed_ec.finished = True
+		logger.info(f"Super-seeding of {get_torrent_name(torrent_entity)} is complete. Every piece has spread")
+
+		# tell connected peers about everything we have
+		info = torrent_entity.get_component(TorrentInfoEC).info
+		info_hash = torrent_entity.get_component(TorrentEC).info_hash
+		for peer_entity in iterate_peers(self.env, info_hash):
+			peer_connection_ec = peer_entity.get_component(PeerConnectionEC)
+			announced = super_seed_ec.announced.get(peer_connection_ec.peer_info.host, set())
+			for index in range(info.pieces_num):
+				if index in announced or peer_connection_ec.remote_bitfield.have_index(index):
+					continue
+				await peer_connection_ec.connection.send(msg.have(index))
@@ -3,28 +3,41 @@ from pathlib import Path
 
 from angelovich.core.DataStorage import Entity
 
-from yap_torrent.components.peer_ec import PeerConnectionEC
+from yap_torrent.components.peer_ec import PeerConnectionEC, PeerStatsEC, UploadQueueEC
 from yap_torrent.components.piece_ec import PieceEC, PiecePendingRemoveEC
 from yap_torrent.components.torrent_ec import TorrentEC, TorrentInfoEC, TorrentStatsEC
 from yap_torrent.env import Env
 from yap_torrent.protocol import bt_main_messages as msg
 from yap_torrent.protocol.message import Message
+from yap_torrent.protocol.structures import PieceBlockInfo
 from yap_torrent.system import System
-from yap_torrent.utils import load_piece, check_hash
+from yap_torrent.systems import get_super_seed
+from yap_torrent.utils import check_hash
 
 logger = logging.getLogger(__name__)
 
 
+# the largest block a peer can ask for
+MAX_BLOCK_LENGTH = 2 ** 17
+
+
 class BTUploadSystem(System):
 	_UPLOAD_MESSAGES = (msg.MessageId.REQUEST.value, msg.MessageId.CANCEL.value)
 
 	async def start(self):
 		self.env.event_bus.add_listener("peer.message", self.__on_message, scope=self)
-		self.env.event_bus.add_listener("peer.remote.interested_changed", self.__on_remote_peer_changed, scope=self)
-		self.env.event_bus.add_listener("peer.remote.choked_changed", self.__on_remote_peer_changed, scope=self)
+		self.env.event_bus.add_listener("peer.remote.choked_changed", self.__on_remote_choked_changed, scope=self)
+
+	def close(self) -> None:
+		self.env.event_bus.remove_all_listeners(scope=self)
+		super().close()
 
-	async def __on_remote_peer_changed(self, torrent_entity: Entity, peer_entity: Entity) -> None:
-		pass
+	async def __on_remote_choked_changed(self, torrent_entity: Entity, peer_entity: Entity) -> None:
+		# a choke drops all requests. the peer asks again after the unchoke
+		if peer_entity.get_component(PeerConnectionEC).remote_choked:
+			upload_queue_ec = peer_entity.get_component(UploadQueueEC)
+			self._count_dropped("choked", len(upload_queue_ec))
+			upload_queue_ec.clear()
 
 	async def __on_message(self, torrent_entity: Entity, peer_entity: Entity, message: Message):
 		if message.message_id not in self._UPLOAD_MESSAGES:
@@ -32,26 +45,108 @@ class BTUploadSystem(System):
 
 		message_id = msg.MessageId(message.message_id)
 		if message_id == msg.MessageId.REQUEST:
-			await _process_request_message(self.env, peer_entity, torrent_entity, message)
+			self._process_request_message(peer_entity, torrent_entity, message)
 		elif message_id == msg.MessageId.CANCEL:
-			pass
+			index, begin, length = msg.payload_cancel(message)
+			if peer_entity.get_component(UploadQueueEC).cancel(PieceBlockInfo(index, begin, length)):
+				self._count_dropped("cancelled")
+
+	def _process_request_message(self, peer_entity: Entity, torrent_entity: Entity, message: Message):
+		torrent_info = torrent_entity.get_component(TorrentInfoEC).info
+		peer_connection_ec = peer_entity.get_component(PeerConnectionEC)
+		upload_queue_ec = peer_entity.get_component(UploadQueueEC)
+
+		index, begin, length = msg.payload_request(message)
 
+		if peer_connection_ec.remote_choked:
+			logger.debug(f"{peer_connection_ec} requests piece {index} while choked")
+			self._count_dropped("choked")
+			return
+
+		if length > MAX_BLOCK_LENGTH:
+			logger.debug(f"{peer_connection_ec} requests a block of {length} bytes")
+			self._count_dropped("invalid")
+			return
+
+		if not torrent_entity.get_component(TorrentEC).bitfield.have_index(index):
+			logger.debug(f"Piece {index} in {torrent_info.name} is requested but not downloaded yet")
+			self._count_dropped("invalid")
+			return
 
-async def _process_request_message(env: Env, peer_entity: Entity, torrent_entity: Entity, message: Message):
+		super_seed_ec = get_super_seed(torrent_entity)
+		if super_seed_ec and not super_seed_ec.is_announced(peer_connection_ec.peer_info.host, index):
+			logger.debug(f"Piece {index} in {torrent_info.name} is requested but not offered to {peer_connection_ec}")
+			self._count_dropped("invalid")
+			return
+
+		if upload_queue_ec.is_full:
+			logger.debug(f"Upload queue of {peer_connection_ec} is full")
+			self._count_dropped("queue_full")
+			return
+
+		upload_queue_ec.add(PieceBlockInfo(index, begin, length))
+		if not upload_queue_ec.task or upload_queue_ec.task.done():
+			upload_queue_ec.task = self.add_task(self._send_blocks(torrent_entity, peer_entity))
+
+	async def _send_blocks(self, torrent_entity: Entity, peer_entity: Entity):
+		upload_queue_ec = peer_entity.get_component(UploadQueueEC)
+		# the queue can be cleared or cancelled while a block is sent
+		while peer_entity.is_valid() and len(upload_queue_ec):
+			block = upload_queue_ec.pop()
+			# validation can take the piece back while the request waits
+			if not torrent_entity.get_component(TorrentEC).bitfield.have_index(block.index):
+				self._count_dropped("invalid")
+				continue
+			await _send_block(self.env, peer_entity, torrent_entity, block)
+
+	def _count_dropped(self, reason: str, amount: int = 1) -> None:
+		if amount:
+			self.env.metrics.counter(
+				"yap_torrent_upload_requests_dropped_total", "Block requests of peers which were not served",
+				reason=reason).inc(amount)
+
+
+async def _send_block(env: Env, peer_entity: Entity, torrent_entity: Entity, block: PieceBlockInfo):
 	ds = env.data_storage
 	config = env.config
 	info_hash = torrent_entity.get_component(TorrentEC).info_hash
 	torrent_info = torrent_entity.get_component(TorrentInfoEC).info
-	connection = peer_entity.get_component(PeerConnectionEC).connection
-
-	index, begin, length = msg.payload_request(message)
+	peer_connection_ec = peer_entity.get_component(PeerConnectionEC)
+	connection = peer_connection_ec.connection
+	index, begin, length = block.index, block.begin, block.length
 
 	piece_entity = ds.get_collection(PieceEC).find(PieceEC.make_hash(info_hash, index))
+	root = Path(config.download_folder)
+	if piece_entity:
+		env.metrics.counter("yap_torrent_piece_cache_hits_total", "Requests served from cached pieces").inc()
+	else:
+		env.metrics.counter("yap_torrent_piece_cache_misses_total", "Requests served from the storage").inc()
+
+	# send the block straight from the storage if it can do it.
+	# such blocks are not hashed again, the scrubber checks stored pieces in the background
+	if not piece_entity and config.use_sendfile:
+		block_file = env.storage.open_block(root, torrent_info, index, begin, length)
+		if block_file is not None:
+			file, offset = block_file
+			with file:
+				await env.bandwidth.upload.acquire(length, info_hash, peer_connection_ec.upload_bucket)
+				await connection.send_file(msg.piece_header(index, begin), file, offset, length)
+			torrent_entity.get_component(TorrentStatsEC).update_uploaded(length)
+			peer_entity.get_component(PeerStatsEC).on_upload(length)
+			return
+
+	if not piece_entity:
+		chunk = env.storage.read_block(root, torrent_info, index, begin, length)
+		if chunk is not None:
+			await env.bandwidth.upload.acquire(length, info_hash, peer_connection_ec.upload_bucket)
+			await connection.send_chunks(msg.piece_header(index, begin), chunk)
+			torrent_entity.get_component(TorrentStatsEC).update_uploaded(length)
+			peer_entity.get_component(PeerStatsEC).on_upload(length)
+			return
 
 	# load piece
 	if not piece_entity:
-		root = Path(config.download_folder)
-		data = load_piece(root, torrent_info, index)
+		data = env.storage.load_piece(root, torrent_info, index)
 
 		piece_info = torrent_entity.get_component(TorrentInfoEC).info.get_piece_info(index)
 		piece_ec = PieceEC(info_hash, piece_info)
@@ -73,5 +168,7 @@ async def _process_request_message(env: Env, peer_entity: Entity, torrent_entity
 	data = piece_ec.get_block(begin, length)
 	piece_entity.get_component(PiecePendingRemoveEC).update()
 
+	await env.bandwidth.upload.acquire(length, info_hash, peer_connection_ec.upload_bucket)
 	await connection.send(msg.piece(index, begin, data))
 	torrent_entity.get_component(TorrentStatsEC).update_uploaded(length)
+	peer_entity.get_component(PeerStatsEC).on_upload(length)
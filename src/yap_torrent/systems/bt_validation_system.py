@@ -1,120 +1,392 @@
 import asyncio
+import bisect
+import errno
+import functools
+import hashlib
 import logging
-import math
+import os
+import time
 from asyncio import Task
+from concurrent.futures import ProcessPoolExecutor, BrokenExecutor
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Set, Optional
+from typing import Set, Optional, Dict, Tuple, List, BinaryIO, Iterator
+
+from angelovich.core.DataStorage import Entity
 
 from yap_torrent.components.torrent_ec import TorrentPathEC, ValidateTorrentEC, TorrentInfoEC, SaveTorrentEC, TorrentEC, \
 	TorrentStatsEC, TorrentState
 from yap_torrent.env import Env
 from yap_torrent.protocol import TorrentInfo
+from yap_torrent.protocol.structures import FileInfo
+from yap_torrent.storage import Storage
 from yap_torrent.system import System
-from yap_torrent.systems import calculate_downloaded, get_torrent_entity
-from yap_torrent.utils import check_hash, execute_in_pool
+from yap_torrent.systems import calculate_downloaded, get_torrent_entity, is_torrent_loaded
+from yap_torrent.utils import check_hash
 
 logger = logging.getLogger(__name__)
 
+# bytes to hash in one worker call
+CHUNK_SIZE = 2 ** 25
+# seconds before a failed validation starts again. doubles after each failure
+RETRY_TIME = 10
+MAX_RETRY_TIME = 60 * 10
+
+
+class _IOBudget:
+	def __init__(self, bytes_per_second: int):
+		self.bytes_per_second = bytes_per_second
+		self._next_time: float = 0
+
+	async def acquire(self, amount: int):
+		# 0 means no limit
+		if self.bytes_per_second <= 0:
+			return
+
+		# reserve the next time slot. all validations share the same budget
+		current_time = time.monotonic()
+		start_time = max(current_time, self._next_time)
+		self._next_time = start_time + amount / self.bytes_per_second
+		if start_time > current_time:
+			await asyncio.sleep(start_time - current_time)
+
 
 class ValidationSystem(System):
 	def __init__(self, env: Env):
 		super().__init__(env)
+		config = env.config
 
 		self._collection = self.env.data_storage.get_collection(ValidateTorrentEC)
-		self._task: Optional[Task[Set[int]]] = None
+		self._validations: Dict[bytes, Task] = {}
+
+		self._workers_num: int = config.validation_workers
+		self._workers = asyncio.Semaphore(self._workers_num)
+		self._budget = _IOBudget(config.validation_bandwidth)
+		self._pool: Optional[ProcessPoolExecutor] = None
+
+		self._hash_queue = env.metrics.gauge("yap_torrent_hash_queue_pieces", "Pieces waiting for validation")
 
 	async def start(self):
 		self.env.event_bus.add_listener("request.torrent.invalidate", self._on_torrent_invalidate, scope=self)
+		self.env.event_bus.add_listener("action.torrent.remove", self._on_torrent_remove, scope=self)
+		self._collection.add_listener(self._collection.EVENT_ADDED, self.__on_validate_added, self)
+
+	async def __on_validate_added(self, *_):
+		self.wake()
 
 	async def _on_torrent_invalidate(self, info_hash: bytes):
 		torrent_entity = get_torrent_entity(self.env, info_hash)
+
+		# nothing to validate without metadata
+		if not is_torrent_loaded(torrent_entity):
+			await asyncio.gather(*self.env.event_bus.dispatch("request.torrent.load", info_hash))
+
+		# peers stay connected. they get verified pieces while validation goes on
 		torrent_entity.add_component(ValidateTorrentEC())
-		self.env.event_bus.dispatch("action.torrent.stop", info_hash)
+
+	async def _on_torrent_remove(self, info_hash: bytes):
+		task = self._validations.pop(info_hash, None)
+		if task:
+			task.cancel()
 
 	def close(self):
 		self.env.event_bus.remove_all_listeners(scope=self)
-		if self._task:
-			self._task.cancel()
+		self._collection.remove_all_listeners(self)
+		for task in self._validations.values():
+			task.cancel()
+		if self._pool:
+			self._pool.shutdown(wait=False, cancel_futures=True)
 		super().close()
 
 	async def _update(self, delta_time: float):
-		# some validation in process
-		if self._task:
-			return
-
+		now = time.monotonic()
 		for torrent_entity in self._collection.entities:
+			# validate a few torrents at once
+			if len(self._validations) >= self.env.config.max_validations:
+				break
 
-			torrent_info = torrent_entity.get_component(TorrentInfoEC).info
-			download_path = torrent_entity.get_component(TorrentPathEC).root_path
+			info_hash = torrent_entity.get_component(TorrentEC).info_hash
+			if info_hash in self._validations:
+				continue
 
-			def reset_task(_task: Task[Set[int]]):
-				self._task = None
-				if _task.cancelled():
-					return
+			# nothing to validate without metadata
+			if not torrent_entity.has_component(TorrentInfoEC):
+				continue
+
+			# failed before. wait a bit
+			if now < torrent_entity.get_component(ValidateTorrentEC).retry_time:
+				continue
+
+			task = self.add_task(self._try_validate(torrent_entity))
+			task.add_done_callback(lambda _, key=info_hash: self._validations.pop(key, None))
+			self._validations[info_hash] = task
+
+	async def _try_validate(self, torrent_entity: Entity):
+		try:
+			await self._validate(torrent_entity)
+		except Exception as ex:
+			validate_ec = torrent_entity.get_component(ValidateTorrentEC)
+			if not validate_ec:
+				return
+			validate_ec.fails += 1
+			delay = min(RETRY_TIME * 2 ** (validate_ec.fails - 1), MAX_RETRY_TIME)
+			validate_ec.retry_time = time.monotonic() + delay
+			logger.exception(f"Validation of {torrent_entity.get_component(TorrentInfoEC).info.name} failed "
+			                 f"by {ex!r}. Next try in {delay}s")
+
+			# worker processes are gone. start new ones next time
+			if isinstance(ex, BrokenExecutor) and self._pool:
+				self._pool.shutdown(wait=False, cancel_futures=True)
+				self._pool = None
 
-				torrent_entity.get_component(TorrentEC).bitfield.reset(_task.result())
+	async def _validate(self, torrent_entity: Entity):
+		info_hash = torrent_entity.get_component(TorrentEC).info_hash
+		torrent_info = torrent_entity.get_component(TorrentInfoEC).info
+		download_path = torrent_entity.get_component(TorrentPathEC).root_path
+		validate_ec = torrent_entity.get_component(ValidateTorrentEC)
 
-				# save torrent to local data
-				torrent_entity.add_component(SaveTorrentEC())
+		# keep pieces we don't need to check
+		pieces = validate_ec.pieces
+		if pieces is None:
+			pieces = set(range(torrent_info.pieces_num))
+		result: Set[int] = torrent_entity.get_component(TorrentEC).bitfield.difference(pieces)
 
-				# reset validate flag
-				torrent_entity.remove_component(ValidateTorrentEC)
+		logger.info(f"Validation start: {torrent_info.name}. {len(pieces)} pieces to check")
+		torrent_entity.get_component(TorrentEC).bitfield.reset(set(result))
+		await asyncio.gather(*self.env.event_bus.dispatch("torrent.validation.start", torrent_entity))
+
+		pieces_num = len(pieces)
+		validate_ec.reset(pieces_num)
+
+		files = list(torrent_info.files)
+		chunks = _split_chunks(torrent_info, pieces)
+		self._hash_queue.inc(pieces_num)
+
+		async def worker():
+			for first, last in chunks:
+				async with self._workers:
+					await self._budget.acquire(torrent_info.piece_length * (last - first))
+					verified = await self._check_range(torrent_info, download_path, files, first, last)
+
+				# publish verified pieces right away. the torrent can serve them while validation goes on
+				result.update(verified)
+				if verified and torrent_entity.is_valid():
+					bitfield = torrent_entity.get_component(TorrentEC).bitfield
+					for index in verified:
+						bitfield.set_index(index)
+					self.env.event_bus.dispatch("torrent.validation.pieces", torrent_entity, verified)
+
+				validate_ec.checked += last - first
+				self._hash_queue.dec(last - first)
+				self.env.event_bus.dispatch(
+					"torrent.validation.progress", info_hash, validate_ec.checked, pieces_num - validate_ec.checked)
+
+		workers = [asyncio.create_task(worker()) for _ in range(self._workers_num)]
+		try:
+			await asyncio.gather(*workers)
+		finally:
+			# one worker failed. stop the others
+			for task in workers:
+				task.cancel()
+			# cancelled. pieces left are not in the queue anymore
+			self._hash_queue.dec(pieces_num - validate_ec.checked)
 
-				# start torrent if needed
-				if torrent_entity.get_component(TorrentStatsEC).state == TorrentState.Active:
-					info_hash = torrent_entity.get_component(TorrentEC).info_hash
-					self.env.event_bus.dispatch("action.torrent.start", info_hash)
+		torrent_entity.get_component(TorrentEC).bitfield.reset(result)
 
-				logger.info(
-					f"Validation complete: {torrent_info.name}. {calculate_downloaded(torrent_entity):.2%} downloaded")
+		# save torrent to local data
+		torrent_entity.add_component(SaveTorrentEC())
 
-			logger.info(f"Validation start: {torrent_info.name}")
+		# reset validate flag
+		torrent_entity.remove_component(ValidateTorrentEC)
 
-			torrent_entity.get_component(TorrentEC).bitfield.reset(set())
+		# start torrent if needed
+		if torrent_entity.get_component(TorrentStatsEC).state == TorrentState.Active:
+			self.env.event_bus.dispatch("action.torrent.start", info_hash)
 
-			task = asyncio.create_task(execute_in_pool(_check_torrent, torrent_info, download_path))
-			task.add_done_callback(reset_task)
-			self._task = task
+		logger.info(
+			f"Validation complete: {torrent_info.name}. {calculate_downloaded(torrent_entity):.2%} downloaded")
 
+	async def _check_range(self, torrent_info: TorrentInfo, download_path: Path, files: List[FileInfo],
+	                       first: int, last: int) -> Set[int]:
+		loop = asyncio.get_running_loop()
+		storage = self.env.storage
+		if not storage.on_disk:
+			return await loop.run_in_executor(None, _check_storage, storage, torrent_info, download_path, first, last)
+
+		if not self._pool:
+			self._pool = ProcessPoolExecutor(self._workers_num)
+		chunk = _make_chunk(torrent_info, download_path, files, first, last)
+		return await loop.run_in_executor(self._pool, _check_chunk, chunk)
+
+
+@dataclass(frozen=True, slots=True)
+class _ValidationChunk:
+	# everything a worker process needs to check pieces [first, last) without the whole torrent info
+	first: int
+	last: int
+	piece_length: int
+	size: int
+	hashes: bytes
+	files: Tuple[Tuple[str, int, int], ...]  # path, start, length
+
+
+def _split_chunks(torrent_info: TorrentInfo, pieces: Set[int]) -> Iterator[Tuple[int, int]]:
+	# group pieces into continuous ranges no longer than a chunk
+	pieces_per_chunk = max(1, CHUNK_SIZE // max(1, torrent_info.piece_length))
+	first = last = -1
+	for index in sorted(pieces):
+		if index == last and last - first < pieces_per_chunk:
+			last += 1
+			continue
+		if first >= 0:
+			yield first, last
+		first, last = index, index + 1
+	if first >= 0:
+		yield first, last
+
+
+def _make_chunk(torrent_info: TorrentInfo, download_path: Path, files: List[FileInfo],
+                first: int, last: int) -> _ValidationChunk:
+	piece_length = torrent_info.piece_length
+	size = torrent_info.size
+	chunk_start = first * piece_length
+	chunk_end = min(last * piece_length, size)
+
+	# files are sorted by start. find the first file in the range
+	file_index = max(0, bisect.bisect_right(files, chunk_start, key=lambda f: f.start) - 1)
+	chunk_files: List[Tuple[str, int, int]] = []
+	for file in files[file_index:]:
+		if file.start >= chunk_end:
 			break
+		if file.start + file.length <= chunk_start:
+			continue
+		chunk_files.append((str(torrent_info.get_file_path(download_path, file)), file.start, file.length))
 
+	return _ValidationChunk(
+		first, last, piece_length, size, torrent_info.get_pieces_hashes(first, last), tuple(chunk_files))
 
-def _check_torrent(torrent_info: TorrentInfo, download_path: Path) -> Set[int]:
-	piece_length: int = torrent_info.piece_length
+
+def _check_chunk(chunk: _ValidationChunk) -> Set[int]:
 	bitfield_data: Set[int] = set()
+	files = chunk.files
+	handles: Dict[str, BinaryIO] = {}
+	data_ranges: Dict[str, Optional[List[Tuple[int, int]]]] = {}
+	missing: Set[str] = set()
 
-	buffer: bytearray = bytearray()
-	for file in torrent_info.files:
-		try:
-			path = torrent_info.get_file_path(download_path, file)
-			if not path.exists():
-				buffer.clear()
-				continue
+	# only the part of a file inside the chunk is scanned for holes
+	chunk_start = chunk.first * chunk.piece_length
+	chunk_end = min(chunk.last * chunk.piece_length, chunk.size)
 
-			with open(path, "rb") as f:
-				bytes_left = file.length
-				if not buffer:
-					index: int = math.ceil(file.start / piece_length)
-					current_piece_length = torrent_info.calculate_piece_size(index)
-					offset = index * piece_length - file.start
-					f.seek(offset)
-					bytes_left -= offset
-				while bytes_left > 0:
-					bytes_to_read = min(bytes_left, current_piece_length)
-					buffer.extend(f.read(bytes_to_read))
-					bytes_left -= bytes_to_read
-					current_piece_length -= bytes_to_read
-
-					if current_piece_length > 0:
-						continue
-
-					if check_hash(bytes(buffer), torrent_info.get_piece_hash(index)):
-						bitfield_data.add(index)
-
-					buffer.clear()
-					index += 1
-					current_piece_length = torrent_info.calculate_piece_size(index)
-		except Exception as ex:
-			logger.error(f"Error while validating torrent {download_path}: {ex}")
+	file_index = 0
+	try:
+		for index in range(chunk.first, chunk.last):
+			piece_start = index * chunk.piece_length
+			piece_end = min(piece_start + chunk.piece_length, chunk.size)
+
+			# skip files before the piece
+			while file_index < len(files) and files[file_index][1] + files[file_index][2] <= piece_start:
+				file_index += 1
+
+			# file parts of the piece: path, offset in the file, length
+			parts: List[Tuple[str, int, int]] = []
+			i = file_index
+			while i < len(files) and files[i][1] < piece_end:
+				path, file_start, file_length = files[i]
+				i += 1
+
+				start_pos = max(piece_start, file_start)
+				end_pos = min(piece_end, file_start + file_length)
+				if start_pos >= end_pos:
+					continue
+
+				if path not in handles and path not in missing:
+					try:
+						handles[path] = open(path, "rb")
+						data_ranges[path] = _data_ranges(
+							handles[path].fileno(), max(chunk_start - file_start, 0),
+							min(chunk_end - file_start, file_length))
+					except OSError:
+						missing.add(path)
+				if path in missing:
+					break
+				parts.append((path, start_pos - file_start, end_pos - start_pos))
+			else:
+				piece_hash = chunk.hashes[(index - chunk.first) * 20:(index - chunk.first + 1) * 20]
+
+				# the piece is not written yet. nothing but zeros to read
+				if all(not _has_data(data_ranges[path], offset, length) for path, offset, length in parts) \
+						and piece_hash != _zeros_hash(piece_end - piece_start):
+					continue
+
+				data = bytearray()
+				for path, offset, length in parts:
+					f = handles[path]
+					try:
+						f.seek(offset)
+						data.extend(f.read(length))
+					except OSError as ex:
+						logger.error(f"Error while validating file {path}: {ex}")
+						break
+
+				if len(data) == piece_end - piece_start and check_hash(data, piece_hash):
+					bitfield_data.add(index)
+	finally:
+		for f in handles.values():
+			f.close()
 
 	return bitfield_data
+
+
+def _data_ranges(fd: int, start: int, end: int) -> Optional[List[Tuple[int, int]]]:
+	# data extents of a sparse file within [start, end). None means the holes are unknown and everything should be read
+	if not hasattr(os, "SEEK_DATA"):
+		return None
+
+	result: List[Tuple[int, int]] = []
+	position = start
+	try:
+		while position < end:
+			try:
+				data_start = os.lseek(fd, position, os.SEEK_DATA)
+			except OSError as ex:
+				# no data after the position
+				if ex.errno == errno.ENXIO:
+					break
+				raise
+			if data_start >= end:
+				break
+			data_end = os.lseek(fd, data_start, os.SEEK_HOLE)
+			result.append((data_start, min(data_end, end)))
+			position = data_end
+	except OSError:
+		# the file system doesn't support it
+		return None
+	return result
+
+
+def _has_data(data_ranges: Optional[List[Tuple[int, int]]], offset: int, length: int) -> bool:
+	if data_ranges is None:
+		return True
+	# the last extent that starts before the end of the range
+	i = bisect.bisect_left(data_ranges, (offset + length,)) - 1
+	return i >= 0 and data_ranges[i][1] > offset
+
+
+@functools.cache
+def _zeros_hash(size: int) -> bytes:
+	# a piece of zeros is valid even if the file system keeps it as a hole
+	return hashlib.sha1(bytes(size)).digest()
+
+
+def check_pieces(storage: Storage, torrent_info: TorrentInfo, download_path: Path, first: int, last: int) -> Set[int]:
+	# check pieces [first, last) in the current thread
+	if not storage.on_disk:
+		return _check_storage(storage, torrent_info, download_path, first, last)
+	return _check_chunk(_make_chunk(torrent_info, download_path, list(torrent_info.files), first, last))
+
+
+def _check_storage(storage: Storage, torrent_info: TorrentInfo, download_path: Path, first: int, last: int) -> Set[int]:
+	# there are no files to read. ask the storage for every piece
+	return set(
+		index for index in range(first, last)
+		if check_hash(storage.load_piece(download_path, torrent_info, index), torrent_info.get_piece_hash(index)))
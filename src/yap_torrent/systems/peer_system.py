@@ -2,20 +2,24 @@ import asyncio
 import logging
 import time
 from asyncio import StreamReader, StreamWriter, Server
-from typing import Iterable, Set, List
+from functools import partial
+from typing import Iterable, Set, List, Dict, Optional
 
 from angelovich.core.DataStorage import Entity
 
 import yap_torrent.protocol.connection as net
-from yap_torrent.components.peer_ec import PeerConnectionEC, KnownPeersEC, PeerDisconnectedEC
+from yap_torrent.components.peer_ec import PeerConnectionEC, KnownPeersEC, PeerDisconnectedEC, PeerStatsEC, \
+	UploadQueueEC
 from yap_torrent.components.torrent_ec import TorrentInfoEC, TorrentEC, TorrentStatsEC, TorrentState
+from yap_torrent.connector import Connector
 from yap_torrent.env import Env
 from yap_torrent.protocol import extensions
 from yap_torrent.protocol.bt_main_messages import bitfield
 from yap_torrent.protocol.extensions import create_reserved, merge_reserved
 from yap_torrent.protocol.structures import PeerInfo
 from yap_torrent.system import System
-from yap_torrent.systems import iterate_peers, is_torrent_active, is_torrent_complete, get_torrent_entity
+from yap_torrent.systems import iterate_peers, is_torrent_active, is_torrent_complete, get_torrent_entity, \
+	is_torrent_loaded, get_super_seed
 
 logger = logging.getLogger(__name__)
 
@@ -29,6 +33,16 @@ class PeerSystem(System):
 		super().__init__(env)
 		self.server: Server = None
 
+		collection = env.data_storage.get_collection(PeerConnectionEC)
+		env.metrics.gauge_callback("yap_torrent_peers_connected", "Connected peers", lambda: len(collection))
+		self._connector = Connector(env.metrics, env.config.max_half_open, env.config.connect_rate)
+
+		# incoming connections in progress: host -> handshakes, info hash -> admitted peers not added yet
+		self._handshakes: Dict[str, int] = {}
+		self._joining: Dict[bytes, int] = {}
+		self._upload_queue_gauge = env.metrics.gauge(
+			"yap_torrent_upload_queue_requests", "Block requests of peers waiting for upload")
+
 	async def start(self):
 		port = self.env.config.port
 		host = self.env.ip
@@ -39,13 +53,21 @@ class PeerSystem(System):
 		self.env.event_bus.add_listener("action.torrent.stop", self._on_torrent_stop, scope=self)
 		self.env.event_bus.add_listener("action.torrent.start", self._on_torrent_start, scope=self)
 
+		# a free connection slot. don't wait for the next update to use it
+		collection = self.env.data_storage.get_collection(PeerDisconnectedEC)
+		collection.add_listener(collection.EVENT_ADDED, self.__on_peer_disconnected, self)
+
 	def close(self):
 		# TODO: disconnect all peers
 
 		self.server.close()
 		self.env.event_bus.remove_all_listeners(scope=self)
+		self.env.data_storage.get_collection(PeerDisconnectedEC).remove_all_listeners(self)
 		super().close()
 
+	async def __on_peer_disconnected(self, *_):
+		self.wake()
+
 	def process_disconnected(self):
 		ds = self.env.data_storage
 		to_remove = ds.get_collection(PeerDisconnectedEC).entities
@@ -53,6 +75,12 @@ class PeerSystem(System):
 			peer_ec = peer_entity.get_component(PeerConnectionEC)
 			logger.info("Disconnect %s", peer_ec)
 			peer_ec.disconnect()
+
+			# remember how good the peer was. it helps to choose between incoming connections
+			torrent_entity = get_torrent_entity(self.env, peer_ec.info_hash)
+			if torrent_entity:
+				torrent_entity.get_component(KnownPeersEC).add_score(
+					peer_ec.peer_info.host, peer_entity.get_component(PeerStatsEC).download.total)
 			ds.remove_entity(peer_entity)
 
 	def remove_outdated_peers(self):
@@ -98,21 +126,40 @@ class PeerSystem(System):
 			d.get_component(PeerConnectionEC).peer_info.host
 			for d in ds.get_collection(PeerConnectionEC)
 		)
+		active_hosts.update(self._connector.connecting)
 
-		# select only torrents we want to download
+		# select only torrents we want to download. a torrent being validated serves verified pieces
 		active_torrents: List[Entity] = [
 			e for e in ds.get_collection(TorrentEC)
 			if is_torrent_active(e) and not is_torrent_complete(e)
 		]
 		# TODO: sort active torrents by priority
 
-		for torrent_entity in active_torrents:
-			for peer in torrent_entity.get_component(KnownPeersEC).get_peers_to_connect(active_hosts):
+		# torrents take turns. connects are limited and the first one could use them all
+		torrent_limit = self._torrent_connections_limit()
+		candidates = [
+			(e, e.get_component(KnownPeersEC).get_peers_to_connect(active_hosts)) for e in active_torrents
+			if len(iterate_peers(self.env, e.get_component(TorrentEC).info_hash)) < torrent_limit
+		]
+		while candidates:
+			for item in list(candidates):
+				torrent_entity, peers = item
+				peer = next(peers, None)
+				if peer is None:
+					candidates.remove(item)
+					continue
+
 				if len(active_hosts) >= self.env.config.max_connections:
 					return
+				# no free half-open slots or out of the connect rate. the rest waits for the next update
+				if not self._connector.can_connect():
+					return
+
 				active_hosts.add(peer.host)
+				self._connector.reserve(peer.host)
 				info_hash = torrent_entity.get_component(TorrentEC).info_hash
-				self.add_task(self._connect(my_peer_id, info_hash, peer))
+				fails = torrent_entity.get_component(KnownPeersEC).get_fails_count(peer)
+				self.add_task(self._connect(my_peer_id, info_hash, peer, fails))
 
 	async def _update(self, delta_time: float):
 		ds = self.env.data_storage
@@ -147,43 +194,152 @@ class PeerSystem(System):
 		_disconnect_peers(p for p in iterate_peers(self.env, info_hash))
 
 	async def _on_torrent_start(self, info_hash: bytes):
-		pass
+		self.wake()
 
 	async def _on_peers_update(self, info_hash: bytes, peers: Iterable[PeerInfo]):
 		torrent_entity = get_torrent_entity(self.env, info_hash)
 		if not torrent_entity:
 			return
 
-		torrent_entity.get_component(KnownPeersEC).update_peers(peers)
+		known_peers_ec = torrent_entity.get_component(KnownPeersEC)
+		new_peers = set(peers).difference(known_peers_ec.peers)
+		known_peers_ec.update_peers(new_peers)
+		if new_peers:
+			self.wake()
+
+		# new peers for an unloaded torrent. get it back to work
+		if new_peers and not is_torrent_loaded(torrent_entity) \
+				and torrent_entity.get_component(TorrentStatsEC).state == TorrentState.Active:
+			await asyncio.gather(*self.env.event_bus.dispatch("request.torrent.load", info_hash))
 
 	async def _server_callback(self, reader: StreamReader, writer: StreamWriter):
 		peer_info = PeerInfo(*writer.transport.get_extra_info('peername'))
 		logger.info('%s connected to us', peer_info)
 
+		# no room for the connection. drop it before reading a byte
+		reason = self._admit_host(peer_info.host)
+		if reason:
+			self._reject(peer_info, writer, reason)
+			return
+
+		# the slot is taken until the peer entity is created
+		host = peer_info.host
+		self._handshakes[host] = self._handshakes.get(host, 0) + 1
+		try:
+			await self._accept(peer_info, reader, writer)
+		finally:
+			_release(self._handshakes, host)
+
+	async def _accept(self, peer_info: PeerInfo, reader: StreamReader, writer: StreamWriter):
 		# parse handshake
-		local_peer_id = self.env.peer_id
-		result = await net.on_connect(local_peer_id, reader, writer, LOCAL_RESERVED)
+		result = await net.read_handshake(reader)
 		if result is None:
+			self._reject(peer_info, writer, "handshake_failed")
 			return
 
 		# unpack handshake
 		pstrlen, pstr, remote_reserved, info_hash, remote_peer_id = result
 
-		# get peer info from
-		torrent_entity = self.env.data_storage.get_collection(TorrentEC).find(info_hash)
-		if not torrent_entity:
-			logger.debug("%s asks for torrent %s we don't have", peer_info, info_hash)
-			writer.close()
+		# the torrent is known now. nothing is sent to the peer before it's admitted
+		reason = self._admit_peer(info_hash, peer_info, remote_peer_id)
+		if reason:
+			self._reject(peer_info, writer, reason)
 			return
 
-		# calculate protocol extensions bytes for us and remote peer
-		reserved = merge_reserved(LOCAL_RESERVED, remote_reserved)
-		await self._add_peer(info_hash, peer_info, remote_peer_id, reader, writer, reserved)
-
-	async def _connect(self, my_peer_id: bytes, info_hash: bytes, peer_info: PeerInfo):
-		result = await net.connect(peer_info, info_hash, my_peer_id, reserved=LOCAL_RESERVED)
+		self._joining[info_hash] = self._joining.get(info_hash, 0) + 1
+		try:
+			if not await net.send_handshake(writer, info_hash, self.env.peer_id, remote_peer_id, LOCAL_RESERVED):
+				self._reject(peer_info, writer, "handshake_failed")
+				return
+			self.env.metrics.counter("yap_torrent_inbound_connections_total", "Incoming connections",
+			                         result="accepted").inc()
+
+			# calculate protocol extensions bytes for us and remote peer
+			reserved = merge_reserved(LOCAL_RESERVED, remote_reserved)
+			await self._add_peer(info_hash, peer_info, remote_peer_id, reader, writer, reserved)
+		finally:
+			_release(self._joining, info_hash)
+
+	def _admit_host(self, host: str) -> Optional[str]:
+		config = self.env.config
+		handshakes = sum(self._handshakes.values())
+		if handshakes >= config.max_inbound_handshakes:
+			return "flood"
+
+		peers = _live_peers(self.env.data_storage.get_collection(PeerConnectionEC))
+		same_host = self._handshakes.get(host, 0) + int(host in self._connector.connecting) + sum(
+			1 for p in peers if p.get_component(PeerConnectionEC).peer_info.host == host)
+		if same_host >= config.max_connections_per_ip:
+			return "ip_limit"
+
+		# full. only a peer which gave us data before may take someone's place
+		if len(peers) + handshakes >= config.max_connections and not any(
+				e.get_component(KnownPeersEC).get_score(host) > 0 for e in self.env.data_storage.get_collection(TorrentEC)):
+			return "full"
+		return None
+
+	def _admit_peer(self, info_hash: bytes, peer_info: PeerInfo, remote_peer_id: bytes) -> Optional[str]:
+		torrent_entity = get_torrent_entity(self.env, info_hash)
+		if not torrent_entity:
+			logger.debug("%s asks for torrent %s we don't have", peer_info, info_hash)
+			return "unknown_torrent"
+		if torrent_entity.get_component(TorrentStatsEC).state == TorrentState.Inactive:
+			return "inactive"
+		if remote_peer_id == self.env.peer_id:
+			return "self"
+
+		torrent_peers = _live_peers(iterate_peers(self.env, info_hash))
+		if any(p.get_component(PeerConnectionEC).connection.remote_peer_id == remote_peer_id for p in torrent_peers):
+			return "duplicate"
+
+		config = self.env.config
+		score = torrent_entity.get_component(KnownPeersEC).get_score(peer_info.host)
+		if len(torrent_peers) + self._joining.get(info_hash, 0) >= self._torrent_connections_limit():
+			if not self._make_room(torrent_peers, score):
+				return "torrent_full"
+			return None
+
+		peers = _live_peers(self.env.data_storage.get_collection(PeerConnectionEC))
+		if len(peers) + sum(self._joining.values()) >= config.max_connections:
+			if not self._make_room(peers, score):
+				return "full"
+		return None
+
+	def _make_room(self, peers: List[Entity], score: int) -> bool:
+		# the least useful peer leaves if the new one gave us more before. unknown peers don't push anyone out
+		if not peers:
+			return False
+		victim = min(peers, key=self._peer_score)
+		if self._peer_score(victim) >= score:
+			return False
+		logger.info("%s makes room for a better peer", victim.get_component(PeerConnectionEC))
+		victim.add_component(PeerDisconnectedEC())
+		return True
+
+	def _peer_score(self, peer_entity: Entity) -> int:
+		peer_ec = peer_entity.get_component(PeerConnectionEC)
+		torrent_entity = get_torrent_entity(self.env, peer_ec.info_hash)
+		score = torrent_entity.get_component(KnownPeersEC).get_score(peer_ec.peer_info.host) if torrent_entity else 0
+		return score + peer_entity.get_component(PeerStatsEC).download.total
+
+	def _torrent_connections_limit(self) -> int:
+		return self.env.config.max_torrent_connections or self.env.config.max_connections
+
+	def _reject(self, peer_info: PeerInfo, writer: StreamWriter, reason: str) -> None:
+		logger.debug("Reject incoming connection %s: %s", peer_info, reason)
+		writer.close()
+		self.env.metrics.counter("yap_torrent_inbound_connections_total", "Incoming connections", result=reason).inc()
+
+	async def _connect(self, my_peer_id: bytes, info_hash: bytes, peer_info: PeerInfo, fails: int):
+		try:
+			result = await self._connector.connect(peer_info, info_hash, my_peer_id, LOCAL_RESERVED, fails)
+		finally:
+			# a free half-open slot
+			self.wake()
 		if not result:
-			get_torrent_entity(self.env, info_hash).get_component(KnownPeersEC).mark_failed(peer_info)
+			torrent_entity = get_torrent_entity(self.env, info_hash)
+			if torrent_entity:
+				torrent_entity.get_component(KnownPeersEC).mark_failed(peer_info)
 			return
 
 		remote_peer_id, reader, writer, remote_reserved = result
@@ -203,14 +359,26 @@ class PeerSystem(System):
 			connection.close()
 			return
 
-		# send a BITFIELD message first
+		# active torrents are loaded in background. this one is needed now
+		if not is_torrent_loaded(torrent_entity):
+			await asyncio.gather(*self.env.event_bus.dispatch("request.torrent.load", info_hash))
+			if not torrent_entity.is_valid():
+				connection.close()
+				return
+
+		# send a BITFIELD message first. a super-seed hides its pieces
 		local_bitfield = torrent_entity.get_component(TorrentEC).bitfield
-		if local_bitfield.have_num > 0:
+		if local_bitfield.have_num > 0 and not get_super_seed(torrent_entity):
 			torrent_info_ec = torrent_entity.get_component(TorrentInfoEC)
 			await connection.send(bitfield(local_bitfield.dump(torrent_info_ec.info.pieces_num)))
 
 		# create peer entity
-		peer_entity = ds.create_entity().add_component(PeerConnectionEC(info_hash, peer_info, connection, reserved))
+		peer_connection_ec = PeerConnectionEC(info_hash, peer_info, connection, reserved)
+		peer_entity = ds.create_entity().add_component(peer_connection_ec)
+		peer_entity.add_component(PeerStatsEC())
+		peer_entity.add_component(UploadQueueEC(self.env.config.max_upload_queue, self._upload_queue_gauge))
+		connection.read_throttle = partial(
+			self.env.bandwidth.download.acquire, info_hash=info_hash, peer_bucket=peer_connection_ec.download_bucket)
 
 		# notify systems about a new peer
 		# wait for it before start listening to messages
@@ -251,6 +419,17 @@ class PeerSystem(System):
 		peer_entity.add_component(PeerDisconnectedEC())
 
 
+def _live_peers(peers: Iterable[Entity]) -> List[Entity]:
+	# peers which are not about to be disconnected
+	return [p for p in peers if not p.has_component(PeerDisconnectedEC)]
+
+
+def _release(counters: Dict, key) -> None:
+	counters[key] -= 1
+	if not counters[key]:
+		del counters[key]
+
+
 def _disconnect_peers(peers: Iterable[Entity]):
 	for peer_entity in peers:
 		peer_entity.add_component(PeerDisconnectedEC())
@@ -8,8 +8,7 @@ from yap_torrent.components.piece_ec import PieceToSaveEC, PieceEC, PiecePending
 from yap_torrent.components.torrent_ec import TorrentInfoEC, SaveTorrentEC, TorrentEC
 from yap_torrent.env import Env
 from yap_torrent.system import TimeSystem
-from yap_torrent.systems import calculate_downloaded, get_torrent_entity
-from yap_torrent.utils import save_piece
+from yap_torrent.systems import calculate_downloaded, get_torrent_entity, iterate_pieces
 
 logger = logging.getLogger(__name__)
 
@@ -29,6 +28,7 @@ class PieceSystem(TimeSystem):
 		self.env.event_bus.add_listener("piece.complete", _on_piece_complete, scope=self)
 		self.env.event_bus.add_listener("action.torrent.complete", self.__on_torrent_complete, scope=self)
 		self.env.event_bus.add_listener("action.torrent.remove", self._on_torrent_remove, scope=self)
+		self.env.event_bus.add_listener("action.torrent.unload", self._on_torrent_unload, scope=self)
 
 	def close(self) -> None:
 		super().close()
@@ -36,18 +36,28 @@ class PieceSystem(TimeSystem):
 
 	async def __on_torrent_complete(self, _: Entity):
 		await self._save()
+		await asyncio.get_running_loop().run_in_executor(None, self.env.storage.flush, True)
 
 	async def _on_torrent_remove(self, info_hash: bytes):
 		torrent_entity = get_torrent_entity(self.env, info_hash)
-
-		to_remove = (e for e in self.env.data_storage.get_collection(PieceEC).entities if
-		             e.get_component(PieceEC).info_hash == info_hash)
-		for entity in to_remove:
-			self.env.data_storage.remove_entity(entity)
+		self._release(torrent_entity)
 
 		if torrent_entity.has_component(SaveTorrentEC):
 			torrent_entity.remove_component(SaveTorrentEC)
 
+	async def _on_torrent_unload(self, info_hash: bytes):
+		# buffers of a storage which is not on disk are the only copy of the data. the bitfield counts on them
+		self._release(get_torrent_entity(self.env, info_hash), self.env.storage.on_disk)
+
+	def _release(self, torrent_entity: Entity, release_storage: bool = True):
+		# drop cached pieces and storage buffers of the torrent
+		info_hash = torrent_entity.get_component(TorrentEC).info_hash
+		for entity in iterate_pieces(self.env, info_hash):
+			self.env.data_storage.remove_entity(entity)
+
+		if release_storage and torrent_entity.has_component(TorrentInfoEC):
+			self.env.storage.release(self.download_path, torrent_entity.get_component(TorrentInfoEC).info)
+
 	async def _update(self, delta_time: float):
 		await self._save()
 		await self.cleanup()
@@ -58,6 +68,7 @@ class PieceSystem(TimeSystem):
 
 	def save_pieces(self):
 		ds = self.env.data_storage
+		storage = self.env.storage
 		updated_torrents = set()
 		to_save = ds.get_collection(PieceToSaveEC).entities
 		for piece_entity in to_save:
@@ -65,7 +76,8 @@ class PieceSystem(TimeSystem):
 			updated_torrents.add(piece.info_hash)
 			torrent_entity = ds.get_collection(TorrentEC).find(piece.info_hash)
 			torrent_info = torrent_entity.get_component(TorrentInfoEC).info
-			save_piece(self.download_path, torrent_info, piece.info.index, piece.data)
+			storage.save_piece(self.download_path, torrent_info, piece.info.index, piece.data)
+		storage.flush()
 
 		# cleanup pieces to save
 		for piece_entity in to_save:
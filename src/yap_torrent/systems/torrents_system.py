@@ -3,7 +3,7 @@ import logging
 
 from yap_torrent.components.torrent_ec import TorrentState, TorrentStatsEC
 from yap_torrent.system import System
-from yap_torrent.systems import get_torrent_entity
+from yap_torrent.systems import get_torrent_entity, is_torrent_loaded
 
 logger = logging.getLogger(__name__)
 
@@ -24,6 +24,11 @@ class TorrentSystem(System):
 
 	async def _on_torrent_start(self, info_hash: bytes):
 		torrent_entity = get_torrent_entity(self.env, info_hash)
+
+		# metadata could be still on disk
+		if not is_torrent_loaded(torrent_entity):
+			await asyncio.gather(*self.env.event_bus.dispatch("request.torrent.load", info_hash))
+
 		torrent_entity.get_component(TorrentStatsEC).state = TorrentState.Active
 		await asyncio.gather(*self.env.event_bus.dispatch("action.torrent.start", info_hash))
 
@@ -39,4 +44,6 @@ class TorrentSystem(System):
 		await self._on_torrent_stop(info_hash)
 		await asyncio.gather(*self.env.event_bus.dispatch("action.torrent.remove", info_hash))
 		self.env.data_storage.remove_entity(get_torrent_entity(self.env, info_hash))
+		self.env.metrics.remove(torrent=info_hash.hex())
+		self.env.bandwidth.remove_torrent(info_hash)
 		logger.info(f"Remove torrent {info_hash.hex()} complete")
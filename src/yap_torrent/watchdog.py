@@ -0,0 +1,84 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Optional
+
+from yap_torrent.profiler import Histogram
+
+logger = logging.getLogger(__name__)
+
+# stalls to keep for the export
+MAX_STALLS = 20
+
+
+@dataclass(frozen=True, slots=True)
+class Stall:
+	time: float  # unix time the stall was detected
+	lag: float
+	stack: str  # stack of the loop thread at the moment the lag passed the threshold
+
+
+class LoopWatchdog:
+	# a thread which pings the event loop. a late answer is the loop lag. if the loop doesn't answer in time
+	# the stack of the loop thread is the call which blocks it
+	def __init__(self, loop: asyncio.AbstractEventLoop, interval: float, threshold: float):
+		self._loop = loop
+		self._loop_thread_id = threading.get_ident()
+		self._interval = interval
+		self._threshold = threshold
+
+		self.lag: Histogram = Histogram()
+		self.stalls: Deque[Stall] = deque(maxlen=MAX_STALLS)
+		self.stalls_count: int = 0
+
+		self._stop_event = threading.Event()
+		self._thread: Optional[threading.Thread] = None
+
+	def start(self) -> None:
+		self._thread = threading.Thread(target=self._run, name="loop-watchdog", daemon=True)
+		self._thread.start()
+
+	def stop(self) -> None:
+		self._stop_event.set()
+		if self._thread:
+			self._thread.join()
+			self._thread = None
+
+	def _run(self) -> None:
+		while not self._stop_event.wait(self._interval):
+			answer = threading.Event()
+			start_time = time.monotonic()
+			try:
+				self._loop.call_soon_threadsafe(answer.set)
+			except RuntimeError:
+				# the loop is closed
+				return
+
+			stack = None
+			if not answer.wait(self._threshold):
+				stack = self._capture_stack()
+				# wait for the end of the stall to know its length
+				while not answer.wait(self._interval):
+					if self._stop_event.is_set():
+						return
+
+			lag = time.monotonic() - start_time
+			self.lag.add(lag)
+			if stack is not None:
+				self._on_stall(Stall(time.time(), lag, stack))
+
+	def _capture_stack(self) -> str:
+		frame = sys._current_frames().get(self._loop_thread_id)
+		if frame is None:
+			return ""
+		return "".join(traceback.format_stack(frame))
+
+	def _on_stall(self, stall: Stall) -> None:
+		self.stalls_count += 1
+		self.stalls.append(stall)
+		logger.warning(f"Event loop was blocked for {stall.lag:.3f} s. Loop thread stack:\n{stall.stack}")